@@ -3,6 +3,7 @@ import socket as sock
 import select
 import sys
 import argparse
+import collections
 
 import jim
 
@@ -24,6 +25,8 @@ class Client(metaclass=ClientVerifier):
         log.debug("Соединение с чат-сервером %s:%d",
                      self._server_address if self._server_address else '(broadcast)', self._server_port)
         self._connected = False
+        self._decoder = jim.FrameDecoder()          # splits data received from server into messages
+        self._frames = collections.deque()          # received messages waiting for processing
         try:
             self._socket = sock.socket(sock.AF_INET, sock.SOCK_STREAM)
             self._socket.settimeout(sett.CONNECTION_TIMEOUT)            # timeout of connection to server
@@ -52,9 +55,9 @@ class Client(metaclass=ClientVerifier):
         if not self._connected:
             log.error("Чат невозможен - не установлено соединение с сервером")
             return False
-        log.debug(f"Посылка сообщения серверу: {message}")
+        log.debug("Посылка сообщения серверу: %s", message)
         try:
-            self._socket.send(jim.Message(**message).json.encode(sett.DEFAULT_ENCODING))
+            self._socket.sendall(jim.frame(jim.Message(**message).json.encode(sett.DEFAULT_ENCODING)))
         except ValueError as e:
             log.error("Ошибка формирования сообщения: %s", e)
             return False
@@ -67,18 +70,22 @@ class Client(metaclass=ClientVerifier):
         else:
             return True
 
-    def _receive_from_server(self) -> (bool, str):
+    def _receive_from_server(self) -> (bool, bytes):
         if not self._connected:
             log.error("Чат невозможен - не установлено соединение с сервером")
             return False, ""
         log.debug("Прием сообщения от сервера")
         try:
-            response_str = self._socket.recv(jim.MAX_JIM_LEN)
-            if not response_str:
-                log.critical("Соединение закрыто сервером.")
-                self._connected = False
-                return False, ""
-            log.debug(f"Получено сообщение от сервера: {response_str}")
+            # Receive data until at least one complete message is available
+            while not self._frames:
+                data_bytes = self._socket.recv(sett.RECEIVE_BUFFER_SIZE)
+                if not data_bytes:
+                    log.critical("Соединение закрыто сервером.")
+                    self._connected = False
+                    return False, ""
+                self._frames.extend(self._decoder.feed(data_bytes))
+            response_str = self._frames.popleft()
+            log.debug("Получено сообщение от сервера: %s", response_str)
         except sock.timeout as e:       # в соответствии с описанием в лекции, не тестировалось
             log.critical("Превышено время ожидания приема данных от сервера: %s", e)
             return False, ""
@@ -133,6 +140,12 @@ class Client(metaclass=ClientVerifier):
             log.error("Сервер сообщил об ошибке аутентификации: %s - %s",  response.response, response.message)
         elif response.response == jim.Responses.NOT_FOUND:
             log.warning("Сервер сообщил, что адресат не в сети: %s - %s",  response.response, response.message)
+        elif response.response == jim.Responses.FORBIDDEN:
+            log.warning("Сервер сообщил, что пользователь не участник чата: %s - %s",
+                        response.response, response.message)
+        elif response.response == jim.Responses.GONE:
+            log.warning("Адресат не в сети, сообщение будет доставлено при подключении: %s - %s",
+                        response.response, response.message)
         elif response.response != jim.Responses.OK:
             log.critical("Ошибочный код возврата сервера: %s - %s",  response.response, response.message)
             return False
@@ -157,32 +170,48 @@ class Client(metaclass=ClientVerifier):
                  jim.MessageFields.MESSAGE: message_text
                 })
 
+    def send_join(self, room: str) -> bool:
+        return self._send_message_and_wait_for_response(
+                {jim.MessageFields.ACTION: jim.Actions.JOIN,
+                 jim.MessageFields.ROOM: room
+                })
+
+    def send_leave(self, room: str) -> bool:
+        return self._send_message_and_wait_for_response(
+                {jim.MessageFields.ACTION: jim.Actions.LEAVE,
+                 jim.MessageFields.ROOM: room
+                })
+
     def receive_chat_message(self) -> (bool, str, str, str):
         """
-        Receives chat message from server
-        :return: status, sender, addressee and message
+        Receives chat message from server, answering probe messages
+        :return: status, sender, addressee and message (empty if a probe has been answered)
         """
         success, message = self._receive_message_from_server()
         if not success:
             return False, "", "", ""
         try:
-            if message.action != jim.Actions.MESSAGE:
+            if message.action == jim.Actions.PROBE:
+                log.debug("Получен запрос проверки связи от сервера")
+                return self.send_presence(), "", "", ""
+            elif message.action != jim.Actions.MESSAGE:
                 log.error("Ожидается сообщения чата, получено сообщение: %s", message.json)
                 return False, "", "", ""
             else:
-                return True, \
-                       message.kwargs[jim.MessageFields.FROM], \
-                       message.kwargs[jim.MessageFields.TO], \
-                       message.kwargs[jim.MessageFields.MESSAGE]
+                return True, message.sender, message.target, message.text
         except KeyError as e:
             log.error("Неверный формат сообщения чата: %s", message.json)
             return False, "", "", ""
 
     def wait_for_messages(self):
         while True:                 # wait for data from stdin or server connection
-            print("Введите имя адресата/чата и сообщение через пробел: ", end="", flush=True)
+            print("Введите имя адресата/чата и сообщение через пробел "
+                  f"или {sett.COMMAND_JOIN}/{sett.COMMAND_LEAVE} и имя чата: ", end="", flush=True)
             try:
-                read_ready, _, _ = select.select([sys.stdin, self._socket], [], [], sett.SELECT_TIMEOUT)
+                if self._frames:            # messages already received are processed without waiting
+                    read_ready = [self._socket]
+                else:
+                    read_ready, _, _ = select.select([sys.stdin, self._socket], [], [], sett.SELECT_TIMEOUT)
             except select.error as e:
                 log.critical("Непредвиденная ошибка select(): %s", e)
                 return
@@ -196,7 +225,14 @@ class Client(metaclass=ClientVerifier):
                         message = input()
                         target_nickname = message.split(" ")[0]
                         message = message.removeprefix(target_nickname).strip()
-                        if target_nickname is None or target_nickname == "":
+                        if target_nickname in (sett.COMMAND_JOIN, sett.COMMAND_LEAVE):
+                            log.debug("Команда %s для чата %s", target_nickname, message)
+                            send_command = self.send_join if target_nickname == sett.COMMAND_JOIN else self.send_leave
+                            if not message.startswith(jim.ROOM_PREFIX):
+                                print(f"Имя чата должно начинаться с '{jim.ROOM_PREFIX}'")
+                            elif not send_command(message):
+                                return
+                        elif target_nickname is None or target_nickname == "":
                             print("Имя адресата/чата не может быть пустым")
                         elif message is None or message == "":
                             print("Сообщение не может быть пустым")
@@ -210,6 +246,8 @@ class Client(metaclass=ClientVerifier):
                         success, sender, addressee, text = self.receive_chat_message()
                         if not success:
                             return
+                        if not sender:
+                            continue
                         log.info("Получено сообщение от '%s' для '%s': '%s'", sender, addressee, text)
                         print(f"({sender}->{addressee}): {text}")
 
@@ -0,0 +1,299 @@
+"""
+Chat client library for asyncio: every AsyncClient is a chat session serviced by the running event loop,
+so a single process can run many sessions (bots, integrations) at once.
+
+    client = AsyncClient("127.0.0.1", "7777", "bot")
+    if await client.connect():
+        response = await client.send_presence()     # await client.send_authenticate(password) first if registered
+        await client.send_chat_message("#all", "Hello!")
+        async for message in client:
+            print(message.sender, message.text)
+        await client.close()
+"""
+import asyncio
+import logging
+import itertools
+
+import jim
+
+import client_settings as sett
+
+log = logging.getLogger(sett.LOG_NAME)
+
+
+class AsyncClient:
+    """
+    Chat client session - sends messages without waiting for responses to the previous ones,
+    matching responses to requests by request id, and delivers incoming chat messages via async iteration
+    """
+    def __init__(self, server_address: str = None, server_port: str = None, nickname: str = None,
+                 codec: str = sett.CODEC, token: str = None):
+        """
+        :param server_address: server IP address
+        :param server_port: server port
+        :param nickname: user nickname
+        :param codec: message encoding to request from server in presence (jim.CODEC_JSON or jim.CODEC_BINARY)
+        :param token: (optional) session token issued by server before, to resume the session without password
+        Attributes:
+        _pending - requests waiting for response: request id -> future
+        _messages - received chat messages waiting to be iterated, None marks connection closed
+        _history - messages received from the history by history request id
+        """
+        self._server_address = server_address if server_address else sett.DEFAULT_SERVER_ADDRESS
+        self._server_port = int(server_port) if server_port else sett.DEFAULT_PORT
+        self._nickname = nickname if nickname else "client"
+        self._connected = False
+        self._reader = None
+        self._writer = None
+        self._receiver = None
+        self._decoder = jim.FrameDecoder()
+        self._requested_codec = codec
+        self._token = token
+        self._codec = jim.CODEC_JSON        # until server accepts the requested codec
+        self._pending = {}
+        self._request_ids = itertools.count(1)
+        self._messages = asyncio.Queue()
+        self._history = {}
+
+    @property
+    def connected(self) -> bool:
+        return self._connected
+
+    @property
+    def nickname(self) -> str:
+        return self._nickname
+
+    @property
+    def token(self) -> str | None:
+        """ Session token issued by server on authentication, None if not authenticated """
+        return self._token
+
+    async def connect(self) -> bool:
+        """
+        Connect to the server and start receiving messages
+        :return: True if connected, False otherwise
+        """
+        log.debug("Соединение с чат-сервером %s:%d", self._server_address, self._server_port)
+        try:
+            self._reader, self._writer = await asyncio.wait_for(
+                asyncio.open_connection(self._server_address, self._server_port), sett.CONNECTION_TIMEOUT)
+        except asyncio.TimeoutError as e:
+            log.critical("Превышено время ожидания соединения с сервером: %s", e)
+            return False
+        except OSError as e:
+            log.critical("Ошибка соединения с сервером: %s", e)
+            return False
+        log.info("Соединение с сервером %s:%d установлено с адреса %s:%d, имя пользователя %s",
+                 self._server_address, self._server_port, *self._writer.get_extra_info('sockname')[:2],
+                 self._nickname)
+        self._connected = True
+        self._receiver = asyncio.create_task(self._receive())
+        return True
+
+    async def _receive(self):
+        """ Receive messages from the server until the connection is closed: complete requests, queue chat messages """
+        try:
+            while data := await self._reader.read(sett.RECEIVE_BUFFER_SIZE):
+                for frame in self._decoder.feed(data):
+                    self._process_frame(frame)
+            if self._connected:
+                log.critical("Соединение закрыто сервером")
+        except ValueError as e:
+            log.critical("Нарушен формат потока данных от сервера: %s", e)
+        except OSError as e:
+            if self._connected:
+                log.critical("Нет соединения с сервером: %s", e)
+        finally:
+            self._connected = False
+            pending, self._pending = self._pending, {}
+            for future in pending.values():
+                if not future.done():
+                    future.set_exception(ConnectionError("Нет соединения с сервером"))
+            self._messages.put_nowait(None)
+            self._writer.close()
+
+    def _process_frame(self, frame: bytes):
+        """
+        Process a single message received from the server
+        :param frame: message payload
+        """
+        try:
+            fields = jim.decode(frame)
+        except ValueError as e:
+            log.error("Ошибка декодирования сообщения: %s", e)
+            return
+        try:
+            message = jim.Message(**fields)
+        except ValueError:
+            try:
+                response = jim.Response(**fields)
+            except ValueError as e:
+                log.error("Некорректный формат сообщения: %s", e)
+                return
+            # Server has accepted the codec requested in presence - use it for the next messages
+            codec = response.kwargs.get(jim.ResponseFields.CODEC)
+            if codec:
+                self._codec = codec
+            # Responses without request id are matched in the order of requests
+            request_id = response.kwargs.get(jim.ResponseFields.ID)
+            if request_id is None:
+                request_id = next(iter(self._pending), None)
+            future = self._pending.pop(request_id, None)
+            if future is None:
+                log.error("Получен ответ на неизвестный запрос (%s): %s - %s",
+                          request_id, response.response, response.message)
+            elif not future.done():         # not cancelled
+                future.set_result(response)
+            return
+        if message.action == jim.Actions.PROBE:
+            # Server checks the client is alive - answer with presence, the response is of no interest
+            log.debug("Получен запрос проверки связи от сервера")
+            self.send_message_nowait(self._presence()).add_done_callback(
+                lambda future: future.cancelled() or future.exception())
+            return
+        if message.action != jim.Actions.MESSAGE:
+            log.error("Ожидается сообщения чата, получен неподдерживаемый тип сообщения")
+            return
+        # Messages from the history precede the response to the history request
+        history = self._history.get(message.kwargs.get(jim.MessageFields.HISTORY))
+        if history is not None:
+            history.append(message)
+            return
+        self._messages.put_nowait(message)
+
+    def send_message_nowait(self, message: dict) -> asyncio.Future:
+        """
+        Send message to the server with a new request id, without waiting for the response
+        :param message: message fields
+        :return: future completed with the server response (jim.Response), or with ConnectionError if connection
+            is lost; raises ValueError if message format error
+        """
+        return self._send_request(message, next(self._request_ids))
+
+    def _send_request(self, message: dict, request_id: int) -> asyncio.Future:
+        """ Send message to the server with the given request id (see send_message_nowait()) """
+        data = jim.frame(jim.Message(**message, **{jim.MessageFields.ID: request_id}).to_bytes(self._codec))
+        future = asyncio.get_running_loop().create_future()
+        if not self._connected:
+            future.set_exception(ConnectionError("Нет соединения с сервером"))
+            return future
+        self._pending[request_id] = future
+        self._writer.write(data)
+        return future
+
+    async def send_message(self, message: dict) -> jim.Response:
+        """
+        Send message to the server and wait for the response
+        :param message: message fields
+        :return: server response; raises ConnectionError if connection is lost, ValueError if message format error
+        """
+        future = self.send_message_nowait(message)
+        if not future.done():
+            # Let the transport buffer drain if the server does not keep up
+            try:
+                await self._writer.drain()
+            except ConnectionError:
+                pass                        # the request fails when the receiver detects lost connection
+        return await future
+
+    def _presence(self) -> dict:
+        message = {jim.MessageFields.ACTION: jim.Actions.PRESENCE,
+                   jim.MessageFields.USER: {
+                       jim.MessageFields.ACCOUNT_NAME: self._nickname,
+                       jim.MessageFields.STATUS: "Online"
+                   },
+                   jim.MessageFields.CODEC: self._requested_codec
+                   }
+        if self._token:
+            message[jim.MessageFields.TOKEN] = self._token
+        return message
+
+    async def send_presence(self) -> jim.Response:
+        return await self.send_message(self._presence())
+
+    async def send_authenticate(self, password: str) -> jim.Response:
+        """
+        Authenticate the user (registered users' nicknames can't be used without it), remembering the session
+        token issued by server to resume the session on reconnect
+        :param password: password
+        :return: server response
+        """
+        response = await self.send_message(
+                {jim.MessageFields.ACTION: jim.Actions.AUTHENTICATE,
+                 jim.MessageFields.USER: {
+                     jim.MessageFields.ACCOUNT_NAME: self._nickname,
+                     jim.MessageFields.PASSWORD: password
+                 }
+                })
+        if response.response == jim.Responses.OK:
+            self._token = response.kwargs.get(jim.ResponseFields.TOKEN, self._token)
+        return response
+
+    async def send_chat_message(self, target_nickname: str, message_text: str) -> jim.Response:
+        return await self.send_message(
+                {jim.MessageFields.ACTION: jim.Actions.MESSAGE,
+                 jim.MessageFields.TO: target_nickname,
+                 jim.MessageFields.FROM: self._nickname,
+                 jim.MessageFields.MESSAGE: message_text
+                })
+
+    async def send_join(self, room: str) -> jim.Response:
+        return await self.send_message(
+                {jim.MessageFields.ACTION: jim.Actions.JOIN,
+                 jim.MessageFields.ROOM: room
+                })
+
+    async def send_leave(self, room: str) -> jim.Response:
+        return await self.send_message(
+                {jim.MessageFields.ACTION: jim.Actions.LEAVE,
+                 jim.MessageFields.ROOM: room
+                })
+
+    async def fetch_history(self, peer: str, before: int = None, limit: int = None) -> tuple:
+        """
+        Fetch a page of the conversation history, latest messages first
+        :param peer: chat room or user nickname
+        :param before: (optional) cursor returned with the page after the requested one, the latest page if missing
+        :param limit: (optional) maximum number of messages, the server's default if missing
+        :return: server response, messages of the page in chronological order and the cursor of the previous page
+            (None if there are no more messages); raises ConnectionError if connection is lost
+        """
+        message = {jim.MessageFields.ACTION: jim.Actions.HISTORY,
+                   jim.MessageFields.PEER: peer}
+        if before is not None:
+            message[jim.MessageFields.BEFORE] = before
+        if limit is not None:
+            message[jim.MessageFields.LIMIT] = limit
+        request_id = next(self._request_ids)
+        history = self._history[request_id] = []
+        try:
+            response = await self._send_request(message, request_id)
+        finally:
+            del self._history[request_id]
+        return response, history, response.kwargs.get(jim.ResponseFields.BEFORE)
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self) -> jim.Message:
+        """ Wait for the next chat message; iteration stops when the connection is closed """
+        message = await self._messages.get()
+        if message is None:
+            self._messages.put_nowait(None)         # keep iteration stopped for other iterators
+            raise StopAsyncIteration
+        return message
+
+    async def close(self):
+        """ Close connection to the server """
+        if self._writer is None:
+            return
+        if self._connected:
+            log.info("Завершение соединения с чат-сервером %s:%d", self._server_address, self._server_port)
+            self._connected = False
+            self._writer.close()
+        if self._receiver:
+            await self._receiver
+        try:
+            await self._writer.wait_closed()
+        except OSError:
+            pass
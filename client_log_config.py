@@ -1,5 +1,7 @@
 import os
 import sys
+import queue
+import atexit
 import logging.handlers
 
 import client_settings as sett
@@ -21,3 +23,19 @@ log.setLevel(sett.LOG_FILE_LEVEL)
 log_handler = logging.FileHandler(sett.LOG_FILE_NAME)
 log_handler.setFormatter(logging.Formatter(sett.LOG_FILE_FORMAT))
 log.addHandler(log_handler)
+
+# Write log records in a separate thread, so that the file and console I/O does not block the caller:
+#  loggers only put records to the queue, the listener thread passes them to the handlers configured above
+log_listener = None
+if sett.LOG_QUEUE:
+    root_log = logging.getLogger()
+    log_handler.addFilter(logging.Filter(sett.LOG_NAME))       # the file gets app records only, as before
+    log_handlers = (*root_log.handlers, log_handler)
+    for handler in root_log.handlers[:]:
+        root_log.removeHandler(handler)
+    log.removeHandler(log_handler)
+    log_queue = queue.SimpleQueue()
+    root_log.addHandler(logging.handlers.QueueHandler(log_queue))
+    log_listener = logging.handlers.QueueListener(log_queue, *log_handlers, respect_handler_level=True)
+    log_listener.start()
+    atexit.register(log_listener.stop)
@@ -11,6 +11,10 @@ DEFAULT_ENCODING = 'UTF-8'              # Default encoding for JIM messages
 DEFAULT_SERVER_ADDRESS = '127.0.0.1'    # Server IP address for client to connect to
 CONNECTION_TIMEOUT = 60                 # Connection timeout in seconds
 SELECT_TIMEOUT = 60.0                   # Timeout for select.select() function waiting for data
+CODEC = 'binary'                        # Message encoding to request from server in presence ('json' or 'binary')
+RECEIVE_BUFFER_SIZE = 65536             # Max bytes to receive from server at once - may contain several messages
+COMMAND_JOIN = '/join'                  # Chat input command to join a chat room
+COMMAND_LEAVE = '/leave'                # Chat input command to leave a chat room
 
 DIRECTORY_SEPARATOR = '/'
 
@@ -24,3 +28,5 @@ LOG_CONSOLE_FORMAT = "%(asctime)s %(levelname)-10s %(module)s %(message)s"
 LOG_FILE_NAME = DIRECTORY_SEPARATOR.join((LOG_DIRECTORY, 'client.log'))
 LOG_FILE_LEVEL = logging.NOTSET
 LOG_FILE_FORMAT = "%(asctime)s %(levelname)-10s %(module)s %(message)s"
+# Write log in a separate thread, so that file and console output do not delay the caller (e.g. asyncio event loop)
+LOG_QUEUE = False
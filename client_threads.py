@@ -3,10 +3,13 @@ import socket as sock
 import select
 import sys
 import argparse
+import getpass
 
 import time
 import threading
 import queue
+import itertools
+import concurrent.futures
 
 import jim
 
@@ -27,27 +30,36 @@ class Client:
             return
         log.info("Прием сообщений от сервера стартовал")
         while True:
-            message = None
+            # The socket is full-duplex - wait for data without blocking the writer
             try:
-                self._socket_lock.acquire(True)
-                message = self._socket.recv(jim.MAX_JIM_LEN)
-            except sock.timeout as e:
-                continue
-            except BrokenPipeError as e:
+                message = self._socket.recv(sett.RECEIVE_BUFFER_SIZE)
+            except (BrokenPipeError, ConnectionResetError) as e:
                 log.critical("Нет соединения с сервером: %s", e)
                 self._connected = False
                 self._reader_queue.put(None)
                 return
             except Exception as e:
-                log.critical("Непредвиденная ошибка при приеме сообщения: %s", e)
+                if self._connected:
+                    log.critical("Непредвиденная ошибка при приеме сообщения: %s", e)
+                    self._connected = False
                 self._reader_queue.put(None)
                 return
-            finally:
-                self._socket_lock.release()
             if message:
-                log.debug(f"Получено сообщение от сервера: {message}")
-                self._reader_queue.put(message)
-                log.debug(f"Размер очереди входящих сообщений: {self._reader_queue.qsize()}")
+                log.debug("Получены данные от сервера: %s", message)
+                try:
+                    frames = self._decoder.feed(message)
+                except ValueError as e:
+                    log.critical("Нарушен формат потока данных от сервера: %s", e)
+                    self._reader_queue.put(None)
+                    return
+                for frame in frames:
+                    self._reader_queue.put(frame)
+                if self._debug:
+                    log.debug("Размер очереди входящих сообщений: %d", self._reader_queue.qsize())
+            elif not self._connected:
+                log.info("Прием сообщений от сервера закончен - соединение закрывается")
+                self._reader_queue.put(None)
+                return
             else:
                 log.critical("Соединение закрыто сервером.")
                 self._connected = False
@@ -61,50 +73,54 @@ class Client:
             message_bytes = self._reader_queue.get()
             if not message_bytes:
                 log.info("Обработка принятых сообщений закончена - обнаружен признак конца очереди")
+                self._fail_requests(ConnectionError("Нет соединения с сервером"))
                 return
             # process message
-            log.debug(f"Получено сообщение для обработки: {message_bytes}")
+            log.debug("Получено сообщение для обработки: %s", message_bytes)
             try:
 
-                # decode message to string
+                # decode message of any codec
                 try:
-                    message_str = message_bytes.decode(sett.DEFAULT_ENCODING)
+                    message_fields = jim.decode(message_bytes)
                 except ValueError as e:
-                    log.error("Ошибка декодирования байтовой строки сообщения: %s", e)
+                    log.error("Ошибка декодирования сообщения: %s", e)
                     continue
 
                 # try to interpret message as user message
                 try:
-                    message = jim.Message.from_str(message_str)
+                    message = jim.Message(**message_fields)
                 except ValueError as e:
 
                     # not a user message - try to interpret it as server response
                     try:
-                        response = jim.Response.from_str(message_str)
+                        response = jim.Response(**message_fields)
                     except ValueError as e:
 
                         # not a message nor a response - report and drop
                         log.error("Некорректный формат сообщения: %s", e)
                         continue
 
-                    # SUCCESS: it's a response - QUEUE IT for processing
+                    # SUCCESS: it's a response - COMPLETE THE REQUEST it responds to
                     else:
-                        self._response_queue.put(response)
-                        log.debug("Получен ответ от сервера - поставлен в очередь (всего %d ответов в очереди)",
-                                  self._response_queue.qsize())
+                        self._complete_request(response)
 
                 # it's a message - interpret it
                 else:
-                    if message.action != jim.Actions.MESSAGE:
+                    if message.action == jim.Actions.PROBE:
+                        # server checks the client is alive - ANSWER WITH PRESENCE, the response is of no interest
+                        log.debug("Получен запрос проверки связи от сервера")
+                        self.send_message_nowait(self._presence())
+
+                    elif message.action != jim.Actions.MESSAGE:
                         # message type not supported - report and drop
                         log.error("Ожидается сообщения чата, получен неподдерживаемый тип сообщения")
                         continue
 
                     # SUCCESS: it's a chat message - PRINT IT
                     else:
-                        sender = message.kwargs[jim.MessageFields.FROM]
-                        target = message.kwargs[jim.MessageFields.TO]
-                        text = message.kwargs[jim.MessageFields.MESSAGE]
+                        sender = message.sender
+                        target = message.target
+                        text = message.text
                         log.debug("Получено сообщение от '%s' для '%s': '%s'", sender, target, text)
                         print(f"({sender}->{target}): {text}")
 
@@ -116,7 +132,8 @@ class Client:
             # report success to log and queue
             log.debug("Обработка сообщения прошла успешно")
             self._reader_queue.task_done()
-            log.debug(f"Размер очереди входящих сообщений: {self._reader_queue.qsize()}")
+            if self._debug:
+                log.debug("Размер очереди входящих сообщений: %d", self._reader_queue.qsize())
 
     def socket_writer(self):
         if not self._connected:
@@ -125,42 +142,42 @@ class Client:
         log.info("Отправка сообщений на сервер стартовала")
         while True:
             message = self._writer_queue.get()
+            if message is None:
+                log.info("Отправка сообщений на сервер закончена - обнаружен признак конца очереди")
+                return
             try:
-                log.debug(f"Получено сообщение для отправки на сервер: {message}")
-                self._socket_lock.acquire(True)
-                self._socket.send(message)
+                log.debug("Получено сообщение для отправки на сервер: %s", message)
+                # Sent at once - the reader waiting for data in the other thread does not hold the socket
+                self._socket.sendall(message)
                 log.debug("Полученное для отправки на сервер сообщение отправлено")
-            except BrokenPipeError as e:
+            except (BrokenPipeError, ConnectionResetError) as e:
                 log.critical("Нет соединения с сервером: %s", e)
                 self._connected = False
                 return
-            except sock.timeout as e:  # в соответствии с описанием в лекции, не тестировалось
-                log.critical("Превышено время ожидания посылки данных серверу: %s", e)
-                return False
             except Exception as e:
                 log.critical("Непредвиденная ошибка при отправке сообщения: %s", e)
                 return
-            finally:
-                self._socket_lock.release()
             self._writer_queue.task_done()
-            log.debug(f"Размер очереди исходящих сообщений: {self._writer_queue.qsize()}")
+            if self._debug:
+                log.debug("Размер очереди исходящих сообщений: %d", self._writer_queue.qsize())
 
     def __init__(self, server_address: str = None, server_port: str = None, nickname: str = None):
         self._server_address = server_address if server_address else sett.DEFAULT_SERVER_ADDRESS
         self._server_port = int(server_port) if server_port else sett.DEFAULT_PORT
         self._nickname = nickname if nickname else "client"
+        self._debug = log.isEnabledFor(logging.DEBUG)  # debug logging enabled - checked once, not for every message
         log.debug("Соединение с чат-сервером %s:%d",
                      self._server_address if self._server_address else '(broadcast)', self._server_port)
         self._connected = False
+        self._decoder = jim.FrameDecoder()          # splits data received from server into messages
+        self._codec = jim.CODEC_JSON                # encoding of messages sent - until server accepts sett.CODEC
         try:
             self._socket = sock.socket(sock.AF_INET, sock.SOCK_STREAM)
             self._socket.settimeout(sett.CONNECTION_TIMEOUT)            # timeout of connection to server
             self._socket.connect((self._server_address, self._server_port))
-            self._socket.setblocking(True)              # blocking mode - will wait for data during send() and recv()
-            # !!! Почему-то, даже если поставить 0,5 секунд, writer очень долго - несколько секунд -
-            # захватывает контроль над lock. Оптимальное не слишком маленькое значение, при котором ожидание захвата
-            # lock не более секунды - 0,1.
-            self._socket.settimeout(0.1)                # timeout to use the socket to read and write simultaneously
+            # Blocking mode without timeout - the reader and the writer threads wait in recv() and sendall()
+            # independently, as TCP socket is full-duplex; shutdown() wakes the reader up
+            self._socket.setblocking(True)
         except ConnectionRefusedError as e:
             log.critical("Соединение отклонено сервером: %s", e)
         except sock.timeout as e:               # в соответствии с описанием в лекции, не тестировалось
@@ -176,37 +193,115 @@ class Client:
                          self._nickname)
             self._connected = True
         # MULTITHREADING INIT
-        self._socket_lock = threading.Lock()        # socket lock
         self._reader = threading.Thread(target=self.socket_reader, daemon=True)         # socket reader
         self._processor = threading.Thread(target=self.message_processor, daemon=True)  # message processor
         self._writer = threading.Thread(target=self.socket_writer, daemon=True)       # message writer
         self._reader_queue = queue.Queue()          # read queue
         self._writer_queue = queue.Queue()          # writer queue
-        self._response_queue = queue.Queue()        # server response queue
+        self._pending = {}                          # requests waiting for response: request id -> future
+        self._pending_lock = threading.Lock()       # pending requests lock - used by callers and message processor
+        self._request_ids = itertools.count(1)      # request id generator
 
     @property
     def connected(self):
         return self._connected
 
-    def _send_message_to_server(self, message: dict) -> bool:
-        log.debug(f"Постановка сообщения в очередь на отправку: {message}")
+    def _complete_request(self, response: jim.Response):
+        """
+        Complete the request the server has responded to with the response.
+        Responses without request id (e.g. of a server not supporting ids) are matched in the order of requests.
+        :param response: server response
+        """
+        request_id = response.kwargs.get(jim.ResponseFields.ID)
+        with self._pending_lock:
+            if request_id is None:
+                request_id = next(iter(self._pending), None)
+            future = self._pending.pop(request_id, None)
+        if future is None:
+            log.error("Получен ответ на неизвестный запрос (%s): %s - %s",
+                      request_id, response.response, response.message)
+            return
+        log.debug("Получен ответ на запрос %d: %s", request_id, response.response)
+        # Server has accepted the codec requested in presence - use it for the next messages
+        codec = response.kwargs.get(jim.ResponseFields.CODEC)
+        if codec:
+            log.debug("Кодирование сообщений: %s", codec)
+            self._codec = codec
+        future.set_result(response)
+
+    def _fail_requests(self, exception: Exception):
+        """ Complete all the requests waiting for response with the exception """
+        with self._pending_lock:
+            pending, self._pending = self._pending, {}
+        for future in pending.values():
+            future.set_exception(exception)
+
+    def send_message_nowait(self, message: dict) -> concurrent.futures.Future:
+        """
+        Queue message to send to the server with a new request id, without waiting for the response,
+        so that many messages can be sent at once
+        :param message: message fields
+        :return: future completed with the server response (jim.Response), or with ConnectionError if connection
+            is lost; raises ValueError if message format error
+        """
+        future = concurrent.futures.Future()
+        with self._pending_lock:
+            request_id = next(self._request_ids)
+            data = jim.frame(jim.Message(**message, **{jim.MessageFields.ID: request_id}).to_bytes(self._codec))
+            if not self._connected:
+                future.set_exception(ConnectionError("Нет соединения с сервером"))
+                return future
+            self._pending[request_id] = future
+        log.debug("Постановка сообщения в очередь на отправку: %s, запрос %d", message, request_id)
+        self._writer_queue.put(data)
+        return future
+
+    def _request(self, message: dict) -> jim.Response | None:
+        """
+        Send message to the server and wait for the response
+        :param message: message fields
+        :return: server response, None if failed
+        """
         try:
-            self._writer_queue.put(jim.Message(**message).json.encode(sett.DEFAULT_ENCODING))
+            future = self.send_message_nowait(message)
         except ValueError as e:
             log.error("Ошибка формирования сообщения: %s", e)
-            return False
+            return None
         except Exception as e:
             log.critical("Непредвиденная ошибка при формировании сообщения: %s", e)
-            return False
+            return None
+
+        log.debug("Ожидание подтверждения приемки сообщения от сервера")
+        try:
+            return future.result()
+        except ConnectionError as e:
+            log.critical("Ответ сервера не получен: %s", e)
+            return None
+
+    def _send_message_to_server(self, message: dict) -> bool:
+        response = self._request(message)
+        return response is not None and self._check_response(response)
 
-        log.debug(f"Ожидание подтверждения приемки сообщения от сервера")
-        response = self._response_queue.get()
+    @staticmethod
+    def _check_response(response: jim.Response) -> bool:
+        """
+        Report server response
+        :param response: server response
+        :return: True if message has been accepted, False otherwise
+        """
         if response.response == jim.Responses.BAD_LOGIN:
             log.error("Сервер сообщил об ошибке аутентификации: %s - %s",  response.response, response.message)
             return False
         elif response.response == jim.Responses.NOT_FOUND:
             log.warning("Сервер сообщил, что адресат не в сети: %s - %s",  response.response, response.message)
             return False
+        elif response.response == jim.Responses.FORBIDDEN:
+            log.warning("Сервер сообщил, что пользователь не участник чата: %s - %s",
+                        response.response, response.message)
+            return False
+        elif response.response == jim.Responses.GONE:
+            log.warning("Адресат не в сети, сообщение будет доставлено при подключении: %s - %s",
+                        response.response, response.message)
         elif response.response != jim.Responses.OK:
             log.critical("Ошибочный код возврата сервера: %s - %s",  response.response, response.message)
             return False
@@ -214,37 +309,96 @@ class Client:
             log.debug("Сообщение подтверждено")
         return True
 
+    def _presence(self) -> dict:
+        return {jim.MessageFields.ACTION: jim.Actions.PRESENCE,
+                jim.MessageFields.USER: {
+                    jim.MessageFields.ACCOUNT_NAME: self._nickname,
+                    jim.MessageFields.STATUS: "Online"
+                },
+                jim.MessageFields.CODEC: sett.CODEC
+                }
+
     def send_presence(self) -> bool:
+        return self._send_message_to_server(self._presence())
+
+    def send_authenticate(self, password: str) -> bool:
         return self._send_message_to_server(
-                {jim.MessageFields.ACTION: jim.Actions.PRESENCE,
+                {jim.MessageFields.ACTION: jim.Actions.AUTHENTICATE,
                  jim.MessageFields.USER: {
                      jim.MessageFields.ACCOUNT_NAME: self._nickname,
-                     jim.MessageFields.STATUS: "Online"
+                     jim.MessageFields.PASSWORD: password
                  }
                 })
 
+    def login(self) -> bool:
+        """
+        Send presence; if the server requires authentication for the nickname, ask for the password,
+        authenticate and send presence again
+        :return: True if presence has been accepted
+        """
+        response = self._request(self._presence())
+        if response is None:
+            return False
+        if response.response != jim.Responses.LOGIN_REQUIRED:
+            return self._check_response(response)
+        log.info("Сервер требует аутентификации пользователя %s", self._nickname)
+        try:
+            password = getpass.getpass(f"Пароль пользователя {self._nickname}: ")
+        except (EOFError, KeyboardInterrupt):
+            return False
+        return self.send_authenticate(password) and self.send_presence()
+
+    def _chat_message(self, target_nickname: str, message_text: str) -> dict:
+        return {jim.MessageFields.ACTION: jim.Actions.MESSAGE,
+                jim.MessageFields.TO: target_nickname,
+                jim.MessageFields.FROM: self._nickname,
+                jim.MessageFields.MESSAGE: message_text
+                }
+
     def send_chat_message(self, target_nickname: str, message_text: str) -> bool:
+        return self._send_message_to_server(self._chat_message(target_nickname, message_text))
+
+    def send_chat_message_nowait(self, target_nickname: str, message_text: str) -> concurrent.futures.Future:
+        """
+        Send chat message without waiting for the server response (see send_message_nowait())
+        :return: future completed with the server response
+        """
+        return self.send_message_nowait(self._chat_message(target_nickname, message_text))
+
+    def send_join(self, room: str) -> bool:
+        return self._send_message_to_server(
+                {jim.MessageFields.ACTION: jim.Actions.JOIN,
+                 jim.MessageFields.ROOM: room
+                })
+
+    def send_leave(self, room: str) -> bool:
         return self._send_message_to_server(
-                {jim.MessageFields.ACTION: jim.Actions.MESSAGE,
-                 jim.MessageFields.TO: target_nickname,
-                 jim.MessageFields.FROM: self._nickname,
-                 jim.MessageFields.MESSAGE: message_text
+                {jim.MessageFields.ACTION: jim.Actions.LEAVE,
+                 jim.MessageFields.ROOM: room
                 })
 
     def chat(self):
         self._reader.start()
         self._processor.start()
         self._writer.start()
-        if not self.send_presence():
+        if not self.login():
             return
         try:
             while True:
-                print("Введите имя адресата/чата и сообщение через пробел: ", flush=True)
+                print("Введите имя адресата/чата и сообщение через пробел "
+                      f"или {sett.COMMAND_JOIN}/{sett.COMMAND_LEAVE} и имя чата: ", flush=True)
                 # Input chat message from keyboard and send it
                 message = input()
                 target_nickname = message.split(" ")[0]
                 message = message.removeprefix(target_nickname).strip()
-                if target_nickname is None or target_nickname == "":
+                if target_nickname in (sett.COMMAND_JOIN, sett.COMMAND_LEAVE):
+                    log.debug("Команда %s для чата %s", target_nickname, message)
+                    send_command = self.send_join if target_nickname == sett.COMMAND_JOIN else self.send_leave
+                    if not message.startswith(jim.ROOM_PREFIX):
+                        print(f"Имя чата должно начинаться с '{jim.ROOM_PREFIX}'")
+                    elif not send_command(message):
+                        return
+                elif target_nickname is None or target_nickname == "":
                     print("Имя адресата/чата не может быть пустым")
                 elif message is None or message == "":
                     print("Сообщение не может быть пустым")
@@ -266,8 +420,16 @@ class Client:
             log.critical("Завершение соединения с чат-сервером %s:%d с адреса %s:%d",
                          self._server_address if self._server_address else '(broadcast)', self._server_port,
                          *self._socket.getsockname())
-            self._socket.close()
+            # Stop the writer after the queued messages, then wake up the reader waiting for data
+            self._writer_queue.put(None)
+            if self._writer.is_alive():
+                self._writer.join(sett.CONNECTION_TIMEOUT)
             self._connected = False
+            try:
+                self._socket.shutdown(sock.SHUT_RDWR)
+            except OSError:
+                pass
+            self._socket.close()
 
 
 def main() -> bool:
@@ -1,6 +1,8 @@
 import enum
 import time
 import json
+import struct
+from collections.abc import Iterable
 
 MAX_JIM_LEN = 640                       # Max JSON instant message length
 
@@ -14,7 +16,8 @@ MESSAGE FORMATS:
     "user": {
         "account_name": "C0deMaver1ck",     # 25 characters max (chat names begin with '#' char)
         "status": "Yep, I am here!"
-    }
+    },
+    ["codec": {"json"|"binary"}]            # encoding the client wants to use after presence, default - 'json'
 }
 # проверка присутствия - запрос от сервера клиенту для проверки присутствии клиента online
 {
@@ -53,8 +56,13 @@ RESPONSE FORMATS:
 {
     "response": <код ответа>,               # 3 digits
     "time": <unix timestamp>,
+    ["id": <id запроса>,]                   # echoed request id
     [{"alert"|"error"}: <текст ответа>]     # status codes 1xx-2xx - "alert", others - "error"
+    ["codec": {"json"|"binary"}]            # in response to presence - encoding accepted by the server
 }
+Any message can contain optional request id "id": <integer> - the server puts it to the response to the message,
+so that the client can match responses to requests sent without waiting for the previous responses.
+After the server accepts the codec requested in presence, both sides send messages with that codec (see BINARY CODEC).
 """
 
 
@@ -84,6 +92,20 @@ def get_child_field_name(field_name: str) -> str:
     return field_name[field_name.rfind(MESSAGE_LEVEL_DELIMITER) + 1:]
 
 
+def typed_field_value(field_type: type, value):
+    """
+    Return field value as the field type (e.g. enum member), if the value is of that type
+    :param field_type: field type - str, int or their enum subclass
+    :param value: field value
+    :return: typed value, raises ValueError if the value is of another type, even if it can be converted
+        (e.g. '5' for int or 5 for str) - the server relies on the field types when routing messages
+    """
+    base_type = int if issubclass(field_type, int) else str
+    if not isinstance(value, base_type) or isinstance(value, bool):
+        raise ValueError(f"{value!r} is not {base_type.__name__}")
+    return field_type(value)
+
+
 def check_message(message: dict, message_fields: dict, message_type_field: str,
                   message_type=None, parent: str = None) -> bool:
     """
@@ -139,7 +161,7 @@ def check_message(message: dict, message_fields: dict, message_type_field: str,
             continue                # Don't have to do any further checking
         else:                       # Ordinary field - check value type
             try:
-                typed_value = settings[MessageSettings.TYPE](value)
+                typed_value = typed_field_value(settings[MessageSettings.TYPE], value)
             except ValueError as e:     # Wrong field value type
                 raise ValueError(f"{message_type_field} '{message_type}': "
                                  f"wrong message field '{field}' value type: '{value}'")
@@ -173,6 +195,122 @@ def check_message(message: dict, message_fields: dict, message_type_field: str,
 
     return True
 
+
+_MISSING = object()                 # marks absent message field
+
+
+class MessageSchema:
+    """
+    Message fields descriptions compiled into validation plans - one plan per message type.
+    Validation results and errors are the same as with check_message(), but message fields are filtered
+    and their settings are looked up once at compile time, so a check is a straight pass over the plan.
+    """
+    def __init__(self, message_fields: dict, message_type_field: str, message_types: Iterable):
+        """
+        Compile message fields descriptions
+        :param message_fields: dict containing message fields descriptions
+        :param message_type_field: key of the message type field in message_fields
+        :param message_types: all the valid message types (values of the message type field)
+        """
+        self._message_type_field = message_type_field
+        # Plans are looked up by message type value; unknown message types get the plan compiled for no type
+        self._plans = {message_type.value: self._compile(message_fields, message_type, "")
+                       for message_type in message_types}
+        self._default_plan = self._compile(message_fields, _MISSING, "")
+
+    def check(self, message: dict) -> bool:
+        """
+        Validate message fields, the same way check_message() does
+        :param message: message presented as dict
+        :return: True if message OK, ValueError exception otherwise
+        """
+        message_type = message.get(self._message_type_field)
+        try:
+            plan = self._plans[message_type]
+        except (KeyError, TypeError):       # unknown or unhashable message type
+            plan = self._default_plan
+        for check in plan:
+            check(message, message_type)
+        return True
+
+    def _compile(self, message_fields: dict, message_type, parent: str) -> tuple:
+        """
+        Compile validation plan for the fields on the given nesting level
+        :param message_fields: dict containing message fields descriptions
+        :param message_type: message type to compile the plan for
+        :param parent: parent field(s) string with trailing delimiter, blank for top level fields
+        :return: tuple of field checks to call with message and message type
+        """
+        return tuple(self._compile_field(message_fields, message_type, field, settings)
+                     for field, settings in message_fields.items()
+                     if (field.startswith(parent) if parent else field.find(MESSAGE_LEVEL_DELIMITER) == -1))
+
+    def _compile_field(self, message_fields: dict, message_type, field: str, settings: dict):
+        """
+        Compile single field check
+        :return: function checking the field in message, raises ValueError if check failed
+        """
+        message_type_field = self._message_type_field
+        name = get_child_field_name(field)
+        for_actions = settings.get(MessageSettings.FOR_MESSAGES)
+
+        # Field can't be supplied for this message type
+        if for_actions and message_type not in for_actions:
+            def check_unexpected(message: dict, message_type):
+                if name in message:
+                    raise ValueError(f"{message_type_field} '{message_type}': unexpected message field '{field}'")
+            return check_unexpected
+
+        required = settings[MessageSettings.REQUIRED]
+        field_type = settings[MessageSettings.TYPE]
+
+        # Nested structure field - compile nested fields plan
+        if field_type == dict:
+            plan = self._compile(message_fields, message_type, field + MESSAGE_LEVEL_DELIMITER)
+
+            def check_dict(message: dict, message_type):
+                value = message.get(name, _MISSING)
+                if value is _MISSING:
+                    if required:
+                        raise ValueError(f"{message_type_field} '{message_type}': "
+                                         f"required message field '{field}' does not exist")
+                    return
+                if type(value) != dict:
+                    raise ValueError(f"{message_type_field} '{message_type}': "
+                                     f"message field '{field}' should be of type 'dict'")
+                for check in plan:
+                    check(value, message_type)
+            return check_dict
+
+        # Ordinary field
+        values = settings.get(MessageSettings.VALUES)
+        max_length = settings.get(MessageSettings.MAX_LENGTH)
+        starts_with = settings.get(MessageSettings.STARTS_WITH)
+
+        def check_value(message: dict, message_type):
+            value = message.get(name, _MISSING)
+            if value is _MISSING:
+                if required:
+                    raise ValueError(f"{message_type_field} '{message_type}': "
+                                     f"required message field '{field}' does not exist")
+                return
+            try:
+                typed_value = typed_field_value(field_type, value)
+            except ValueError as e:     # Wrong field value type
+                raise ValueError(f"{message_type_field} '{message_type}': "
+                                 f"wrong message field '{field}' value type: '{value}'")
+            if values is not None and typed_value not in values:
+                raise ValueError(f"{message_type_field} '{message_type}': "
+                                 f"wrong message field '{field}' value: '{typed_value}'")
+            if max_length is not None and len(typed_value) > max_length:
+                raise ValueError(f"{message_type_field} '{message_type}': "
+                                 f"message field '{field}' value exceeds {max_length} characters: '{typed_value}'")
+            if starts_with is not None and not str(typed_value).startswith(starts_with):
+                raise ValueError(f"{message_type_field} '{message_type}': "
+                                 f"message field '{field}' value should start with '{starts_with}', "
+                                 f"got: '{typed_value}'")
+        return check_value
+
 # ************* CHECKING END *********************
 
 
@@ -190,6 +328,7 @@ class Actions(str, enum.Enum):
     AUTHENTICATE = "authenticate"
     JOIN = "join"
     LEAVE = "leave"
+    HISTORY = "history"
 
 
 class MessageFields(str, enum.Enum):
@@ -213,11 +352,23 @@ class MessageFields(str, enum.Enum):
     ENCODING = "encoding"
     MESSAGE = "message"
     ROOM = "room"
+    ID = "id"
+    CODEC = "codec"
+    TOKEN = "token"
+    PEER = "peer"
+    BEFORE = "before"
+    LIMIT = "limit"
+    HISTORY = "history"
 
 
 ACCOUNT_NAME_MAX_LENGTH = 25
 MESSAGE_FIELD_MAX_LENGTH = 500
 OTHER_FIELDS_MAX_LENGTH = 25
+TOKEN_MAX_LENGTH = 64
+
+CODEC_JSON = "json"
+CODEC_BINARY = "binary"
+CODECS = (CODEC_JSON, CODEC_BINARY)
 
 ROOM_PREFIX = "#"
 BROADCAST_MESSAGE_ADDRESS = ROOM_PREFIX + "all"     # broadcast TO address to send messages to all users
@@ -279,6 +430,40 @@ MESSAGE_FIELDS = {
                              MessageSettings.MAX_LENGTH: ACCOUNT_NAME_MAX_LENGTH,
                              MessageSettings.STARTS_WITH: ROOM_PREFIX
                              },
+    MessageFields.ID:       {MessageSettings.TYPE: int,
+                             MessageSettings.REQUIRED: False,
+                             },
+    MessageFields.CODEC:    {MessageSettings.TYPE: str,
+                             MessageSettings.REQUIRED: False,
+                             MessageSettings.FOR_MESSAGES: (Actions.PRESENCE,),
+                             MessageSettings.VALUES: CODECS
+                             },
+    # session token issued in response to authenticate - presence with it resumes the authenticated session
+    MessageFields.TOKEN:    {MessageSettings.TYPE: str,
+                             MessageSettings.REQUIRED: False,
+                             MessageSettings.FOR_MESSAGES: (Actions.PRESENCE,),
+                             MessageSettings.MAX_LENGTH: TOKEN_MAX_LENGTH
+                             },
+    # user nickname or chat room the conversation history is requested with
+    MessageFields.PEER:     {MessageSettings.TYPE: str,
+                             MessageSettings.REQUIRED: True,
+                             MessageSettings.FOR_MESSAGES: (Actions.HISTORY,),
+                             MessageSettings.MAX_LENGTH: ACCOUNT_NAME_MAX_LENGTH
+                             },
+    # history cursor: only the messages before it are requested (see ResponseFields.BEFORE), latest if missing
+    MessageFields.BEFORE:   {MessageSettings.TYPE: int,
+                             MessageSettings.REQUIRED: False,
+                             MessageSettings.FOR_MESSAGES: (Actions.HISTORY,),
+                             },
+    MessageFields.LIMIT:    {MessageSettings.TYPE: int,
+                             MessageSettings.REQUIRED: False,
+                             MessageSettings.FOR_MESSAGES: (Actions.HISTORY,),
+                             },
+    # id of the history request the message is sent from the history in response to
+    MessageFields.HISTORY:  {MessageSettings.TYPE: int,
+                             MessageSettings.REQUIRED: False,
+                             MessageSettings.FOR_MESSAGES: (Actions.MESSAGE,),
+                             },
     }
 
 # ************* MESSAGE DEFINITIONS END *********************
@@ -294,6 +479,10 @@ class ResponseFields(str, enum.Enum):
     TIME = "time"
     ALERT = "alert"
     ERROR = "error"
+    ID = "id"
+    CODEC = "codec"
+    TOKEN = "token"
+    BEFORE = "before"
 
 
 class Responses(enum.IntEnum):
@@ -316,30 +505,36 @@ class Responses(enum.IntEnum):
     SERVER_ERROR = 500          # ошибка сервера
 
     @property
-    def response(self):
-        messages = {
-            self.NOTIFY_BASIC: {ResponseFields.ALERT: "Базовое уведомление"},
-            self.NOTIFY_IMPORTANT: {ResponseFields.ALERT: "Важное уведомление"},
-            self.OK: {ResponseFields.ALERT: "OK"},
-            self.CREATED: {ResponseFields.ALERT: "Объект создан"},
-            self.ACCEPTED: {ResponseFields.ALERT: "Подтверждение"},
-            self.BAD_REQUEST: {ResponseFields.ERROR: "Неправильный запрос / JSON - объект"},
-            self.LOGIN_REQUIRED: {ResponseFields.ERROR: "Не авторизован"},
-            self.BAD_LOGIN: {ResponseFields.ERROR: "Неправильный логин / пароль"},
-            self.FORBIDDEN: {ResponseFields.ERROR: "Пользователь заблокирован"},
-            self.NOT_FOUND: {ResponseFields.ERROR: "Пользователь / чат отсутствует на сервере"},
-            self.CONFLICT: {ResponseFields.ERROR: "Уже имеется подключение с указанным логином"},
-            self.GONE: {ResponseFields.ERROR: "Адресат существует, но недоступен (offline)"},
-            self.SERVER_ERROR: {ResponseFields.ERROR: "Ошибка сервера"}
-        }
+    def texts(self) -> dict:
+        """ Standard alert or error text fields of the response """
+        return _RESPONSE_TEXTS.get(self.value, {ResponseFields.ERROR: "Неизвестный код ответа"})
 
+    @property
+    def response(self):
         message = {
             ResponseFields.RESPONSE: self.value,
         }
-        message.update(messages.get(self.value, {ResponseFields.ERROR: "Неизвестный код ответа"}))
+        message.update(self.texts)
         return message
 
 
+_RESPONSE_TEXTS = {
+    Responses.NOTIFY_BASIC: {ResponseFields.ALERT: "Базовое уведомление"},
+    Responses.NOTIFY_IMPORTANT: {ResponseFields.ALERT: "Важное уведомление"},
+    Responses.OK: {ResponseFields.ALERT: "OK"},
+    Responses.CREATED: {ResponseFields.ALERT: "Объект создан"},
+    Responses.ACCEPTED: {ResponseFields.ALERT: "Подтверждение"},
+    Responses.BAD_REQUEST: {ResponseFields.ERROR: "Неправильный запрос / JSON - объект"},
+    Responses.LOGIN_REQUIRED: {ResponseFields.ERROR: "Не авторизован"},
+    Responses.BAD_LOGIN: {ResponseFields.ERROR: "Неправильный логин / пароль"},
+    Responses.FORBIDDEN: {ResponseFields.ERROR: "Пользователь заблокирован"},
+    Responses.NOT_FOUND: {ResponseFields.ERROR: "Пользователь / чат отсутствует на сервере"},
+    Responses.CONFLICT: {ResponseFields.ERROR: "Уже имеется подключение с указанным логином"},
+    Responses.GONE: {ResponseFields.ERROR: "Адресат существует, но недоступен (offline)"},
+    Responses.SERVER_ERROR: {ResponseFields.ERROR: "Ошибка сервера"}
+}
+
+
 RESPONSE_FIELDS = {
     ResponseFields.RESPONSE:    {MessageSettings.TYPE: Responses,
                                  MessageSettings.REQUIRED: True,
@@ -368,21 +563,57 @@ RESPONSE_FIELDS = {
                                                                 Responses.SERVER_ERROR),
                                  MessageSettings.MAX_LENGTH: MESSAGE_FIELD_MAX_LENGTH
                                  },
+    ResponseFields.ID:          {MessageSettings.TYPE: int,
+                                 MessageSettings.REQUIRED: False,
+                                 },
+    ResponseFields.CODEC:       {MessageSettings.TYPE: str,
+                                 MessageSettings.REQUIRED: False,
+                                 MessageSettings.VALUES: CODECS
+                                 },
+    ResponseFields.TOKEN:       {MessageSettings.TYPE: str,
+                                 MessageSettings.REQUIRED: False,
+                                 MessageSettings.FOR_MESSAGES: (Responses.OK,),
+                                 MessageSettings.MAX_LENGTH: TOKEN_MAX_LENGTH
+                                 },
+    # history cursor to request the previous messages with, missing if there are none
+    ResponseFields.BEFORE:      {MessageSettings.TYPE: int,
+                                 MessageSettings.REQUIRED: False,
+                                 MessageSettings.FOR_MESSAGES: (Responses.OK,),
+                                 },
     }
 
 # ************* RESPONSE MESSAGE DEFINITIONS END *********************
 
+MESSAGE_SCHEMA = MessageSchema(MESSAGE_FIELDS, MessageFields.ACTION, Actions)
+# Fields the server needs to route a chat message - a relayed message is checked against them only,
+#  its body is left to be validated by the recipients
+ROUTING_FIELDS = (MessageFields.ACTION, MessageFields.TO, MessageFields.FROM, MessageFields.ID)
+ROUTING_SCHEMA = MessageSchema({field: MESSAGE_FIELDS[field] for field in ROUTING_FIELDS},
+                               MessageFields.ACTION, Actions)
+RESPONSE_SCHEMA = MessageSchema(RESPONSE_FIELDS, ResponseFields.RESPONSE, Responses)
+
 
 class Message:
     """
-    Message class
+    Message class.
+    The message keeps the fields it has been created from and is not supposed to be changed afterwards,
+    so its encodings are cached on first use.
     """
+    __slots__ = ('action', 'time', 'kwargs', '_json', '_binary')
+
     def __init__(self, **kwargs):
         # Check message format, raises ValueError if error
-        check_message(kwargs, MESSAGE_FIELDS, MessageFields.ACTION)
+        MESSAGE_SCHEMA.check(kwargs)
+        self._set_fields(kwargs)
+
+    def _set_fields(self, kwargs: dict):
+        """ Take action and time out of the validated fields dict and keep the dict with the other fields """
         self.action = kwargs.pop(MessageFields.ACTION)
-        self.time = kwargs.pop(MessageFields.TIME, time.time_ns())
+        time_ns = kwargs.pop(MessageFields.TIME, None)
+        self.time = time.time_ns() if time_ns is None else time_ns
         self.kwargs = kwargs
+        self._json = None
+        self._binary = None
 
     @classmethod
     def from_str(cls, json_str: str):
@@ -396,27 +627,81 @@ class Message:
         message = json.loads(json_str)
         return cls(**message)
 
+    @classmethod
+    def from_bytes(cls, payload: bytes, relay: bool = False):
+        """
+        Class object constructor from encoded message of any codec (see detect_codec()).
+        The decoded fields dict is kept by the message as is, without copying.
+        :param payload: encoded message (frame payload)
+        :param relay: (optional) check only the routing fields of a chat message (see ROUTING_FIELDS) -
+            for messages forwarded as received
+        :return: Message object if OK, raises ValueError in case of message format error
+        """
+        kwargs = decode(payload)
+        if relay and kwargs.get(MessageFields.ACTION) == Actions.MESSAGE:
+            ROUTING_SCHEMA.check(kwargs)
+        else:
+            MESSAGE_SCHEMA.check(kwargs)
+        message = cls.__new__(cls)
+        message._set_fields(kwargs)
+        return message
+
+    # chat message sender nickname
+    @property
+    def sender(self) -> str | None:
+        return self.kwargs.get(MessageFields.FROM)
+
+    # chat message recipient nickname or chat room
+    @property
+    def target(self) -> str | None:
+        return self.kwargs.get(MessageFields.TO)
+
+    # chat message text
+    @property
+    def text(self) -> str | None:
+        return self.kwargs.get(MessageFields.MESSAGE)
+
     # return JSON string with the message
     @property
     def json(self) -> str:
-        message = {
-            MessageFields.ACTION: self.action,
-            MessageFields.TIME: self.time
-        }
-        message.update(**self.kwargs)
-        return json.dumps(message)
+        if self._json is None:
+            self._json = json.dumps({MessageFields.ACTION: self.action, MessageFields.TIME: self.time, **self.kwargs})
+        return self._json
+
+    def to_bytes(self, codec: str = CODEC_JSON) -> bytes:
+        """
+        Encode message with the given codec
+        :param codec: CODEC_JSON or CODEC_BINARY
+        :return: encoded message
+        """
+        if codec == CODEC_BINARY:
+            if self._binary is None:
+                self._binary = encode_binary({MessageFields.ACTION: self.action, MessageFields.TIME: self.time,
+                                              **self.kwargs})
+            return self._binary
+        return self.json.encode("ascii")
 
 
 class Response:
     """
-    Response class
+    Response class.
+    The response keeps the fields it has been created from and is not supposed to be changed afterwards,
+    so its JSON string is cached on first use.
     """
+    __slots__ = ('response', 'time', 'kwargs', '_json')
+
     def __init__(self, **kwargs):
         # Check response format, raises ValueError if error
-        check_message(kwargs, RESPONSE_FIELDS, ResponseFields.RESPONSE)
+        RESPONSE_SCHEMA.check(kwargs)
+        self._set_fields(kwargs)
+
+    def _set_fields(self, kwargs: dict):
+        """ Take response code and time out of the validated fields dict and keep the dict with the other fields """
         self.response = kwargs.pop(ResponseFields.RESPONSE)
-        self.time = kwargs.pop(ResponseFields.TIME, time.time_ns())
+        time_ns = kwargs.pop(ResponseFields.TIME, None)
+        self.time = time.time_ns() if time_ns is None else time_ns
         self.kwargs = kwargs
+        self._json = None
 
     # class object constructor from JSON string
     @classmethod
@@ -426,17 +711,393 @@ class Response:
         response = json.loads(json_str)
         return cls(**response)
 
+    @classmethod
+    def from_bytes(cls, payload: bytes):
+        """
+        Class object constructor from encoded response of any codec (see detect_codec()).
+        The decoded fields dict is kept by the response as is, without copying.
+        :param payload: encoded response (frame payload)
+        :return: Response object if OK, raises ValueError in case of response format error
+        """
+        kwargs = decode(payload)
+        RESPONSE_SCHEMA.check(kwargs)
+        response = cls.__new__(cls)
+        response._set_fields(kwargs)
+        return response
+
     # return JSON string with the response
     @property
     def json(self) -> str:
-        response = {
-            ResponseFields.RESPONSE: self.response,
-            ResponseFields.TIME: self.time
-        }
-        response.update(**self.kwargs)
-        return json.dumps(response)
+        if self._json is None:
+            self._json = json.dumps({ResponseFields.RESPONSE: self.response, ResponseFields.TIME: self.time,
+                                     **self.kwargs})
+        return self._json
+
+    # return response encoded as bytes with the given codec
+    def to_bytes(self, codec: str = CODEC_JSON) -> bytes:
+        return RESPONSE_ENCODER.encode(self.response, self.time, self.kwargs, codec)
 
     # return response message
     @property
     def message(self) -> str:
         return self.kwargs.get(ResponseFields.ALERT, self.kwargs.get(ResponseFields.ERROR, ""))
+
+
+class ResponseEncoder:
+    """
+    Encoder of responses keeping pre-encoded templates of the standard responses (see Responses.response),
+    so that only the timestamp is encoded for each of them.
+    Encoded responses are the same as Response.to_bytes() gives for the codec.
+    """
+    def __init__(self):
+        # Response code -> (standard text fields, encoded part before time value, encoded part after time value)
+        self._templates = {}
+        # Response code -> (binary encoded part before time field, binary encoded part after time field)
+        self._binary_templates = {}
+        for code in Responses:
+            texts = code.texts
+            # Same layout as json.dumps() with default separators gives for Response.json
+            prefix = json.dumps({ResponseFields.RESPONSE: code.value})[:-1] + f', "{ResponseFields.TIME.value}": '
+            suffix = ", " + json.dumps(texts)[1:] if texts else "}"
+            self._templates[code.value] = (texts, prefix.encode("ascii"), suffix.encode("ascii"))
+            self._binary_templates[code.value] = (encode_binary({ResponseFields.RESPONSE: code.value}),
+                                                  encode_binary(texts)[len(BINARY_MARKER):])
+        self._id_separator = f', "{ResponseFields.ID.value}": '.encode("ascii")
+        self._binary_time_field = _encode_binary_field_name(ResponseFields.TIME) + _BINARY_INT64_TYPE
+        self._binary_id_field = _encode_binary_field_name(ResponseFields.ID)
+
+    def encode(self, code: int, time_ns: int = None, kwargs: dict = None, codec: str = CODEC_JSON) -> bytes:
+        """
+        Encode response
+        :param code: response code
+        :param time_ns: (optional) response time, current time if not specified
+        :param kwargs: (optional) response fields other than code and time, standard fields for the code if not specified
+        :param codec: (optional) CODEC_JSON or CODEC_BINARY
+        :return: encoded response
+        """
+        template = self._templates.get(code)
+        time_ns = time.time_ns() if time_ns is None else time_ns
+        if template is not None and (kwargs is None or kwargs == template[0]):
+            if codec == CODEC_BINARY:
+                prefix, suffix = self._binary_templates[code]
+                return b"".join((prefix, self._binary_time_field, _BINARY_INT64.pack(time_ns), suffix))
+            return b"".join((template[1], str(time_ns).encode("ascii"), template[2]))
+        response = {ResponseFields.RESPONSE: code, ResponseFields.TIME: time_ns}
+        response.update(kwargs or {})
+        if codec == CODEC_BINARY:
+            return encode_binary(response)
+        return json.dumps(response).encode("ascii")
+
+    def encode_frame(self, code: int, time_ns: int = None, request_id: int = None, codec: str = CODEC_JSON,
+                     fields: dict = None) -> bytes:
+        """
+        Encode standard response with the given code as frame ready to be sent (see frame())
+        :param code: response code
+        :param time_ns: (optional) response time, current time if not specified
+        :param request_id: (optional) id of the request to respond to, placed after the time value
+        :param codec: (optional) CODEC_JSON or CODEC_BINARY
+        :param fields: (optional) additional response fields placed after the standard ones - such responses
+            are encoded without template
+        :return: framed response
+        """
+        if fields:
+            kwargs = {} if request_id is None else {ResponseFields.ID: request_id}
+            kwargs.update(self._templates[code][0])
+            kwargs.update(fields)
+            return frame(self.encode(code, time_ns, kwargs, codec))
+        time_ns = time.time_ns() if time_ns is None else time_ns
+        if codec == CODEC_BINARY:
+            prefix, suffix = self._binary_templates[code]
+            time_bytes = self._binary_time_field + _BINARY_INT64.pack(time_ns)
+            if request_id is not None:
+                time_bytes += self._binary_id_field + _encode_binary_value(request_id)
+        else:
+            _, prefix, suffix = self._templates[code]
+            time_bytes = str(time_ns).encode("ascii")
+            if request_id is not None:
+                time_bytes += b'%s%d' % (self._id_separator, request_id)
+        return b"".join((FRAME_HEADER.pack(len(prefix) + len(time_bytes) + len(suffix)), prefix, time_bytes, suffix))
+
+
+# ************* FRAMING START *********************
+
+FRAME_HEADER = struct.Struct("!H")      # Frame header - payload length in bytes, network byte order
+MAX_FRAME_LEN = MAX_JIM_LEN             # Max frame payload length in bytes (JSON is encoded as ASCII)
+
+
+def frame(payload: bytes, max_length: int = MAX_FRAME_LEN) -> bytes:
+    """
+    Prefix encoded message with its length to send it over a stream connection
+    :param payload: encoded message
+    :param max_length: (optional) max payload length, up to the header's capacity
+    :return: framed message, raises ValueError if message is too long
+    """
+    if len(payload) > max_length:
+        raise ValueError(f"Maximum JIM frame length of {max_length} bytes exceeded: {len(payload)}")
+    return FRAME_HEADER.pack(len(payload)) + payload
+
+
+class FrameDecoder:
+    """
+    Incremental decoder of length-prefixed frames received over a stream connection - one per connection.
+    A message can be split among several received chunks, and a chunk can contain several messages,
+    so only an incomplete frame at the end of a chunk is kept in a buffer until the rest of it is received.
+    """
+    __slots__ = ('_buffer', '_max_length')
+
+    def __init__(self, max_length: int = MAX_FRAME_LEN):
+        """
+        :param max_length: (optional) max payload length, up to the header's capacity
+        """
+        self._buffer = bytearray()
+        self._max_length = max_length
+
+    def __len__(self) -> int:
+        """ Return number of buffered bytes not yet extracted as frames """
+        return len(self._buffer)
+
+    def feed(self, data: bytes) -> list:
+        """
+        Extract all the complete frames from the received data
+        :param data: data received from connection
+        :return: list of complete frame payloads (may be empty), raises ValueError if frame length is invalid
+        """
+        return [bytes(frame[FRAME_HEADER.size:]) for frame in self.feed_frames(data)]
+
+    def feed_frames(self, data: bytes) -> list:
+        """
+        Extract all the complete frames from the received data without copying them:
+        frames are read-only views of the data, so they can be forwarded as received.
+        Only a frame split among received chunks is copied to be joined with the rest of it.
+        :param data: data received from connection - immutable (bytes), as frames reference it
+        :return: list of complete frames with their headers (memoryview, may be empty),
+            raises ValueError if frame length is invalid
+        """
+        buffer = self._buffer
+        if buffer:
+            buffer += data
+            data = bytes(buffer)
+            buffer.clear()
+        view = memoryview(data).toreadonly()
+        frames = []
+        offset = 0
+        while len(data) - offset >= FRAME_HEADER.size:
+            length, = FRAME_HEADER.unpack_from(data, offset)
+            if length > self._max_length:
+                # Stream is out of sync - nothing else can be decoded
+                raise ValueError(f"Maximum JIM frame length of {self._max_length} bytes exceeded: {length}")
+            end = offset + FRAME_HEADER.size + length
+            if end > len(data):
+                break               # incomplete frame - wait for more data
+            frames.append(view[offset:end])
+            offset = end
+        if offset < len(data):
+            buffer += view[offset:]
+        return frames
+
+# ************* FRAMING END *********************
+
+
+# ************* BINARY CODEC START *********************
+"""
+Compact binary encoding of messages and responses, an alternative to JSON negotiated in presence (MessageFields.CODEC).
+Binary payload starts with BINARY_MARKER (JSON payload always starts with '{'), followed by fields:
+field name index in BINARY_FIELDS (1 byte) or BINARY_UNKNOWN_FIELD followed by the name as string,
+then value type (1 byte) and value:
+    int         - 2 bytes if it fits, 8 bytes otherwise, network byte order
+    str         - length in bytes (2 bytes) and UTF-8 bytes
+    action      - index in BINARY_ACTIONS (1 byte), for the action field
+    dict        - number of fields (1 byte) and the fields
+    list        - number of items (2 bytes) and the values
+    float, true, false, null
+"""
+
+BINARY_MARKER = b"\x01"
+BINARY_UNKNOWN_FIELD = 0xFF
+# Field names are encoded as indexes in this table, so new fields should only be appended to it
+BINARY_FIELDS = (MessageFields.ACTION, MessageFields.TIME, MessageFields.TYPE, MessageFields.USER,
+                 MessageFields.ACCOUNT_NAME, MessageFields.PASSWORD, MessageFields.STATUS, MessageFields.TO,
+                 MessageFields.FROM, MessageFields.ENCODING, MessageFields.MESSAGE, MessageFields.ROOM,
+                 MessageFields.ID, MessageFields.CODEC,
+                 ResponseFields.RESPONSE, ResponseFields.ALERT, ResponseFields.ERROR, MessageFields.TOKEN,
+                 MessageFields.PEER, MessageFields.BEFORE, MessageFields.LIMIT, MessageFields.HISTORY)
+# Actions are encoded as indexes in this table, so new actions should only be appended to it
+BINARY_ACTIONS = (Actions.PRESENCE, Actions.PROBE, Actions.MESSAGE, Actions.QUIT, Actions.AUTHENTICATE,
+                  Actions.JOIN, Actions.LEAVE, Actions.HISTORY)
+
+_BINARY_FIELD_INDEXES = {field.value: bytes((index,)) for index, field in enumerate(BINARY_FIELDS)}
+_BINARY_FIELD_NAMES = tuple(field.value for field in BINARY_FIELDS)
+_BINARY_ACTION_INDEXES = {action.value: bytes((index,)) for index, action in enumerate(BINARY_ACTIONS)}
+_BINARY_ACTION_NAMES = tuple(action.value for action in BINARY_ACTIONS)
+
+# Value types
+_BINARY_INT16_TYPE = b"h"
+_BINARY_INT64_TYPE = b"q"
+_BINARY_STR_TYPE = b"s"
+_BINARY_ACTION_TYPE = b"a"
+_BINARY_DICT_TYPE = b"d"
+_BINARY_LIST_TYPE = b"l"
+_BINARY_FLOAT_TYPE = b"f"
+_BINARY_TRUE_TYPE = b"t"
+_BINARY_FALSE_TYPE = b"F"
+_BINARY_NULL_TYPE = b"n"
+
+_BINARY_INT16 = struct.Struct("!h")
+_BINARY_INT64 = struct.Struct("!q")
+_BINARY_LENGTH = struct.Struct("!H")
+_BINARY_FLOAT = struct.Struct("!d")
+
+
+def detect_codec(payload: bytes) -> str:
+    """ Return codec of the encoded message or response """
+    return CODEC_BINARY if payload[:1] == BINARY_MARKER else CODEC_JSON
+
+
+def decode(payload: bytes) -> dict:
+    """
+    Decode message or response encoded with any codec
+    :param payload: encoded message (frame payload)
+    :return: message or response presented as dict (not validated), raises ValueError in case of format error
+    """
+    if payload[:1] == BINARY_MARKER:
+        return decode_binary(payload)
+    if len(payload) > MAX_JIM_LEN:
+        raise ValueError(f"Maximum JIM message length of {MAX_JIM_LEN} characters exceeded: {len(payload)}")
+    message = json.loads(payload)
+    if not isinstance(message, dict):
+        raise ValueError("JIM message should be a JSON object")
+    return message
+
+
+def _encode_binary_str(value: str) -> bytes:
+    value_bytes = value.encode("utf-8")
+    return _BINARY_LENGTH.pack(len(value_bytes)) + value_bytes
+
+
+def _encode_binary_field_name(name: str) -> bytes:
+    index = _BINARY_FIELD_INDEXES.get(name)
+    return index if index is not None else bytes((BINARY_UNKNOWN_FIELD,)) + _encode_binary_str(name)
+
+
+def _encode_binary_value(value) -> bytes:
+    # bool is checked before int, as it is its subclass
+    if value is True:
+        return _BINARY_TRUE_TYPE
+    if value is False:
+        return _BINARY_FALSE_TYPE
+    if isinstance(value, str):
+        return _BINARY_STR_TYPE + _encode_binary_str(value)
+    if isinstance(value, int):
+        if -0x8000 <= value < 0x8000:
+            return _BINARY_INT16_TYPE + _BINARY_INT16.pack(value)
+        return _BINARY_INT64_TYPE + _BINARY_INT64.pack(value)
+    if isinstance(value, dict):
+        if len(value) > 0xFF:
+            raise ValueError(f"Binary JIM codec: too many nested fields: {len(value)}")
+        return _BINARY_DICT_TYPE + bytes((len(value),)) + _encode_binary_fields(value)
+    if isinstance(value, (list, tuple)):
+        return _BINARY_LIST_TYPE + _BINARY_LENGTH.pack(len(value)) + b"".join(map(_encode_binary_value, value))
+    if isinstance(value, float):
+        return _BINARY_FLOAT_TYPE + _BINARY_FLOAT.pack(value)
+    if value is None:
+        return _BINARY_NULL_TYPE
+    raise ValueError(f"Binary JIM codec: unsupported value type: {type(value).__name__}")
+
+
+def _encode_binary_fields(fields: dict) -> bytes:
+    parts = []
+    for name, value in fields.items():
+        parts.append(_encode_binary_field_name(name))
+        action = _BINARY_ACTION_INDEXES.get(value) if name == MessageFields.ACTION else None
+        parts.append(_BINARY_ACTION_TYPE + action if action is not None else _encode_binary_value(value))
+    return b"".join(parts)
+
+
+def encode_binary(message: dict) -> bytes:
+    """
+    Encode message or response fields with the binary codec
+    :param message: message or response presented as dict
+    :return: encoded message, raises ValueError if a value can't be encoded
+    """
+    try:
+        return BINARY_MARKER + _encode_binary_fields(message)
+    except struct.error as e:           # too long strings, too big ints
+        raise ValueError(f"Binary JIM codec: value can't be encoded: {e}")
+
+
+def _decode_binary_str(data: bytes, offset: int) -> tuple:
+    """ Decode string at the offset, return the string and the offset after it """
+    length, = _BINARY_LENGTH.unpack_from(data, offset)
+    end = offset + 2 + length
+    if end > len(data):
+        raise ValueError("Binary JIM codec: string exceeds message length")
+    return data[offset + 2:end].decode("utf-8"), end
+
+
+def _decode_binary_value(data: bytes, offset: int) -> tuple:
+    """ Decode value at the offset, return the value and the offset after it """
+    value_type = data[offset:offset + 1]
+    offset += 1
+    if value_type == _BINARY_STR_TYPE:
+        return _decode_binary_str(data, offset)
+    if value_type == _BINARY_INT16_TYPE:
+        return _BINARY_INT16.unpack_from(data, offset)[0], offset + 2
+    if value_type == _BINARY_INT64_TYPE:
+        return _BINARY_INT64.unpack_from(data, offset)[0], offset + 8
+    if value_type == _BINARY_ACTION_TYPE:
+        return _BINARY_ACTION_NAMES[data[offset]], offset + 1
+    if value_type == _BINARY_DICT_TYPE:
+        return _decode_binary_fields(data, offset + 1, data[offset])
+    if value_type == _BINARY_LIST_TYPE:
+        count, = _BINARY_LENGTH.unpack_from(data, offset)
+        offset += 2
+        values = []
+        for _ in range(count):
+            value, offset = _decode_binary_value(data, offset)
+            values.append(value)
+        return values, offset
+    if value_type == _BINARY_FLOAT_TYPE:
+        return _BINARY_FLOAT.unpack_from(data, offset)[0], offset + 8
+    if value_type == _BINARY_TRUE_TYPE:
+        return True, offset
+    if value_type == _BINARY_FALSE_TYPE:
+        return False, offset
+    if value_type == _BINARY_NULL_TYPE:
+        return None, offset
+    raise ValueError(f"Binary JIM codec: unknown value type: {value_type}")
+
+
+def _decode_binary_fields(data: bytes, offset: int, count: int = None) -> tuple:
+    """ Decode count fields at the offset or all the fields up to the end, return the fields dict and the offset """
+    fields = {}
+    end = len(data)
+    while offset < end if count is None else len(fields) < count:
+        index = data[offset]
+        if index == BINARY_UNKNOWN_FIELD:
+            name, offset = _decode_binary_str(data, offset + 1)
+        else:
+            name = _BINARY_FIELD_NAMES[index]
+            offset += 1
+        fields[name], offset = _decode_binary_value(data, offset)
+    return fields, offset
+
+
+def decode_binary(payload: bytes) -> dict:
+    """
+    Decode message or response encoded with the binary codec
+    :param payload: encoded message
+    :return: message or response presented as dict, raises ValueError in case of format error
+    """
+    if payload[:1] != BINARY_MARKER:
+        raise ValueError("Binary JIM codec: not a binary message")
+    try:
+        message, offset = _decode_binary_fields(payload, len(BINARY_MARKER))
+    except (IndexError, struct.error) as e:
+        raise ValueError(f"Binary JIM codec: message truncated or invalid: {e}")
+    if offset != len(payload):
+        raise ValueError("Binary JIM codec: unexpected data after the last field")
+    return message
+
+# ************* BINARY CODEC END *********************
+
+RESPONSE_ENCODER = ResponseEncoder()
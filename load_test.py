@@ -0,0 +1,274 @@
+"""
+Load test of the chat server: opens a number of simulated clients, logs them in with PRESENCE
+and sends direct and broadcast messages at the given total rate, then reports throughput, response (ack) latency,
+connect rate and server memory usage.
+Run against a local server (python server_select.py -max_connections N) or let the test start it (-spawn).
+"""
+import os
+import sys
+import json
+import time
+import random
+import asyncio
+import resource
+import argparse
+import subprocess
+from collections import Counter, deque
+
+import jim
+
+import server_settings as sett
+
+NICKNAME_PREFIX = "load_"
+MESSAGE_TEXT_LENGTH = 32
+CONNECT_CONCURRENCY = 4             # connections being established at once - within the server's listen backlog
+SERVER_START_TIMEOUT = 5.0          # seconds to wait for the spawned server to start listening
+PERCENTILES = (50, 99, 99.9)
+
+
+class LoadClient:
+    """
+    Simulated chat client - sends pre-encoded messages on schedule and collects responses and forwarded messages
+    """
+    def __init__(self, number: int, clients: int, broadcast_share: float):
+        """
+        :param number: client number
+        :param clients: total number of clients - direct messages are sent to the next client
+        :param broadcast_share: share of messages sent to all users
+        Attributes:
+        _pending - scheduled send times of the messages waiting for the server's response
+        latencies - response latencies in seconds
+        responses - response counts by response code
+        received - number of messages forwarded to the client
+        """
+        self.nickname = f"{NICKNAME_PREFIX}{number}"
+        self._presence = self._encode(action=jim.Actions.PRESENCE, user={
+            jim.MessageFields.ACCOUNT_NAME: self.nickname, jim.MessageFields.STATUS: "load test"})
+        self._direct = self._encode(**{jim.MessageFields.ACTION: jim.Actions.MESSAGE,
+                                       jim.MessageFields.TO: f"{NICKNAME_PREFIX}{(number + 1) % clients}",
+                                       jim.MessageFields.FROM: self.nickname,
+                                       jim.MessageFields.MESSAGE: "x" * MESSAGE_TEXT_LENGTH})
+        self._broadcast = self._encode(**{jim.MessageFields.ACTION: jim.Actions.MESSAGE,
+                                          jim.MessageFields.TO: jim.BROADCAST_MESSAGE_ADDRESS,
+                                          jim.MessageFields.FROM: self.nickname,
+                                          jim.MessageFields.MESSAGE: "x" * MESSAGE_TEXT_LENGTH})
+        self._broadcast_share = broadcast_share
+        self._reader = None
+        self._writer = None
+        self._decoder = jim.FrameDecoder()
+        self._logged_in = None
+        self._pending = deque()
+        self.latencies = []
+        self.responses = Counter()
+        self.received = 0
+        self.sent = 0
+
+    @staticmethod
+    def _encode(**message) -> bytes:
+        return jim.frame(jim.Message(**message).json.encode(sett.DEFAULT_ENCODING))
+
+    async def connect(self, address: str, port: int) -> int:
+        """
+        Connect to the server and log in
+        :return: PRESENCE response code, raises OSError if connection failed
+        """
+        self._reader, self._writer = await asyncio.open_connection(address, port)
+        self._logged_in = asyncio.get_running_loop().create_future()
+        asyncio.create_task(self._receive())
+        self._writer.write(self._presence)
+        return await self._logged_in
+
+    async def _receive(self):
+        """ Receive and count responses and forwarded messages until the connection is closed """
+        try:
+            while data := await self._reader.read(sett.RECEIVE_BUFFER_SIZE):
+                now = time.perf_counter()
+                for payload in self._decoder.feed(data):
+                    code = json.loads(payload).get(jim.ResponseFields.RESPONSE)
+                    if code is None:            # message forwarded from another client
+                        self.received += 1
+                        continue
+                    if not self._logged_in.done():
+                        self._logged_in.set_result(code)
+                        continue
+                    self.responses[code] += 1
+                    if self._pending:
+                        self.latencies.append(now - self._pending.popleft())
+        except (OSError, ValueError):
+            pass
+        if not self._logged_in.done():
+            self._logged_in.set_exception(ConnectionResetError("connection closed by server"))
+
+    async def run(self, interval: float, until: float):
+        """
+        Send messages every interval seconds until the given time.
+        Latency is counted from the scheduled send time, so a server falling behind is not hidden
+        by the clients slowing down.
+        :param interval: seconds between messages
+        :param until: perf_counter() time to stop sending
+        """
+        scheduled = time.perf_counter() + random.uniform(0, interval)
+        while scheduled < until:
+            delay = scheduled - time.perf_counter()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            self._pending.append(scheduled)
+            self._writer.write(self._broadcast if random.random() < self._broadcast_share else self._direct)
+            self.sent += 1
+            scheduled += interval
+
+    def close(self):
+        if self._writer:
+            self._writer.close()
+
+
+def raise_file_limit(required: int):
+    """ Raise open files limit up to the hard limit if needed """
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft != resource.RLIM_INFINITY and soft < required:
+        resource.setrlimit(resource.RLIMIT_NOFILE,
+                           (required if hard == resource.RLIM_INFINITY else min(required, hard), hard))
+
+
+def process_rss(pid: int) -> int | None:
+    """
+    Return resident memory size of the process and its child processes (worker processes) in bytes,
+    None if not available (no /proc file system)
+    """
+    try:
+        processes = {pid}
+        for entry in os.listdir("/proc"):
+            if entry.isdigit():
+                try:
+                    with open(f"/proc/{entry}/stat") as stat:
+                        # Parent pid follows the process name in parentheses and the process state
+                        if int(stat.read().rsplit(")", 1)[1].split()[1]) == pid:
+                            processes.add(int(entry))
+                except (OSError, IndexError, ValueError):
+                    pass
+        rss = 0
+        for process in processes:
+            with open(f"/proc/{process}/statm") as statm:
+                rss += int(statm.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+        return rss
+    except OSError:
+        return None
+
+
+def percentile(values: list, percent: float) -> float:
+    """ Return percentile of the sorted values """
+    return values[min(len(values) - 1, int(len(values) * percent / 100))]
+
+
+def format_rss(rss: int | None) -> str:
+    return "н/д" if rss is None else f"{rss / 2 ** 20:.1f} МБ"
+
+
+async def wait_for_server(address: str, port: int, timeout: float) -> bool:
+    """ Wait until the server accepts connections """
+    deadline = time.perf_counter() + timeout
+    while time.perf_counter() < deadline:
+        try:
+            _, writer = await asyncio.open_connection(address, port)
+            writer.close()
+            return True
+        except OSError:
+            await asyncio.sleep(0.1)
+    return False
+
+
+async def load_test(args, server_pid: int | None):
+    clients = [LoadClient(number, args.clients, args.broadcast) for number in range(args.clients)]
+    if server_pid is not None and not await wait_for_server(args.address, args.port, SERVER_START_TIMEOUT):
+        print("Сервер не принимает соединения")
+        return
+    rss_start = process_rss(server_pid) if server_pid else None
+
+    # Connect and log in
+    semaphore = asyncio.Semaphore(args.connect_concurrency)
+
+    async def connect(client: LoadClient):
+        async with semaphore:
+            return await client.connect(args.address, args.port)
+
+    start = time.perf_counter()
+    results = await asyncio.gather(*(connect(client) for client in clients), return_exceptions=True)
+    connect_time = time.perf_counter() - start
+    connected = [client for client, result in zip(clients, results) if result == jim.Responses.OK]
+    refused = Counter(type(result).__name__ if isinstance(result, BaseException) else result
+                      for result in results if result != jim.Responses.OK)
+    print(f"Клиентов подключено: {len(connected)} из {len(clients)} за {connect_time:.2f} с "
+          f"({len(connected) / connect_time:.0f} соединений/с)")
+    if refused:
+        print(f"Отказы в подключении: {dict(refused)}")
+    if not connected:
+        return
+    rss_connected = process_rss(server_pid) if server_pid else None
+
+    # Send messages
+    interval = len(connected) / args.rate
+    start = time.perf_counter()
+    await asyncio.gather(*(client.run(interval, start + args.duration) for client in connected))
+    await asyncio.sleep(args.drain)            # wait for responses to the last messages
+    elapsed = time.perf_counter() - start
+    rss_end = process_rss(server_pid) if server_pid else None
+    for client in clients:
+        client.close()
+
+    # Report
+    sent = sum(client.sent for client in connected)
+    responses = sum((client.responses for client in connected), Counter())
+    received = sum(client.received for client in connected)
+    latencies = sorted(latency for client in connected for latency in client.latencies)
+    print(f"Сообщений отправлено: {sent} за {args.duration:.1f} с ({sent / args.duration:.0f} сообщений/с)")
+    print(f"Ответов получено: {sum(responses.values())} ({sum(responses.values()) / elapsed:.0f} ответов/с), "
+          f"коды ответов: {dict(responses)}")
+    print(f"Сообщений доставлено клиентам: {received} ({received / elapsed:.0f} сообщений/с)")
+    if latencies:
+        print("Время ответа, мс: " + ", ".join(f"p{percent:g} {percentile(latencies, percent) * 1000:.2f}"
+                                               for percent in PERCENTILES) + f", max {latencies[-1] * 1000:.2f}")
+    if server_pid:
+        print(f"Память сервера (RSS): при старте {format_rss(rss_start)}, после подключения {format_rss(rss_connected)}, "
+              f"в конце {format_rss(rss_end)}")
+
+
+def main() -> bool:
+    # Parse command-line arguments
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-address', default="127.0.0.1")
+    parser.add_argument('-port', type=int, default=sett.DEFAULT_PORT)
+    parser.add_argument('-clients', type=int, default=1000, help="number of simulated clients")
+    parser.add_argument('-rate', type=float, default=5000, help="total messages per second")
+    parser.add_argument('-broadcast', type=float, default=0.0, help="share of messages to all users, 0..1")
+    parser.add_argument('-connect_concurrency', type=int, default=CONNECT_CONCURRENCY,
+                        help="connections being established at once (keep within the server's listen backlog)")
+    parser.add_argument('-duration', type=float, default=10.0, help="seconds to send messages")
+    parser.add_argument('-drain', type=float, default=1.0, help="seconds to wait for responses after sending")
+    parser.add_argument('-spawn', action='store_true', help="start server_select.py for the test")
+    parser.add_argument('-server_pid', type=int, help="pid of the running server to report memory usage of")
+    parser.add_argument('server_args', nargs=argparse.REMAINDER,
+                        help="arguments of the spawned server, e.g. -- -workers 4")
+    args = parser.parse_args()
+    raise_file_limit(args.clients * (3 if args.spawn else 1) + 256)
+
+    server = None
+    if args.spawn:
+        server_args = [arg for arg in args.server_args if arg != "--"]
+        server = subprocess.Popen([sys.executable, "server_select.py", "-address", args.address,
+                                   "-port", str(args.port), "-max_connections", str(args.clients), *server_args],
+                                  cwd=os.path.dirname(os.path.abspath(__file__)),
+                                  stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        asyncio.run(load_test(args, server.pid if server else args.server_pid))
+    except KeyboardInterrupt:
+        print("Тест прерван")
+        return False
+    finally:
+        if server:
+            server.terminate()
+            server.wait()
+    return True
+
+
+if __name__ == "__main__":
+    exit(0 if main() else -1)
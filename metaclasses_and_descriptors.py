@@ -3,13 +3,18 @@ import dis
 from collections.abc import Iterator, Iterable
 from dis import Instruction
 
+# Opcodes loading a method to call: since Python 3.11 methods may also be loaded with LOAD_ATTR
+LOAD_METHOD_OPNAMES = ('LOAD_METHOD', 'LOAD_ATTR')
+# Opcodes calling a loaded method: CALL_METHOD before Python 3.11, CALL since
+CALL_METHOD_OPNAMES = ('CALL_METHOD', 'CALL')
+
 
 def exist_method_calls(instructions: Iterator[Instruction], methods: Iterable) -> bool:
     try:
         # ищем загрузку переданных методов
         while True:
             instruction = next(instructions)
-            if instruction.opname == 'LOAD_METHOD' and instruction.argval in methods:
+            if instruction.opname in LOAD_METHOD_OPNAMES and instruction.argval in methods:
                 return True
     except StopIteration as e:
         pass
@@ -21,11 +26,11 @@ def get_method_attributes(instructions: Iterator[Instruction], method: str) -> [
         # ищем загрузку метода
         while True:
             instruction = next(instructions)
-            if instruction.opname == 'LOAD_METHOD' and instruction.argval == method:
+            if instruction.opname in LOAD_METHOD_OPNAMES and instruction.argval == method:
                 break
         # сохраняем атрибуты, пока не произойдет вызов метода
         attributes = []
-        while instruction.opname != "CALL_METHOD":
+        while instruction.opname not in CALL_METHOD_OPNAMES:
             instruction = next(instructions)
             if instruction.opname == 'LOAD_ATTR':
                 attributes.append(instruction.argval)
@@ -39,7 +44,8 @@ def get_method_attributes(instructions: Iterator[Instruction], method: str) -> [
 class ChatClassVerifier(type):
 
     def __init__(self, clsname, bases, clsdict, forbidden_methods=None):
-        uses_tcp_sockets = False        # пока не нашли использование сокетов для работы по TCP
+        # использование сокетов для работы по TCP уже проверено у базовых классов, созданных этим метаклассом
+        uses_tcp_sockets = any(isinstance(base, ChatClassVerifier) for base in bases)
         for key, value in clsdict.items():
             if hasattr(value, "__code__"):
 
@@ -49,30 +49,35 @@ class Server:
             connected = True
             connection.settimeout(sett.CLIENT_CONNECTION_TIMEOUT)
             log.info("Клиент %s:%d: Входящее соединение установлено", *address)
+            decoder = jim.FrameDecoder()
             while True:                 # Loop through incoming messages
-                data = connection.recv(jim.MAX_JIM_LEN).decode(sett.DEFAULT_ENCODING)
-                if not data:
+                data_bytes = connection.recv(sett.RECEIVE_BUFFER_SIZE)
+                if not data_bytes:
                     log.info("Клиент %s:%d: Соединение закрыто клиентом", *address)
                     break
-                try:
-                    message = jim.Message.from_str(data)
-                except ValueError as e:
-                    log.error("Клиент %s:%d: Получены некорректные данные: %s", *address, data)
-                    response = jim.Response(**jim.Responses.BAD_REQUEST.response).json
-                else:
-                    log.debug("Клиент %s:%d: Получено сообщение: %s", *address, message.json)
-                    if message.action == jim.Actions.PRESENCE:
-                        log.debug("Клиент %s:%d: Формирование ответа на сообщение присутствия", *address)
-                        response = jim.Response(**jim.Responses.OK.response).json
+                for frame in decoder.feed(data_bytes):
+                    data = frame.decode(sett.DEFAULT_ENCODING)
+                    request_id = None
+                    try:
+                        message = jim.Message.from_str(data)
+                    except ValueError as e:
+                        log.error("Клиент %s:%d: Получены некорректные данные: %s", *address, data)
+                        response = jim.Responses.BAD_REQUEST
                     else:
-                        log.error("Клиент %s:%d: Неподдерживаемый тип сообщения, формирование ответа", *address)
-                        response = jim.Response(**jim.Responses.BAD_REQUEST.response).json
-                log.debug("Клиент %s:%d: Отправка ответа: %s", *address, response)
-                connection.send(response.encode(sett.DEFAULT_ENCODING))
+                        log.debug("Клиент %s:%d: Получено сообщение: %s", *address, message.json)
+                        request_id = message.kwargs.get(jim.MessageFields.ID)
+                        if message.action == jim.Actions.PRESENCE:
+                            log.debug("Клиент %s:%d: Формирование ответа на сообщение присутствия", *address)
+                            response = jim.Responses.OK
+                        else:
+                            log.error("Клиент %s:%d: Неподдерживаемый тип сообщения, формирование ответа", *address)
+                            response = jim.Responses.BAD_REQUEST
+                    log.debug("Клиент %s:%d: Отправка ответа: %d", *address, response)
+                    connection.sendall(jim.RESPONSE_ENCODER.encode_frame(response, request_id=request_id))
         except TimeoutError:
             log.info("Клиент %s:%d: Соединение закрыто по таймауту", *address)
-        except ValueError as e:             # Can happen when creating response
-            log.critical("Клиент %s:%d: Непредвиденная ошибка данных: %s", e)
+        except ValueError as e:             # Can happen when creating response or decoding data stream
+            log.critical("Клиент %s:%d: Непредвиденная ошибка данных: %s", *address, e)
         finally:
             if connected:
                 log.debug("Клиент %s:%d: Завершение соединения на стороне сервера", *address)
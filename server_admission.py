@@ -0,0 +1,115 @@
+"""
+Admission of client connections. The server accepts pending connections in batches (ACCEPT_BUDGET per listening
+socket readiness event at most) and decides for every one whether to admit it or to reject it right away with
+an error response encoded beforehand. Connections are rejected when:
+
+- MAX_CONNECTIONS is reached;
+- they arrive faster than ACCEPT_RATE per second (token bucket, ACCEPT_BURST connections at once);
+- the event loop lags behind by more than ADMISSION_LAG_THRESHOLD (overload shedding) - new connections
+  would only add to the load and keep the connections being serviced waiting longer.
+
+Rejecting costs an accept, a send of the ready frame and a close, so that a reconnect storm does not take
+the event loop from the connections already admitted.
+"""
+import time
+import logging
+
+import jim
+
+import server_settings as sett
+
+log = logging.getLogger(sett.LOG_NAME)
+
+REJECT_MAX_CONNECTIONS = "max_connections"
+REJECT_RATE = "rate"
+REJECT_OVERLOAD = "overload"
+REJECT_REASONS = (REJECT_MAX_CONNECTIONS, REJECT_RATE, REJECT_OVERLOAD)
+REJECT_FRAME_REFRESH = 1.0          # seconds to re-encode the reject frame after, so that its time stays current
+
+
+class TokenBucket:
+    """
+    Rate limiter: tokens are added at the given rate up to the bucket size, every event takes one
+    """
+    __slots__ = ('_rate', '_burst', '_tokens', '_updated')
+
+    def __init__(self, rate: float, burst: int, now: float):
+        """
+        :param rate: events per second allowed on average
+        :param burst: events allowed at once (bucket size)
+        :param now: current time, seconds (any monotonic clock, the same for all the calls)
+        """
+        self._rate = rate
+        self._burst = burst
+        self._tokens = float(burst)
+        self._updated = now
+
+    def take(self, now: float) -> bool:
+        """
+        Take a token for an event
+        :param now: current time, seconds
+        :return: True if the event is allowed, False if the rate is exceeded
+        """
+        self._tokens = min(self._tokens + (now - self._updated) * self._rate, self._burst)
+        self._updated = now
+        if self._tokens < 1:
+            return False
+        self._tokens -= 1
+        return True
+
+
+class AdmissionController:
+    """
+    Decides whether to admit new client connections
+    """
+    def __init__(self, max_connections: int, rate: float, burst: int, lag_threshold: float):
+        """
+        :param max_connections: maximum number of client connections
+        :param rate: connections to admit per second at most; 0 - no limit
+        :param burst: connections to admit at once at most with the rate limited
+        :param lag_threshold: event loop lag to reject connections at, seconds; 0 - never
+        Attributes:
+        lag - current event loop lag, seconds (set by the server)
+        rejected - number of connections rejected since the last one admitted
+        _bucket - accept rate limiter, None if no limit
+        _reject_frame - framed SERVER_ERROR response sent to the rejected connections, its time (time.monotonic())
+        """
+        self._max_connections = max_connections
+        self._lag_threshold = lag_threshold
+        self._bucket = TokenBucket(rate, burst, time.perf_counter()) if rate else None
+        self._reject_frame = (jim.RESPONSE_ENCODER.encode_frame(jim.Responses.SERVER_ERROR), time.monotonic())
+        self.lag = 0.0
+        self.rejected = 0
+
+    def admit(self, connections: int, now: float) -> str | None:
+        """
+        Decide whether to admit a new connection
+        :param connections: number of client connections open
+        :param now: current time (time.perf_counter())
+        :return: None if admitted, reason of rejection (one of REJECT_REASONS) otherwise
+        """
+        if connections >= self._max_connections:
+            reason = REJECT_MAX_CONNECTIONS
+        elif self._lag_threshold and self.lag > self._lag_threshold:
+            reason = REJECT_OVERLOAD
+        elif self._bucket is not None and not self._bucket.take(now):
+            reason = REJECT_RATE
+        else:
+            if self.rejected:
+                log.warning("Прием входящих соединений возобновлен, отклонено соединений: %d", self.rejected)
+                self.rejected = 0
+            return None
+        if not self.rejected:
+            log.warning("Входящие соединения отклоняются (%s): соединений %d из %d, задержка цикла событий %.3f с",
+                        reason, connections, self._max_connections, self.lag)
+        self.rejected += 1
+        return reason
+
+    def reject_frame(self) -> bytes:
+        """ Return framed SERVER_ERROR response for the rejected connections """
+        frame, encoded = self._reject_frame
+        now = time.monotonic()
+        if now - encoded >= REJECT_FRAME_REFRESH:
+            frame = jim.RESPONSE_ENCODER.encode_frame(jim.Responses.SERVER_ERROR)
+            self._reject_frame = (frame, now)
+        return frame
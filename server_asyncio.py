@@ -0,0 +1,192 @@
+import asyncio
+import concurrent.futures
+from dataclasses import dataclass
+
+import jim
+
+import server_settings as sett
+from server_select import Server, Connection, CLIENT_CONNECTION_CLASS, log
+
+DELIVERY_RETRY_DELAY = 0.01     # seconds to wait for the transport buffer to drain to deliver more stored messages
+
+
+@dataclass(eq=False, slots=True)
+class AsyncConnection(Connection):
+    """
+    Client connection serviced by asyncio event loop - the connection attribute holds the asyncio transport,
+    which buffers outgoing data itself
+    """
+
+    def fileno(self):
+        """ Return file descriptor of the transport's socket """
+        return self.connection.get_extra_info('socket').fileno()
+
+
+class ChatProtocol(asyncio.Protocol):
+    """
+    Chat client connection protocol - passes connection events and received data to the server
+    """
+    def __init__(self, server: 'AsyncServer'):
+        self._server = server
+        self._connection = None
+
+    def connection_made(self, transport: asyncio.Transport):
+        self._connection = self._server._accept_transport(transport)
+
+    def data_received(self, data: bytes):
+        if self._connection and not self._server._process_data(self._connection, data):
+            self._connection.connection.close()
+
+    def resume_writing(self):
+        if self._connection:
+            self._server._resume_senders(self._connection)
+
+    def connection_lost(self, exc: Exception | None):
+        if self._connection:
+            if exc:
+                log.info("Клиент %s:%d: Соединение закрыто: %s", *self._connection.address, exc)
+            else:
+                log.info("Клиент %s:%d: Соединение закрыто", *self._connection.address)
+            self._server._close_connection(self._connection)
+            self._connection = None
+
+
+class AsyncServer(Server):
+    """
+    Chat server class servicing connections in asyncio event loop.
+    Message processing and routing are the same as for the select() based server.
+    Output is buffered by the transports, which are given the server's output watermarks.
+    As the transport buffer can't be trimmed, OUTPUT_DROP_OLDEST policy drops the data being sent instead.
+    """
+    def _accept_transport(self, transport: asyncio.Transport) -> AsyncConnection | None:
+        """
+        Register a new connection in the _connections dictionary if admitted,
+        otherwise send it the error response and close it
+        :param transport: asyncio transport of the new connection
+        :return: new connection, None if rejected
+        """
+        address = transport.get_extra_info('peername')
+        if not self._admit_connection(address):
+            transport.write(self._admission.reject_frame())
+            transport.close()
+            return None
+        transport.set_write_buffer_limits(high=sett.OUTPUT_HIGH_WATERMARK, low=sett.OUTPUT_LOW_WATERMARK)
+        connection = AsyncConnection(
+            connection=transport,
+            address=address,
+            nickname="",
+            decoder=jim.FrameDecoder(),
+            policy=sett.OUTPUT_POLICIES[CLIENT_CONNECTION_CLASS]
+        )
+        self._connections[transport] = connection
+        self._start_heartbeat(connection)
+        return connection
+
+    def _close_connection(self, connection: AsyncConnection):
+        """ Close client connection's transport and forget it """
+        if self._connections.pop(connection.connection, None):
+            connection.closing = True
+            self._forget_connection(connection)
+            connection.connection.close()
+
+    def _send(self, connection: AsyncConnection, data: bytes, sender: Connection = None):
+        """
+        Write framed data to the connection's transport - never blocks.
+        If the transport buffer is above the high watermark, the connection's output policy is applied.
+        """
+        transport = connection.connection
+        if transport.is_closing():
+            return
+        if transport.get_write_buffer_size() > sett.OUTPUT_HIGH_WATERMARK:
+            self._apply_output_policy(connection, sender)
+            if connection.policy == sett.OUTPUT_DROP_OLDEST:
+                self._metrics.bytes_dropped += len(data)
+                return
+            if connection.closing:
+                return
+        transport.write(data)
+        self._metrics.bytes_sent += len(data)
+
+    def _drop_output(self, connection: AsyncConnection) -> int:
+        """ Drop nothing - the transport buffer can't be trimmed, so _send drops the data being sent instead """
+        return 0
+
+    def _disconnect(self, connection: AsyncConnection):
+        """ Close the slow connection's transport discarding its buffer; the protocol then forgets the connection """
+        connection.closing = True
+        connection.connection.abort()
+
+    def _start_delivery(self, connection: AsyncConnection):
+        """ Start delivering stored messages to the connection - a batch every event loop pass """
+        super()._start_delivery(connection)
+        asyncio.get_running_loop().call_soon(self._deliver_next_batch, connection)
+
+    def _deliver_next_batch(self, connection: AsyncConnection):
+        """ Deliver a batch of stored messages to the connection once its transport buffer drains """
+        if self._deliveries.get(connection.nickname) is not connection:
+            return
+        loop = asyncio.get_running_loop()
+        if connection.connection.get_write_buffer_size() > sett.OUTPUT_LOW_WATERMARK:
+            loop.call_later(DELIVERY_RETRY_DELAY, self._deliver_next_batch, connection)
+            return
+        self._deliver_batch(connection)
+        if connection.nickname in self._deliveries:
+            loop.call_soon(self._deliver_next_batch, connection)
+
+    def _pause_reading(self, connection: AsyncConnection):
+        connection.paused += 1
+        if connection.paused == 1:
+            connection.connection.pause_reading()
+
+    def _resume_reading(self, connection: AsyncConnection):
+        connection.paused -= 1
+        if not connection.paused and not connection.closing:
+            connection.connection.resume_reading()
+
+    def _when_done(self, future: concurrent.futures.Future, callback):
+        loop = asyncio.get_running_loop()
+
+        def done(completed_future: concurrent.futures.Future):
+            try:
+                loop.call_soon_threadsafe(callback, completed_future)
+            except RuntimeError:            # the loop has been closed - shutting down
+                pass
+        future.add_done_callback(done)
+
+    def _measure_lag(self, expected: float):
+        """ Measure the event loop lag every ADMISSION_LAG_INTERVAL - how late the call is """
+        loop = asyncio.get_running_loop()
+        now = loop.time()
+        self._admission.lag = max(now - expected, 0.0)
+        expected = now + sett.ADMISSION_LAG_INTERVAL
+        loop.call_at(expected, self._measure_lag, expected)
+
+    def _tick_heartbeats(self):
+        """ Check the heartbeat timers expired every HEARTBEAT_TICK """
+        self._check_heartbeats()
+        asyncio.get_running_loop().call_later(sett.HEARTBEAT_TICK, self._tick_heartbeats)
+
+    async def _serve(self):
+        """ Accept connections on the listening socket and process client messages until cancelled """
+        loop = asyncio.get_running_loop()
+        if self._heartbeats is not None:
+            loop.call_later(sett.HEARTBEAT_TICK, self._tick_heartbeats)
+        if sett.ADMISSION_LAG_THRESHOLD:
+            self._measure_lag(loop.time())
+        # asyncio accepts up to the backlog connections per listening socket readiness event
+        server = await loop.create_server(lambda: ChatProtocol(self), sock=self._socket, backlog=sett.LISTEN_BACKLOG)
+        async with server:
+            try:
+                await server.serve_forever()
+            finally:
+                # Close the client transports while the loop is running - shutdown() is called once it is closed
+                for connection in list(self._connections.values()):
+                    self._close_connection(connection)
+                await asyncio.sleep(0)
+
+    def service_connections(self):
+        """ Accept connections and process client messages """
+        if not self._listening:
+            log.critical("Обработка соединений невозможна - не инициализирован порт для входящих подключений")
+            return
+        asyncio.run(self._serve())
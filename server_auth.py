@@ -0,0 +1,337 @@
+"""
+Chat users authentication: credentials store with salted slow password hashes (scrypt, or PBKDF2 where scrypt
+is not available), verified in a thread pool so that the server's event loop never waits for hashing,
+and a bounded cache of session tokens, so that reconnecting clients resume their sessions without hashing.
+The credentials file is re-read in the thread pool as well, the event loop only looks the users up in memory.
+
+Users are added to the credentials store (sett.DATA_USERS in the server data directory) with:
+
+    python server_auth.py -data DIRECTORY adduser NICKNAME
+    python server_auth.py -data DIRECTORY deluser NICKNAME
+
+The running server picks up the changes within AUTH_RELOAD_INTERVAL.
+"""
+import os
+import sys
+import hmac
+import json
+import time
+import getpass
+import secrets
+import hashlib
+import logging
+import argparse
+import threading
+import concurrent.futures
+from collections import OrderedDict
+
+import server_settings as sett
+
+log = logging.getLogger(sett.LOG_NAME)
+
+HASH_SCRYPT = "scrypt"
+HASH_PBKDF2 = "pbkdf2_sha256"
+SCRYPT_N = 2 ** 14                  # scrypt cost parameters (16 MB of memory per hash)
+SCRYPT_R = 8
+SCRYPT_P = 1
+SCRYPT_MAXMEM = 64 * 2 ** 20
+PBKDF2_ITERATIONS = 600000
+SALT_SIZE = 16                      # bytes
+TOKEN_SIZE = 24                     # random bytes of a session token (32 characters encoded)
+RECORD_SEPARATOR = "$"
+
+
+def hash_password(password: str, algorithm: str = None) -> str:
+    """
+    Hash password with a new random salt
+    :param password: password
+    :param algorithm: (optional) HASH_SCRYPT or HASH_PBKDF2, sett.AUTH_HASH if not specified
+    :return: credentials record: algorithm, its parameters, salt and hash separated with RECORD_SEPARATOR
+    """
+    algorithm = algorithm or sett.AUTH_HASH
+    if algorithm == HASH_SCRYPT and not hasattr(hashlib, "scrypt"):      # OpenSSL without scrypt
+        algorithm = HASH_PBKDF2
+    salt = os.urandom(SALT_SIZE)
+    if algorithm == HASH_SCRYPT:
+        parameters = (SCRYPT_N, SCRYPT_R, SCRYPT_P)
+    elif algorithm == HASH_PBKDF2:
+        parameters = (PBKDF2_ITERATIONS,)
+    else:
+        raise ValueError(f"Unknown password hash algorithm: {algorithm}")
+    digest = _hash(algorithm, parameters, password, salt)
+    return RECORD_SEPARATOR.join((algorithm, *map(str, parameters), salt.hex(), digest.hex()))
+
+
+def verify_password(record: str, password: str) -> bool:
+    """
+    Check password against the credentials record - slow, to be called outside of the event loop
+    :param record: credentials record (see hash_password())
+    :param password: password to check
+    :return: True if the password matches
+    """
+    try:
+        algorithm, *parameters, salt, digest = record.split(RECORD_SEPARATOR)
+        return hmac.compare_digest(_hash(algorithm, tuple(map(int, parameters)), password, bytes.fromhex(salt)),
+                                   bytes.fromhex(digest))
+    except (ValueError, TypeError) as e:
+        log.error("Некорректная запись в хранилище учетных данных: %s", e)
+        return False
+
+
+def _verify_unknown(dummy_record: str, password: str) -> bool:
+    """ Check password of an unknown user: take the same time as for a known user and fail """
+    verify_password(dummy_record, password)
+    return False
+
+
+def _hash(algorithm: str, parameters: tuple, password: str, salt: bytes) -> bytes:
+    password_bytes = password.encode(sett.DEFAULT_ENCODING)
+    if algorithm == HASH_SCRYPT:
+        n, r, p = parameters
+        return hashlib.scrypt(password_bytes, salt=salt, n=n, r=r, p=p, maxmem=SCRYPT_MAXMEM)
+    if algorithm == HASH_PBKDF2:
+        iterations, = parameters
+        return hashlib.pbkdf2_hmac("sha256", password_bytes, salt, iterations)
+    raise ValueError(f"Unknown password hash algorithm: {algorithm}")
+
+
+class CredentialStore:
+    """
+    Users' credentials records by nickname, kept in a JSON file.
+    The records are replaced as a whole on reload, so they can be looked up while another thread reloads them.
+    """
+    def __init__(self, path: str):
+        """
+        :param path: credentials file path; the file is created when the first user is added
+        Attributes:
+        _records - credentials records by nickname
+        _mtime - modification time of the file when it was loaded, None if no file
+        """
+        self._path = path
+        self._records = {}
+        self._mtime = None
+        self._reload_lock = threading.Lock()
+        self.reload()
+
+    def reload(self) -> bool:
+        """
+        Load the credentials file if it has changed since it was loaded - reads the disk, so not to be called
+        in the event loop once the server is running
+        :return: True if loaded, False if not changed or failed to load
+        """
+        with self._reload_lock:
+            return self._reload()
+
+    def _reload(self) -> bool:
+        try:
+            mtime = os.stat(self._path).st_mtime_ns
+        except FileNotFoundError:
+            mtime = None
+        except OSError as e:
+            log.error("Ошибка доступа к хранилищу учетных данных %s: %s", self._path, e)
+            return False
+        if mtime == self._mtime:
+            return False
+        try:
+            if mtime is None:
+                records = {}
+            else:
+                with open(self._path, encoding=sett.DEFAULT_ENCODING) as file:
+                    records = json.load(file)
+            if not isinstance(records, dict):
+                raise ValueError("records dictionary expected")
+        except (OSError, ValueError) as e:
+            log.error("Ошибка чтения хранилища учетных данных %s: %s", self._path, e)
+            return False
+        self._records = records
+        self._mtime = mtime
+        log.info("Хранилище учетных данных %s: пользователей %d", self._path, len(records))
+        return True
+
+    @property
+    def loaded(self) -> bool:
+        """ True if the credentials file has been loaded """
+        return self._mtime is not None
+
+    def is_registered(self, nickname: str) -> bool:
+        return nickname in self._records
+
+    def record(self, nickname: str) -> str | None:
+        """ Return credentials record of the user, None if not registered """
+        return self._records.get(nickname)
+
+    def set_password(self, nickname: str, password: str):
+        """ Register user or change their password and save the store; raises OSError if failed """
+        self._records[nickname] = hash_password(password)
+        self._save()
+
+    def remove(self, nickname: str) -> bool:
+        """ Remove user and save the store; raises OSError if failed; returns False if no such user """
+        if self._records.pop(nickname, None) is None:
+            return False
+        self._save()
+        return True
+
+    def _save(self):
+        """ Write the file anew and replace the old one, so that the server never reads it half-written """
+        temporary_path = self._path + ".tmp"
+        with open(temporary_path, "w", encoding=sett.DEFAULT_ENCODING) as file:
+            json.dump(self._records, file, ensure_ascii=False, indent=1)
+        os.chmod(temporary_path, 0o600)
+        os.replace(temporary_path, self._path)
+        self._mtime = os.stat(self._path).st_mtime_ns
+
+
+class TokenCache:
+    """
+    Session tokens issued to authenticated users - bounded, least recently used tokens are evicted first
+    """
+    def __init__(self, size: int = sett.AUTH_TOKEN_CACHE_SIZE, ttl: float = sett.AUTH_TOKEN_TTL):
+        """
+        :param size: maximum number of tokens
+        :param ttl: token lifetime since issued, seconds
+        Attributes:
+        _tokens - (nickname, expiration time) by token, least recently used first
+        """
+        self._size = size
+        self._ttl = ttl
+        self._tokens = OrderedDict()
+
+    def __len__(self):
+        return len(self._tokens)
+
+    def issue(self, nickname: str) -> str:
+        """ Issue a new session token for the user """
+        token = secrets.token_urlsafe(TOKEN_SIZE)
+        self._tokens[token] = (nickname, time.monotonic() + self._ttl)
+        if len(self._tokens) > self._size:
+            self._tokens.popitem(last=False)
+        return token
+
+    def check(self, nickname: str, token: str) -> bool:
+        """ Return True if the token has been issued to the user and has not expired """
+        entry = self._tokens.get(token)
+        if entry is None:
+            return False
+        if entry[1] < time.monotonic():
+            del self._tokens[token]
+            return False
+        if not hmac.compare_digest(entry[0].encode(sett.DEFAULT_ENCODING), nickname.encode(sett.DEFAULT_ENCODING)):
+            return False
+        self._tokens.move_to_end(token)
+        return True
+
+
+class Authenticator:
+    """
+    Users authentication for the server: password checks are run in a thread pool, their results are
+    futures to be completed in the event loop; session tokens are checked right away.
+    The credentials file is checked for changes in the thread pool before every password check and
+    every AUTH_RELOAD_INTERVAL when users are looked up, so that the users added are known without a restart.
+    """
+    def __init__(self, path: str = sett.AUTH_USERS_FILE, workers: int = sett.AUTH_WORKERS):
+        """
+        :param path: credentials file path
+        :param workers: number of threads checking passwords
+        Attributes:
+        _reload_time - time to check the credentials file for changes at (time.monotonic())
+        """
+        self._credentials = CredentialStore(path)
+        self._reload_time = time.monotonic() + sett.AUTH_RELOAD_INTERVAL
+        self._tokens = TokenCache()
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=workers, thread_name_prefix="auth")
+        # Unknown users' passwords are checked against it, so that they take the same time as known users' ones
+        self._dummy_record = hash_password(secrets.token_hex(TOKEN_SIZE))
+
+    def is_registered(self, nickname: str) -> bool:
+        """ Return True if the user is registered in the credentials store """
+        self._reload_periodically()
+        return self._credentials.is_registered(nickname)
+
+    def _reload_periodically(self):
+        """ Start checking the credentials file for changes in the thread pool if it is time to """
+        now = time.monotonic()
+        if now >= self._reload_time:
+            self._reload_time = now + sett.AUTH_RELOAD_INTERVAL
+            self._executor.submit(self._credentials.reload)
+
+    def verify(self, nickname: str, password: str) -> concurrent.futures.Future:
+        """
+        Start checking the user's password
+        :param nickname: user nickname
+        :param password: password
+        :return: future completed with True if the password is correct, False otherwise
+        """
+        return self._executor.submit(self._verify, nickname, password)
+
+    def _verify(self, nickname: str, password: str) -> bool:
+        """ Pool thread: pick up the credentials file changes and check the password """
+        self._credentials.reload()
+        record = self._credentials.record(nickname)
+        if record is None:
+            return _verify_unknown(self._dummy_record, password)
+        return verify_password(record, password)
+
+    def resume(self, nickname: str, token: str) -> bool:
+        """ Return True if the session token has been issued to the user and is still valid """
+        return self.is_registered(nickname) and self._tokens.check(nickname, token)
+
+    def issue_token(self, nickname: str) -> str:
+        """ Issue session token to the authenticated user """
+        return self._tokens.issue(nickname)
+
+    def shutdown(self):
+        """ Stop the thread pool, cancelling the checks not started yet """
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+
+def main() -> bool:
+    parser = argparse.ArgumentParser(description="Chat server users management")
+    parser.add_argument('-data', default=sett.DATA_DIRECTORY, help="server data directory (see server_select.py)")
+    parser.add_argument('-file', help=f"credentials file (default DATA/{sett.DATA_USERS})")
+    commands = parser.add_subparsers(dest='command', required=True)
+    adduser = commands.add_parser('adduser', help="add user or change their password")
+    adduser.add_argument('nickname')
+    adduser.add_argument('-password', help="password (asked for if not specified)")
+    deluser = commands.add_parser('deluser', help="remove user")
+    deluser.add_argument('nickname')
+    args = parser.parse_args()
+    if args.file is None:
+        if not args.data:
+            parser.error("the server data directory (-data) or credentials file (-file) is required")
+        try:
+            os.makedirs(args.data, exist_ok=True)
+        except OSError as e:
+            print(f"Ошибка создания каталога данных сервера: {e}", file=sys.stderr)
+            return False
+        args.file = os.path.join(args.data, sett.DATA_USERS)
+
+    store = CredentialStore(args.file)
+    if os.path.exists(args.file) and not store.loaded:
+        return False                    # the error has been logged, do not overwrite the file
+    try:
+        if args.command == 'adduser':
+            password = args.password
+            if password is None:
+                password = getpass.getpass("Пароль: ")
+                if password != getpass.getpass("Повторите пароль: "):
+                    print("Пароли не совпадают", file=sys.stderr)
+                    return False
+            if not password:
+                print("Пароль не может быть пустым", file=sys.stderr)
+                return False
+            store.set_password(args.nickname, password)
+            print(f"Пользователь {args.nickname} сохранен")
+        elif not store.remove(args.nickname):
+            print(f"Пользователь {args.nickname} не найден", file=sys.stderr)
+            return False
+        else:
+            print(f"Пользователь {args.nickname} удален")
+    except OSError as e:
+        print(f"Ошибка записи хранилища учетных данных: {e}", file=sys.stderr)
+        return False
+    return True
+
+
+if __name__ == "__main__":
+    exit(0 if main() else -1)
@@ -0,0 +1,318 @@
+"""
+Message history: every chat message routed by the server is appended to an SQLite database (WAL mode)
+by a dedicated writer thread, so that the event loop never waits for the disk.
+
+The event loop only puts messages to a bounded queue - if the writer falls that far behind, messages are
+dropped from the history (and counted) rather than kept in memory or waited for. The writer takes the messages
+off the queue in batches and commits every batch with one transaction (group commit): a batch is written once
+HISTORY_BATCH_SIZE messages are collected or HISTORY_BATCH_INTERVAL has passed since its first message.
+Messages older than HISTORY_RETENTION are deleted every HISTORY_CLEANUP_INTERVAL.
+With synchronous=NORMAL in WAL mode the committed messages survive the server process failure,
+but the last ones may be lost on the operating system one.
+
+Several processes (server workers) may write to the same database, SQLite serializes their transactions.
+
+Only the messages that can be sent back from the history are written: the writer checks that a message
+passes the full message format check (relayed messages are only checked for their routing fields) and still fits
+in a frame with the longest HISTORY field added, the others are skipped (and counted). The stored payload is
+not checked again by the queries.
+
+History queries run in a thread pool, every thread reading with its own connection (WAL readers do not wait
+for the writer). Pages are selected by keyset pagination on the time indexes - the messages before the cursor,
+so any page costs the same as the latest one. The cursor is the id of the oldest message of the previous page
+and the messages are ordered by (time, id): message times are unique within the process only, and the server
+workers writing to the same database may give their messages the same time.
+Messages become visible to queries once their batch is committed.
+"""
+import time
+import queue
+import sqlite3
+import logging
+import threading
+import concurrent.futures
+
+import jim
+
+import server_settings as sett
+
+log = logging.getLogger(sett.LOG_NAME)
+
+SCHEMA = ("CREATE TABLE IF NOT EXISTS messages (id INTEGER PRIMARY KEY, time INTEGER NOT NULL, "
+          "sender TEXT NOT NULL, target TEXT NOT NULL, payload BLOB NOT NULL)",
+          "CREATE INDEX IF NOT EXISTS messages_target_time ON messages (target, time)",
+          "CREATE INDEX IF NOT EXISTS messages_sender_time ON messages (sender, time)",
+          # for retention - expired messages are found without scanning the table
+          "CREATE INDEX IF NOT EXISTS messages_time ON messages (time)",
+          # for direct conversations - messages between two users without scanning their other messages
+          "CREATE INDEX IF NOT EXISTS messages_conversation ON messages (sender, target, time)")
+INSERT = "INSERT INTO messages (time, sender, target, payload) VALUES (?, ?, ?, ?)"
+# Expired messages are deleted in chunks, so that other processes' writes are not locked out for long
+DELETE_EXPIRED = "DELETE FROM messages WHERE id IN (SELECT id FROM messages WHERE time < ? LIMIT ?)"
+# Pages of chat room messages, of direct conversations (messages both ways, merged) and of the messages
+# users send to themselves, latest first. The indexes on (..., time) end with the id implicitly,
+# so the (time, id) keyset is looked up in them.
+SELECT_ROOM_PAGE = ("SELECT id, time, payload FROM messages WHERE target = ? AND (time, id) < (?, ?) "
+                    "ORDER BY time DESC, id DESC LIMIT ?")
+SELECT_OWN_PAGE = ("SELECT id, time, payload FROM messages WHERE sender = ? AND target = ? AND (time, id) < (?, ?) "
+                   "ORDER BY time DESC, id DESC LIMIT ?")
+SELECT_CONVERSATION_PAGE = (
+    "SELECT id, time, payload FROM (SELECT id, time, payload FROM messages "
+    "WHERE sender = ? AND target = ? AND (time, id) < (?, ?) ORDER BY time DESC, id DESC LIMIT ?) UNION ALL "
+    "SELECT id, time, payload FROM (SELECT id, time, payload FROM messages "
+    "WHERE sender = ? AND target = ? AND (time, id) < (?, ?) ORDER BY time DESC, id DESC LIMIT ?) "
+    "ORDER BY time DESC, id DESC LIMIT ?")
+SELECT_CURSOR_TIME = "SELECT time FROM messages WHERE id = ?"
+NO_CURSOR = 2 ** 63 - 1             # cursor of the latest page
+# Request ids the messages sent from the history can carry (int64 of the binary codec);
+# the longest of them is reserved room for when a message is written
+REQUEST_ID_RANGE = range(-2 ** 63, 2 ** 63)
+BUSY_TIMEOUT = 5.0                  # seconds to wait for the database locked by another process
+_STOP = None                        # queue item stopping the writer
+
+
+class History:
+    """
+    Chat messages history: writer and queries
+    """
+    def __init__(self, path: str = sett.HISTORY_DATABASE, batch_size: int = sett.HISTORY_BATCH_SIZE,
+                 batch_interval: float = sett.HISTORY_BATCH_INTERVAL, queue_size: int = sett.HISTORY_QUEUE_SIZE,
+                 retention: float = sett.HISTORY_RETENTION, query_workers: int = sett.HISTORY_QUERY_WORKERS):
+        """
+        Open the database, creating it if it does not exist, and start the writer thread;
+        raises sqlite3.Error if failed
+        :param path: database file path
+        :param batch_size: maximum number of messages committed at once
+        :param batch_interval: maximum time to collect a batch since its first message, seconds
+        :param queue_size: maximum number of messages waiting to be written
+        :param retention: time to keep messages for, seconds; 0 - forever
+        :param query_workers: number of threads running history queries
+        Attributes:
+        dropped - number of messages dropped as the queue was full
+        written - number of messages written (updated by the writer thread)
+        skipped - number of messages not written as they cannot be sent from the history (updated by the writer thread)
+        _queue - messages waiting to be written: (time, sender, target, payload)
+        _dropping - messages are being dropped (logged once until the queue has room again)
+        _last_time - time of the last message queued, the next one gets a later time
+        _readers - query threads' database connections, by thread
+        """
+        self._path = path
+        self._batch_size = batch_size
+        self._batch_interval = batch_interval
+        self._retention = retention
+        self._queue = queue.Queue(queue_size)
+        self._dropping = False
+        self._last_time = 0
+        self.dropped = 0
+        self.written = 0
+        self.skipped = 0
+        # Autocommit mode - the writer begins and commits transactions itself
+        self._database = sqlite3.connect(path, timeout=BUSY_TIMEOUT, isolation_level=None, check_same_thread=False)
+        try:
+            self._database.execute("PRAGMA journal_mode=WAL")
+            self._database.execute("PRAGMA synchronous=NORMAL")
+            for statement in SCHEMA:
+                self._database.execute(statement)
+        except sqlite3.Error:
+            self._database.close()
+            raise
+        self._thread = threading.Thread(target=self._write, name="history", daemon=True)
+        self._thread.start()
+        self._readers = {}
+        self._readers_lock = threading.Lock()
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=query_workers,
+                                                               thread_name_prefix="history_query")
+        log.info("История сообщений: %s", path)
+
+    @property
+    def queued(self) -> int:
+        """ Number of messages waiting to be written """
+        return self._queue.qsize()
+
+    def append(self, sender: str, target: str, payload: bytes) -> bool:
+        """
+        Queue chat message to be written - never waits
+        :param sender: sender nickname
+        :param target: recipient nickname or chat room
+        :param payload: message as received (frame payload)
+        :return: True if queued, False if dropped as the queue is full
+        """
+        message_time = time.time_ns()
+        if message_time <= self._last_time:
+            message_time = self._last_time + 1
+        try:
+            self._queue.put_nowait((message_time, sender, target, payload))
+        except queue.Full:
+            self.dropped += 1
+            if not self._dropping:
+                self._dropping = True
+                log.warning("Очередь записи истории сообщений переполнена, сообщения не сохраняются в истории")
+            return False
+        self._last_time = message_time
+        if self._dropping:
+            self._dropping = False
+            log.warning("Запись истории сообщений возобновлена, не сохранено сообщений всего: %d", self.dropped)
+        return True
+
+    def _write(self):
+        """ Writer thread: write the queued messages in batches, delete expired messages periodically """
+        cleanup_time = time.monotonic()
+        stop = False
+        while not stop:
+            batch, stop = self._take_batch(max(cleanup_time - time.monotonic(), 0) if self._retention else None)
+            if batch:
+                self._write_batch(batch)
+            if self._retention and time.monotonic() >= cleanup_time:
+                self._delete_expired()
+                cleanup_time = time.monotonic() + sett.HISTORY_CLEANUP_INTERVAL
+        self._database.close()
+
+    def _take_batch(self, timeout: float | None) -> tuple:
+        """
+        Wait for messages and collect a batch. The thread sleeps while the batch is being collected,
+        rather than waking up for every message queued.
+        :param timeout: maximum time to wait for the first message, seconds; None - no limit
+        :return: messages, True if the writer is to stop
+        """
+        try:
+            item = self._queue.get(timeout=timeout)
+        except queue.Empty:
+            return [], False
+        if item is _STOP:
+            return [], True
+        batch = [item]
+        deadline = time.monotonic() + self._batch_interval
+        while True:
+            try:
+                while len(batch) < self._batch_size:
+                    item = self._queue.get_nowait()
+                    if item is _STOP:
+                        return batch, True
+                    batch.append(item)
+                return batch, False
+            except queue.Empty:
+                pass
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return batch, False
+            time.sleep(remaining)
+
+    def _write_batch(self, batch: list):
+        """ Write messages with one transaction, skipping the ones that cannot be sent from the history """
+        messages = [message for message in batch if _replayable(message[3])]
+        self.skipped += len(batch) - len(messages)
+        if not messages:
+            return
+        batch = messages
+        try:
+            self._database.execute("BEGIN")
+            self._database.executemany(INSERT, batch)
+            self._database.execute("COMMIT")
+        except sqlite3.Error as e:
+            log.error("Ошибка записи истории сообщений (%d): %s", len(batch), e)
+            if self._database.in_transaction:
+                self._database.execute("ROLLBACK")
+            return
+        self.written += len(batch)
+
+    def _delete_expired(self):
+        """ Delete messages older than the retention time """
+        expired = time.time_ns() - int(self._retention * 1e9)
+        deleted = 0
+        try:
+            while True:
+                count = self._database.execute(DELETE_EXPIRED, (expired, self._batch_size)).rowcount
+                deleted += count
+                if count < self._batch_size:
+                    break
+        except sqlite3.Error as e:
+            log.error("Ошибка удаления устаревших сообщений из истории: %s", e)
+        if deleted:
+            log.info("Из истории удалено устаревших сообщений: %d", deleted)
+
+    def query(self, nickname: str, peer: str, before: int | None, limit: int, codec: str,
+              request_id: int | None) -> concurrent.futures.Future:
+        """
+        Start reading a page of the conversation history, latest messages first
+        :param nickname: nickname of the user requesting the history
+        :param peer: chat room or user nickname the conversation is with
+        :param before: cursor - id of the message to read the messages before, None for the latest page
+        :param limit: maximum number of messages
+        :param codec: codec to encode the messages with
+        :param request_id: id of the history request, set to the messages' HISTORY field, within REQUEST_ID_RANGE
+        :return: future completed with the framed messages in chronological order and the cursor of the
+            previous page (None if there are no more messages), or with sqlite3.Error.
+            The messages too long for the codec requested (JSON escapes non-ASCII characters) are encoded with
+            the codec they were received with.
+        """
+        return self._executor.submit(self._query, nickname, peer, before, limit, codec, request_id)
+
+    def _reader(self) -> sqlite3.Connection:
+        """ Return the query thread's database connection, opening it if needed """
+        thread = threading.get_ident()
+        reader = self._readers.get(thread)
+        if reader is None:
+            reader = sqlite3.connect(self._path, timeout=BUSY_TIMEOUT, check_same_thread=False)
+            reader.execute("PRAGMA query_only=ON")
+            with self._readers_lock:
+                self._readers[thread] = reader
+        return reader
+
+    def _query(self, nickname: str, peer: str, before: int | None, limit: int, codec: str,
+               request_id: int | None) -> tuple:
+        """ Query thread: read a page of the conversation history (see query()) """
+        reader = self._reader()
+        if before is None:
+            cursor = (NO_CURSOR, NO_CURSOR)
+        else:
+            row = reader.execute(SELECT_CURSOR_TIME, (before,)).fetchone()
+            if row is None:
+                # The cursor message has expired, and so have all the messages before it
+                return [], None
+            cursor = (row[0], before)
+        # One message more than requested tells if there are more messages
+        if peer.startswith(jim.ROOM_PREFIX):
+            rows = reader.execute(SELECT_ROOM_PAGE, (peer, *cursor, limit + 1)).fetchall()
+        elif peer == nickname:
+            rows = reader.execute(SELECT_OWN_PAGE, (nickname, nickname, *cursor, limit + 1)).fetchall()
+        else:
+            rows = reader.execute(SELECT_CONVERSATION_PAGE,
+                                  (nickname, peer, *cursor, limit + 1, peer, nickname, *cursor, limit + 1,
+                                   limit + 1)).fetchall()
+        previous_page = rows[limit - 1][0] if len(rows) > limit else None
+        frames = []
+        for _, _, payload in reversed(rows[:limit]):
+            # Written messages are known to be valid (see _replayable()), only their routing fields are checked.
+            # The message is not encoded yet, so the HISTORY field is added to its fields.
+            message = jim.Message.from_bytes(payload, relay=True)
+            message.kwargs[jim.MessageFields.HISTORY] = request_id or 0
+            try:
+                frames.append(jim.frame(message.to_bytes(codec)))
+            except ValueError:
+                frames.append(jim.frame(message.to_bytes(jim.detect_codec(payload))))
+        return frames, previous_page
+
+    def close(self):
+        """ Stop the query threads, write the queued messages and stop the writer thread """
+        self._executor.shutdown(wait=True, cancel_futures=True)
+        for reader in self._readers.values():
+            reader.close()
+        self._readers.clear()
+        self._queue.put(_STOP)
+        self._thread.join()
+
+
+def _replayable(payload: bytes) -> bool:
+    """
+    Check if the message can be sent from the history: it passes the full message format check
+    and still fits in a frame, with the codec it was received with, when the longest HISTORY field is added
+    :param payload: message as received (frame payload)
+    :return: True if the message can be written to the history
+    """
+    try:
+        fields = jim.decode(payload)
+        fields[jim.MessageFields.HISTORY] = REQUEST_ID_RANGE[0]
+        jim.frame(jim.Message(**fields).to_bytes(jim.detect_codec(payload)))
+    except ValueError as e:
+        log.warning("Сообщение не сохранено в истории, так как не может быть из нее отправлено: %s", e)
+        return False
+    return True
@@ -1,5 +1,7 @@
 import os
 import sys
+import queue
+import atexit
 import logging.handlers
 
 import server_settings as sett
@@ -25,3 +27,38 @@ log_handler = logging.handlers.TimedRotatingFileHandler(
     backupCount=sett.LOG_FILE_BACKUP_DAYS_COUNT)
 log_handler.setFormatter(logging.Formatter(sett.LOG_FILE_FORMAT))
 log.addHandler(log_handler)
+
+# Write log records in a separate thread, so that the file and console I/O does not block the caller:
+#  loggers only put records to the queue, the listener thread passes them to the handlers configured above
+log_listener = None
+if sett.LOG_QUEUE:
+    root_log = logging.getLogger()
+    log_handler.addFilter(logging.Filter(sett.LOG_NAME))       # the file gets app records only, as before
+    log_handlers = (*root_log.handlers, log_handler)
+    for handler in root_log.handlers[:]:
+        root_log.removeHandler(handler)
+    log.removeHandler(log_handler)
+    log_queue = queue.SimpleQueue()
+    log_queue_handler = logging.handlers.QueueHandler(log_queue)
+    root_log.addHandler(log_queue_handler)
+    log_listener = logging.handlers.QueueListener(log_queue, *log_handlers, respect_handler_level=True)
+    log_listener.start()
+    atexit.register(log_listener.stop)
+
+
+def restart_log_listener():
+    """
+    Start the log thread in a forked worker process - threads do not survive fork(),
+    and the queue state left by the parent's thread is not reliable, so a new queue is used
+    """
+    global log_queue, log_listener
+    if log_listener is not None:
+        log_queue = log_queue_handler.queue = queue.SimpleQueue()
+        log_listener = logging.handlers.QueueListener(log_queue, *log_handlers, respect_handler_level=True)
+        log_listener.start()
+
+
+def stop_log_listener():
+    """ Write the queued log records and stop the log thread - before os._exit(), which skips atexit handlers """
+    if log_listener is not None:
+        log_listener.stop()
@@ -0,0 +1,406 @@
+"""
+Offline mailbox: chat messages to known users who are offline are stored on disk and delivered
+when the user connects again.
+
+The store is log-structured:
+- messages are appended as received (framed) to segment files, a new segment is started when the current one
+  reaches MAILBOX_SEGMENT_SIZE; a segment is deleted once every recipient's next undelivered message is
+  in a later one;
+- every recipient has an index file: delivered message count (the delivery cursor) followed by
+  the messages' locations in the segments (segment number, offset, length);
+- known users (nicknames that have connected at least once) are appended to the users file as JSON strings.
+Only the known users, message counts, delivery cursors and the segment of the next undelivered message per recipient
+are kept in memory, so the store holds any number of messages, and opening it reads a couple of entries per index.
+
+The event loop never writes to the disk: the messages' locations are assigned in memory, the writes are put
+to a queue and done by a dedicated writer thread in batches - all the messages queued meanwhile, the index files
+of the recent recipients are kept open. The event loop reads the messages being delivered, waiting for
+the recipient's queued writes first (if any are left - they are done by the time the user connects as a rule).
+Writes are not synced to disk: the messages survive the server process failure, but not the operating system one.
+"""
+import os
+import json
+import queue
+import struct
+import logging
+import threading
+from collections import OrderedDict
+
+import server_settings as sett
+
+log = logging.getLogger(sett.LOG_NAME)
+
+SEGMENT_SUFFIX = ".seg"
+INDEX_SUFFIX = ".idx"
+INDEX_DIRECTORY = "index"
+USERS_FILE_NAME = "users"
+INDEX_HEADER = struct.Struct("!I")          # delivered messages count
+INDEX_ENTRY = struct.Struct("!IIH")         # segment number, offset, frame length
+# Writer queue items: (_APPEND, nickname, segment, offset, frame), (_DELIVERED, nickname, delivered count),
+# (_REMOVE, nickname), (_ADD_USER, nickname), _STOP
+_APPEND = 1
+_DELIVERED = 2
+_REMOVE = 3
+_ADD_USER = 4
+_STOP = None
+
+
+class Mailbox:
+    """
+    Offline messages store. Not safe to share between processes; to be used by one thread, writes are
+    done by the store's own writer thread.
+    """
+    def __init__(self, directory: str = sett.MAILBOX_DIRECTORY, segment_size: int = sett.MAILBOX_SEGMENT_SIZE,
+                 queue_size: int = sett.MAILBOX_QUEUE_SIZE, index_files: int = sett.MAILBOX_INDEX_FILES):
+        """
+        Open the store, creating it if it does not exist, and start the writer thread; raises OSError if failed
+        :param directory: store directory
+        :param segment_size: segment file size to start a new segment at, bytes
+        :param queue_size: maximum number of messages waiting to be written, the ones above are not stored
+        :param index_files: maximum number of index files kept open by the writer
+        Attributes:
+        _users - known users' nicknames
+        _pending - undelivered messages count by recipient nickname
+        _delivered - delivered messages count (index file cursor) by recipient nickname
+        _heads - segment number of the next undelivered message by recipient nickname
+        _segments - number of recipients whose next undelivered message is in the segment, by segment number
+        _segment_fds - segment file descriptors open for reading by segment number
+        _first_segment - number of the oldest segment not deleted
+        _segment - number of the segment being appended to
+        _segment_end - size of the segment being appended to, including the queued messages
+        _queue - writes waiting for the writer thread
+        _queued - number of writes queued ever
+        _written - number of writes done ever (updated by the writer thread)
+        _last_write - number of the recipient's last write queued (_queued at the time), by recipient nickname
+        _index_fds - index file descriptors and sizes open by the writer by nickname, least recently used first
+        """
+        self._directory = directory
+        self._segment_size = segment_size
+        self._queue_size = queue_size
+        self._index_files = index_files
+        os.makedirs(os.path.join(directory, INDEX_DIRECTORY), exist_ok=True)
+        self._users = set()
+        self._pending = {}
+        self._delivered = {}
+        self._heads = {}
+        self._segments = {}
+        self._segment_fds = {}
+        users_path = os.path.join(directory, USERS_FILE_NAME)
+        if os.path.exists(users_path):
+            with open(users_path, encoding=sett.DEFAULT_ENCODING) as users_file:
+                self._users.update(json.loads(line) for line in users_file if line.strip())
+        self._users_file = open(users_path, "a", encoding=sett.DEFAULT_ENCODING)
+        # Count undelivered messages by recipient from the index sizes, find the segments they start in
+        for file_name in os.listdir(os.path.join(directory, INDEX_DIRECTORY)):
+            if file_name.endswith(INDEX_SUFFIX):
+                nickname = bytes.fromhex(file_name[:-len(INDEX_SUFFIX)]).decode(sett.DEFAULT_ENCODING)
+                self._open_index(nickname)
+        # Delete delivered segments, append to the last one
+        segments = sorted(int(file_name[:-len(SEGMENT_SUFFIX)]) for file_name in os.listdir(directory)
+                          if file_name.endswith(SEGMENT_SUFFIX))
+        self._first_segment = segments[0] if segments else 1
+        self._segment = segments[-1] if segments else 1
+        self._segment_end = os.path.getsize(self._segment_path(self._segment)) if segments else 0
+        self._delete_segments()
+        self._queue = queue.SimpleQueue()
+        self._queued = 0
+        self._written = 0
+        self._written_condition = threading.Condition()
+        self._last_write = {}
+        self._index_fds = OrderedDict()
+        self._thread = threading.Thread(target=self._write, name="mailbox", daemon=True)
+        self._thread.start()
+        log.info("Хранилище сообщений %s: пользователей %d, недоставленных сообщений %d для %d пользователей",
+                 directory, len(self._users), sum(self._pending.values()), len(self._pending))
+
+    def _segment_path(self, segment: int) -> str:
+        return os.path.join(self._directory, f"{segment:08d}{SEGMENT_SUFFIX}")
+
+    def _index_path(self, nickname: str) -> str:
+        return os.path.join(self._directory, INDEX_DIRECTORY,
+                            nickname.encode(sett.DEFAULT_ENCODING).hex() + INDEX_SUFFIX)
+
+    def _open_index(self, nickname: str):
+        """ Load recipient's delivery cursor and next undelivered message segment from the index file """
+        path = self._index_path(nickname)
+        with open(path, "r+b") as index_file:
+            header = index_file.read(INDEX_HEADER.size)
+            entries, partial = divmod(os.fstat(index_file.fileno()).st_size - INDEX_HEADER.size, INDEX_ENTRY.size)
+            delivered, = INDEX_HEADER.unpack(header) if len(header) == INDEX_HEADER.size else (0, )
+            if entries > delivered:
+                # Drop the entry written in part, so that the next ones are appended after the whole ones
+                if partial:
+                    index_file.truncate(INDEX_HEADER.size + entries * INDEX_ENTRY.size)
+                index_file.seek(INDEX_HEADER.size + delivered * INDEX_ENTRY.size)
+                segment, _, _ = INDEX_ENTRY.unpack(index_file.read(INDEX_ENTRY.size))
+                self._pending[nickname] = entries - delivered
+                self._delivered[nickname] = delivered
+                self._heads[nickname] = segment
+                self._segments[segment] = self._segments.get(segment, 0) + 1
+                return
+        os.remove(path)
+
+    def _segment_fd(self, segment: int) -> int:
+        """ Return descriptor of the segment file open for reading, opening it if needed """
+        fd = self._segment_fds.get(segment)
+        if fd is None:
+            fd = self._segment_fds[segment] = os.open(self._segment_path(segment), os.O_RDONLY)
+        return fd
+
+    def _read_index(self, nickname: str, skip: int, limit: int) -> list:
+        """
+        Read recipient's message locations
+        :param nickname: recipient nickname
+        :param skip: number of messages to skip
+        :param limit: maximum number of locations to read
+        :return: list of (segment, offset, length)
+        """
+        with open(self._index_path(nickname), "rb") as index_file:
+            index_file.seek(INDEX_HEADER.size + skip * INDEX_ENTRY.size)
+            data = index_file.read(limit * INDEX_ENTRY.size)
+        return list(INDEX_ENTRY.iter_unpack(data[:len(data) - len(data) % INDEX_ENTRY.size]))
+
+    def _put(self, item: tuple):
+        self._queued += 1
+        self._queue.put(item)
+
+    def is_known(self, nickname: str) -> bool:
+        """ Return True if the user has connected at least once """
+        return nickname in self._users
+
+    def add_user(self, nickname: str):
+        """ Remember the user has connected, so that messages are stored for them while offline """
+        if nickname not in self._users:
+            self._put((_ADD_USER, nickname))
+            self._users.add(nickname)
+
+    def pending(self, nickname: str) -> int:
+        """ Return number of messages waiting for delivery to the user """
+        return self._pending.get(nickname, 0)
+
+    def store(self, nickname: str, frame: bytes | memoryview) -> bool:
+        """
+        Queue message to be appended to the recipient's mailbox - never waits
+        :param nickname: recipient nickname
+        :param frame: framed message
+        :return: True if stored, False if the writer is too far behind
+        """
+        if self._queued - self._written >= self._queue_size:
+            log.error("Очередь записи хранилища сообщений переполнена, сообщение для %s не сохранено", nickname)
+            return False
+        if self._segment_end >= self._segment_size:
+            self._segment += 1
+            self._segment_end = 0
+            self._delete_segments()
+        self._put((_APPEND, nickname, self._segment, self._segment_end, bytes(frame)))
+        self._last_write[nickname] = self._queued
+        self._segment_end += len(frame)
+        pending = self._pending.get(nickname, 0)
+        if not pending:
+            self._heads[nickname] = self._segment
+            self._segments[self._segment] = self._segments.get(self._segment, 0) + 1
+        self._pending[nickname] = pending + 1
+        return True
+
+    def take(self, nickname: str, limit: int) -> list:
+        """
+        Read the next messages to deliver to the user, in the order they were stored, and mark them delivered
+        :param nickname: recipient nickname
+        :param limit: maximum number of messages to read
+        :return: framed messages, empty list if none or failed to read
+        """
+        pending = self._pending.get(nickname)
+        if not pending:
+            return []
+        self._wait_written(self._last_write.get(nickname, 0))
+        delivered = self._delivered.get(nickname, 0)
+        try:
+            # One location more than requested tells the segment of the next undelivered message
+            locations = self._read_index(nickname, delivered, min(limit, pending) + 1)
+            frames = [os.pread(self._segment_fd(segment), length, offset)
+                      for segment, offset, length in locations[:limit]]
+        except OSError as e:
+            log.error("Ошибка чтения сообщений для %s из хранилища: %s", nickname, e)
+            return []
+        if len(locations) < min(limit + 1, pending):
+            log.error("Хранилище сообщений: не найдено сообщений для %s: %d",
+                      nickname, pending - len(locations))
+            pending = len(locations)
+        head = self._heads[nickname]
+        self._segments[head] -= 1
+        if not self._segments[head]:
+            del self._segments[head]
+        if pending > len(frames):
+            self._pending[nickname] = pending - len(frames)
+            self._delivered[nickname] = delivered + len(frames)
+            self._heads[nickname] = head = locations[len(frames)][0]
+            self._segments[head] = self._segments.get(head, 0) + 1
+            self._put((_DELIVERED, nickname, delivered + len(frames)))
+        else:
+            for messages in (self._pending, self._delivered, self._heads, self._last_write):
+                messages.pop(nickname, None)
+            self._put((_REMOVE, nickname))
+        self._delete_segments()
+        return frames
+
+    def _wait_written(self, count: int):
+        """ Wait for the writer to do the first count writes queued """
+        if self._written < count:
+            with self._written_condition:
+                self._written_condition.wait_for(lambda: self._written >= count)
+
+    def flush(self):
+        """ Wait for the writer to do the writes queued """
+        self._wait_written(self._queued)
+
+    def _delete_segments(self):
+        """ Delete segments before the oldest one having undelivered messages, except the one being appended to """
+        oldest = min(self._segments, default=self._segment)
+        for segment in range(self._first_segment, oldest):
+            if segment != self._segment:
+                self._delete_segment(segment)
+        self._first_segment = max(self._first_segment, min(oldest, self._segment))
+
+    def _delete_segment(self, segment: int):
+        """ Delete segment having no undelivered messages """
+        fd = self._segment_fds.pop(segment, None)
+        if fd is not None:
+            os.close(fd)
+        try:
+            os.remove(self._segment_path(segment))
+        except FileNotFoundError:
+            pass
+        except OSError as e:
+            log.error("Ошибка удаления сегмента хранилища %d: %s", segment, e)
+
+    def _write(self):
+        """ Writer thread: do the queued writes in batches - all the ones queued by the time the batch starts """
+        segment_fd = None
+        stop = False
+        while not stop:
+            batch = [self._queue.get()]
+            while not self._queue.empty():
+                batch.append(self._queue.get_nowait())
+            if batch[-1] is _STOP:
+                batch.pop()
+                stop = True
+            try:
+                segment_fd = self._write_batch(batch, segment_fd)
+            except Exception as e:
+                log.critical("Ошибка записи в хранилище сообщений: %r", e, exc_info=True)
+            with self._written_condition:
+                self._written += len(batch)
+                self._written_condition.notify_all()
+        if segment_fd is not None:
+            os.close(segment_fd[1])
+        for fd, _ in self._index_fds.values():
+            os.close(fd)
+        self._index_fds.clear()
+
+    def _write_batch(self, batch: list, segment_fd: tuple | None) -> tuple | None:
+        """
+        Do the writes: messages to the segments first, their locations to the indexes next
+        :param batch: writer queue items
+        :param segment_fd: segment number and descriptor of the segment file written to last, None if none
+        :return: segment number and descriptor of the segment file written to last
+        """
+        chunks = []                 # messages to write at once: segment, offset, frames
+        entries = OrderedDict()     # locations to append by recipient
+        for item in batch:
+            kind, nickname = item[:2]
+            if kind == _APPEND:
+                _, _, segment, offset, frame = item
+                if chunks and chunks[-1][0] == segment and chunks[-1][1] + chunks[-1][3] == offset:
+                    chunks[-1][2].append(frame)
+                    chunks[-1][3] += len(frame)
+                else:
+                    chunks.append([segment, offset, [frame], len(frame)])
+                entries.setdefault(nickname, []).append(INDEX_ENTRY.pack(segment, offset, len(frame)))
+            elif kind == _DELIVERED:
+                self._write_index(nickname, entries.pop(nickname, ()))
+                self._write_header(nickname, item[2])
+            elif kind == _REMOVE:
+                entries.pop(nickname, None)
+                self._remove_index(nickname)
+            elif kind == _ADD_USER:
+                self._users_file.write(json.dumps(nickname) + "\n")
+        self._users_file.flush()
+        for segment, offset, frames, _ in chunks:
+            if segment_fd is None or segment_fd[0] != segment:
+                if segment_fd is not None:
+                    os.close(segment_fd[1])
+                    segment_fd = None
+                segment_fd = segment, os.open(self._segment_path(segment), os.O_WRONLY | os.O_CREAT, 0o600)
+            try:
+                _write_all(segment_fd[1], b"".join(frames), offset)
+            except OSError as e:
+                log.error("Ошибка записи сообщений в сегмент хранилища %d: %s", segment, e)
+        for nickname, nickname_entries in entries.items():
+            self._write_index(nickname, nickname_entries)
+        return segment_fd
+
+    def _index_fd(self, nickname: str) -> list:
+        """ Return recipient's index file descriptor and size, opening (creating) the file if needed """
+        index_fd = self._index_fds.get(nickname)
+        if index_fd is not None:
+            self._index_fds.move_to_end(nickname)
+            return index_fd
+        fd = os.open(self._index_path(nickname), os.O_RDWR | os.O_CREAT, 0o600)
+        size = os.fstat(fd).st_size
+        if not size:
+            _write_all(fd, INDEX_HEADER.pack(0), 0)
+            size = INDEX_HEADER.size
+        index_fd = self._index_fds[nickname] = [fd, size]
+        if len(self._index_fds) > self._index_files:
+            _, (least_recent_fd, _) = self._index_fds.popitem(last=False)
+            os.close(least_recent_fd)
+        return index_fd
+
+    def _write_index(self, nickname: str, nickname_entries: list):
+        """ Append message locations to the recipient's index """
+        if not nickname_entries:
+            return
+        try:
+            index_fd = self._index_fd(nickname)
+            data = b"".join(nickname_entries)
+            _write_all(index_fd[0], data, index_fd[1])
+            index_fd[1] += len(data)
+        except OSError as e:
+            log.error("Ошибка записи сообщений для %s в хранилище: %s", nickname, e)
+
+    def _write_header(self, nickname: str, delivered: int):
+        """ Write the recipient's delivery cursor """
+        try:
+            _write_all(self._index_fd(nickname)[0], INDEX_HEADER.pack(delivered), 0)
+        except OSError as e:
+            log.error("Ошибка записи курсора доставки для %s в хранилище: %s", nickname, e)
+
+    def _remove_index(self, nickname: str):
+        """ Remove the index of the recipient having all the messages delivered """
+        index_fd = self._index_fds.pop(nickname, None)
+        if index_fd is not None:
+            os.close(index_fd[0])
+        try:
+            os.remove(self._index_path(nickname))
+        except FileNotFoundError:
+            pass
+        except OSError as e:
+            log.error("Ошибка удаления индекса хранилища для %s: %s", nickname, e)
+
+    def close(self):
+        """ Do the queued writes, stop the writer thread and close the files """
+        self._queue.put(_STOP)
+        self._thread.join()
+        for fd in self._segment_fds.values():
+            os.close(fd)
+        self._segment_fds.clear()
+        self._users_file.close()
+
+
+def _write_all(fd: int, data: bytes, offset: int):
+    """ Write data to the file at the offset; raises OSError if failed """
+    data = memoryview(data)
+    while data:
+        written = os.pwrite(fd, data, offset)
+        data = data[written:]
+        offset += written
@@ -0,0 +1,219 @@
+"""
+Chat server metrics: counters and latency histograms updated by the server as it services connections,
+exposed in Prometheus text format by a small HTTP server running in a separate thread:
+
+    python server_select.py -metrics_port 9777
+    curl http://127.0.0.1:9777/metrics
+
+The counters are plain integers updated by the event loop thread only; the HTTP thread just reads them,
+so a scrape may see a histogram's count and sum a message apart, which is usual for metrics.
+"""
+import bisect
+import logging
+import threading
+import http.server
+
+import jim
+
+import server_admission
+import server_settings as sett
+
+log = logging.getLogger(sett.LOG_NAME)
+
+METRICS_PATH = "/metrics"
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+INVALID_ACTION = "invalid"          # action label of the messages that could not be parsed
+
+
+class LatencyHistogram:
+    """
+    Latency histogram with log-linear (HDR-style) buckets: every power of two range is split into
+    the same number of equal buckets, so the relative precision is the same for microseconds and seconds.
+    """
+    __slots__ = ('bounds', 'counts', 'count', 'total')
+
+    def __init__(self, lowest: float = sett.METRICS_HISTOGRAM_LOWEST, highest: float = sett.METRICS_HISTOGRAM_HIGHEST,
+                 sub_buckets: int = sett.METRICS_HISTOGRAM_SUB_BUCKETS):
+        """
+        :param lowest: upper bound of the first bucket, seconds
+        :param highest: values above it are counted in the last (+Inf) bucket only, seconds
+        :param sub_buckets: number of buckets every power of two range is split into
+        Attributes:
+        bounds - bucket upper bounds (inclusive), ascending
+        counts - number of values in every bucket, the last one for the values above all the bounds
+        count - number of values recorded
+        total - sum of values recorded
+        """
+        bounds = [lowest]
+        while bounds[-1] < highest:
+            octave = bounds[-1]
+            bounds.extend(octave * (1 + step / sub_buckets) for step in range(1, sub_buckets + 1))
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.count = 0
+        self.total = 0.0
+
+    def record(self, value: float, count: int = 1):
+        """
+        Record value
+        :param value: latency, seconds
+        :param count: number of times the value has been observed (e.g. messages processed together)
+        """
+        self.counts[bisect.bisect_left(self.bounds, value)] += count
+        self.count += count
+        self.total += value * count
+
+    def quantile(self, quantile: float) -> float:
+        """
+        Return the upper bound of the bucket containing the given quantile, inf if above all the bounds,
+        0 if no values recorded
+        :param quantile: 0..1
+        """
+        if not self.count:
+            return 0.0
+        rank = quantile * self.count
+        cumulative = 0
+        for bound, count in zip(self.bounds, self.counts):
+            cumulative += count
+            if cumulative >= rank:
+                return bound
+        return float("inf")
+
+    def render(self, name: str, description: str) -> list:
+        """ Return lines of the histogram in Prometheus text format """
+        lines = [f"# HELP {name} {description}", f"# TYPE {name} histogram"]
+        cumulative = 0
+        for bound, count in zip(self.bounds, self.counts):
+            cumulative += count
+            lines.append(f'{name}_bucket{{le="{bound:.9g}"}} {cumulative}')
+        lines.append(f'{name}_bucket{{le="+Inf"}} {cumulative + self.counts[-1]}')
+        lines.append(f"{name}_sum {self.total:.9g}")
+        lines.append(f"{name}_count {self.count}")
+        return lines
+
+
+class ServerMetrics:
+    """
+    Chat server metrics
+    """
+    __slots__ = ('messages', 'responses', 'bytes_received', 'bytes_sent', 'bytes_dropped', 'connections_accepted',
+                 'connections_rejected', 'output_actions', 'mailbox_stored', 'mailbox_delivered', 'history_dropped',
+                 'probes_sent', 'connections_evicted', 'loop_time', 'ack_latency', 'fanout_latency', '_gauges')
+
+    def __init__(self):
+        """
+        Attributes:
+        messages - number of messages received by action, INVALID_ACTION for the messages failed to parse
+        responses - number of responses sent by response code
+        bytes_received, bytes_sent - client data received, data queued for sending (worker bus included), bytes
+        bytes_dropped - data dropped from slow connections' output by OUTPUT_DROP_OLDEST policy, bytes
+        connections_accepted - number of client connections admitted
+        connections_rejected - number of client connections rejected by reason (see server_admission)
+        output_actions - number of times output policies have been applied to slow connections by policy
+        mailbox_stored, mailbox_delivered - messages stored for offline users and delivered to them later
+        history_dropped - messages not written to the history as its queue was full
+        probes_sent, connections_evicted - probes sent to silent clients, connections closed as probes unanswered
+        loop_time - event loop iteration processing time, select() wait excluded (not measured with asyncio)
+        ack_latency - time from receiving a message to queueing the response to it
+        fanout_latency - time to route a chat message and queue it to all the recipients
+        _gauges - current values to read at scrape time: name -> (description, function returning the value)
+        """
+        # All the label values are known beforehand, so that the dictionaries never change size while being read
+        self.messages = dict.fromkeys([*(action.value for action in jim.Actions), INVALID_ACTION], 0)
+        self.responses = dict.fromkeys((code.value for code in jim.Responses), 0)
+        self.bytes_received = 0
+        self.bytes_sent = 0
+        self.bytes_dropped = 0
+        self.connections_accepted = 0
+        self.connections_rejected = dict.fromkeys(server_admission.REJECT_REASONS, 0)
+        self.output_actions = dict.fromkeys((sett.OUTPUT_DROP_OLDEST, sett.OUTPUT_DISCONNECT, sett.OUTPUT_PAUSE), 0)
+        self.mailbox_stored = 0
+        self.mailbox_delivered = 0
+        self.history_dropped = 0
+        self.probes_sent = 0
+        self.connections_evicted = 0
+        self.loop_time = LatencyHistogram()
+        self.ack_latency = LatencyHistogram()
+        self.fanout_latency = LatencyHistogram()
+        self._gauges = {}
+
+    def add_gauge(self, name: str, description: str, function):
+        """
+        Add value read at scrape time
+        :param name: metric name
+        :param description: metric description
+        :param function: function returning the current value
+        """
+        self._gauges[name] = (description, function)
+
+    def render(self) -> str:
+        """ Return all the metrics in Prometheus text format """
+        lines = ["# HELP chat_messages_total Messages received from clients by action",
+                 "# TYPE chat_messages_total counter"]
+        lines.extend(f'chat_messages_total{{action="{action}"}} {count}' for action, count in self.messages.items())
+        lines.extend(("# HELP chat_responses_total Responses sent to clients by response code",
+                      "# TYPE chat_responses_total counter"))
+        lines.extend(f'chat_responses_total{{code="{code}"}} {count}' for code, count in self.responses.items())
+        lines.extend(("# HELP chat_connections_rejected_total Client connections rejected by reason",
+                      "# TYPE chat_connections_rejected_total counter"))
+        lines.extend(f'chat_connections_rejected_total{{reason="{reason}"}} {count}'
+                     for reason, count in self.connections_rejected.items())
+        lines.extend(("# HELP chat_output_policy_actions_total Output policies applied to slow connections by policy",
+                      "# TYPE chat_output_policy_actions_total counter"))
+        lines.extend(f'chat_output_policy_actions_total{{policy="{policy}"}} {count}'
+                     for policy, count in self.output_actions.items())
+        for name, description, value in (
+                ("chat_received_bytes_total", "Client data received", self.bytes_received),
+                ("chat_sent_bytes_total", "Data queued for sending to clients (and to other workers)", self.bytes_sent),
+                ("chat_dropped_bytes_total", "Data dropped from slow connections' output", self.bytes_dropped),
+                ("chat_connections_accepted_total", "Client connections accepted", self.connections_accepted),
+                ("chat_mailbox_stored_total", "Messages stored for offline users", self.mailbox_stored),
+                ("chat_mailbox_delivered_total", "Stored messages delivered", self.mailbox_delivered),
+                ("chat_history_dropped_total", "Messages not written to the history as its queue was full",
+                 self.history_dropped),
+                ("chat_probes_sent_total", "Probes sent to silent clients", self.probes_sent),
+                ("chat_connections_evicted_total", "Client connections closed as probes were left unanswered",
+                 self.connections_evicted)):
+            lines.extend((f"# HELP {name} {description}", f"# TYPE {name} counter", f"{name} {value}"))
+        for name, (description, function) in self._gauges.items():
+            lines.extend((f"# HELP {name} {description}", f"# TYPE {name} gauge", f"{name} {function()}"))
+        lines.extend(self.loop_time.render(
+            "chat_loop_iteration_seconds", "Event loop iteration processing time, select() wait excluded"))
+        lines.extend(self.ack_latency.render(
+            "chat_receive_to_ack_seconds", "Time from receiving a message to queueing the response to it"))
+        lines.extend(self.fanout_latency.render(
+            "chat_fanout_seconds", "Time to route a chat message and queue it to all the recipients"))
+        return "\n".join(lines) + "\n"
+
+
+def serve_metrics(metrics: ServerMetrics, address: str, port: int) -> http.server.HTTPServer | None:
+    """
+    Start HTTP server exposing the metrics at METRICS_PATH in a separate (daemon) thread
+    :param metrics: metrics to expose
+    :param address: IP address to listen on
+    :param port: TCP port to listen on
+    :return: HTTP server (call its shutdown() to stop it), None if failed to start
+    """
+    class MetricsHandler(http.server.BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path != METRICS_PATH:
+                self.send_error(404)
+                return
+            body = metrics.render().encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", CONTENT_TYPE)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format: str, *args):
+            log.debug("Метрики: %s - %s", self.address_string(), format % args)
+
+    try:
+        server = http.server.HTTPServer((address, port), MetricsHandler)
+    except OSError as e:
+        log.critical("Не удалось открыть порт метрик %s:%d: %s", address, port, e)
+        return None
+    threading.Thread(target=server.serve_forever, name="metrics", daemon=True).start()
+    log.info("Метрики доступны по адресу http://%s:%d%s", address, port, METRICS_PATH)
+    return server
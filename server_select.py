@@ -1,26 +1,67 @@
+import os
+import math
+import time
 import logging
 import socket as sock
-import select
+import selectors
 import argparse
-from dataclasses import dataclass
+import sqlite3
+import itertools
+import concurrent.futures
+from collections import deque
+from dataclasses import dataclass, field
 
 import jim
 
 import server_settings as sett
 import server_log_config
+import server_metrics
+import server_mailbox
+import server_auth
+import server_history
+import server_admission
+from timing_wheel import TimingWheel
 
 from metaclasses_and_descriptors import ServerVerifier, PortValue
 
+log = logging.getLogger(sett.LOG_NAME)
 
-@dataclass
+_MISSING = object()
+_WAKEUP = object()          # selector key data of the socket waking the event loop up from other threads
+
+# Max number of buffers to send with one sendmsg() call
+try:
+    IOV_MAX = os.sysconf('SC_IOV_MAX')
+except (AttributeError, ValueError, OSError):   # no sysconf() or no such setting on this platform
+    IOV_MAX = 16
+# Vectored send is not available on all platforms - buffers are joined and sent with send() then
+SENDMSG_SUPPORTED = hasattr(sock.socket, 'sendmsg')
+# Connection class to choose output policy by (see server_settings.OUTPUT_POLICIES)
+CLIENT_CONNECTION_CLASS = 'client'
+
+
+# Optimize memory usage with slots; connections are compared and hashed by identity
+@dataclass(eq=False, slots=True)
 class Connection:
-    __slots__ = ('connection', 'address', 'nickname')       # Optimize memory usage with slots
     connection: sock.socket         # connection instance
     address: (str, int)             # client address
     nickname: str                   # client nickname used to send messages to
+    decoder: jim.FrameDecoder       # incoming data decoder to split it into messages
+    output: deque = field(default_factory=deque)            # outgoing frames not yet accepted by the socket
+    output_size: int = 0                                    # bytes in the output buffer
+    policy: str = sett.OUTPUT_DISCONNECT                    # output policy if the client does not keep up
+    events: int = selectors.EVENT_READ                      # selector events waited for, 0 - not registered
+    paused: int = 0                                         # number of slow connections reading is paused for
+    paused_senders: set = field(default_factory=set)        # connections paused until this one's output drains
+    closing: bool = False                                   # closed or to be closed at the end of the iteration
+    authenticated: bool = False                             # the nickname has been authenticated
+    codec: str = jim.CODEC_JSON                             # encoding of messages sent to the client
+    last_received: float = 0.0                              # time data was last received (time.perf_counter())
+    rooms: set = field(default_factory=set)                 # chat rooms joined
+    request_id: int | None = None                           # id of the message being processed, to respond with
 
     def fileno(self):
-        """ Return file descriptor to use with select.select() """
+        """ Return file descriptor to use with selectors """
         return self.connection.fileno()
 
 
@@ -31,35 +72,102 @@ class Server(metaclass=ServerVerifier):
     # Port value descriptor
     _port = PortValue("_port")
 
-    def __init__(self, address: str = None, port: str = None):
+    def __init__(self, address: str = None, port: str = None, reuse_port: bool = False, offline_mailbox: bool = True,
+                 message_history: bool = True):
         """
         Initialize server - open port for listening
         :param address: server IP address
         :param port: server port
+        :param reuse_port: allow other processes to listen on the same port, incoming connections are distributed
+            among them (SO_REUSEPORT)
+        :param offline_mailbox: store messages to offline users in sett.MAILBOX_DIRECTORY (unless it is empty)
+        :param message_history: keep chat messages in sett.HISTORY_DATABASE (unless it is empty)
         Attributes:
         _address - server IP address
         _port - server port
         _connections - client connections dictionary
+        _nicknames - client connections index by nickname, to route messages to users
+        _rooms - chat room members index by room name, to route messages to rooms
+        _selector - selector waiting for I/O readiness of the listening socket and client connections
+        _output_pending - connections with outgoing data to flush at the end of the event loop iteration
+        _debug - debug logging enabled: checked once here, as the hot paths would check it for every message
+        _metrics - server metrics (see server_metrics)
+        _mailbox - offline messages store, None if disabled
+        _deliveries - connections stored messages are being delivered to by nickname
+        _history - message history writer, None if disabled
+        _heartbeats - timers of client connections' heartbeat checks, None if disabled
+        _admission - admission controller deciding whether to admit new connections
+        _auth - users authentication, None if disabled
+        _completions - callbacks of the futures completed in other threads, with the futures, to call in the loop
+        _wakeup_reader, _wakeup_writer - socket pair to wake the event loop up when a future completes
         """
         self._address = address if address else sett.DEFAULT_LISTEN_ADDRESS
         self._port = int(port) if port else sett.DEFAULT_PORT
+        self._debug = log.isEnabledFor(logging.DEBUG)
         log.critical("Чат-сервер ожидает подключений по адресу %s:%d",
                      self._address if self._address else '(все интерфейсы)', self._port)
         # Create and bind socket and listed to connections
         self._listening = False
         try:
             self._socket = sock.socket(sock.AF_INET, sock.SOCK_STREAM)
+            if reuse_port:
+                self._socket.setsockopt(sock.SOL_SOCKET, sock.SO_REUSEPORT, 1)
             self._socket.bind((self._address, self._port))
-            self._socket.listen(5)          # размер буфера входящих соединений - в соответствии с описанием в лекции
-            self._socket.setblocking(True)  # blocking mode - will wait for data during send() and recv()
-            self._socket.settimeout(sett.SOCKET_TIMEOUT)    # set timeout for waiting for incoming connections
+            self._socket.listen(sett.LISTEN_BACKLOG)    # размер очереди входящих соединений
+            self._socket.setblocking(False) # non-blocking mode - connections are accepted when selector reports
             self._listening = True
         except OSError as e:
             log.critical("Не удалось инициализировать порт для входящих подключений: %s", e)
         except Exception as e:
             log.critical("Непредвиденная ошибка при инициализации порта для входящих подключений: %s", e)
-        # Initialize empty client connections dictionary
+        # Initialize empty client connections dictionary and its indexes
         self._connections = {}
+        self._nicknames = {}
+        self._rooms = {}
+        # Listening socket is serviced in the same event loop as connections; its selector key has no data
+        self._selector = selectors.DefaultSelector()
+        if self._listening:
+            self._selector.register(self._socket, selectors.EVENT_READ)
+        self._output_pending = set()
+        self._completions = deque()
+        self._wakeup_reader, self._wakeup_writer = sock.socketpair()
+        self._wakeup_reader.setblocking(False)
+        self._wakeup_writer.setblocking(False)
+        self._selector.register(self._wakeup_reader, selectors.EVENT_READ, _WAKEUP)
+        self._metrics = server_metrics.ServerMetrics()
+        self._metrics.add_gauge("chat_connections_open", "Client connections open", lambda: len(self._connections))
+        self._metrics.add_gauge("chat_users", "Users (nicknames) connected", lambda: len(self._nicknames))
+        self._metrics.add_gauge("chat_rooms", "Chat rooms having members", lambda: len(self._rooms))
+        self._admission = server_admission.AdmissionController(sett.MAX_CONNECTIONS, sett.ACCEPT_RATE,
+                                                               sett.ACCEPT_BURST, sett.ADMISSION_LAG_THRESHOLD)
+        self._metrics.add_gauge("chat_event_loop_lag_seconds", "Event loop lag new connections are admitted by",
+                                lambda: self._admission.lag)
+        self._mailbox = None
+        self._deliveries = {}
+        if offline_mailbox and sett.MAILBOX_DIRECTORY:
+            try:
+                self._mailbox = server_mailbox.Mailbox(sett.MAILBOX_DIRECTORY)
+            except (OSError, ValueError) as e:
+                log.critical("Не удалось открыть хранилище сообщений %s, сообщения для пользователей не в сети "
+                             "не сохраняются: %s", sett.MAILBOX_DIRECTORY, e)
+        self._history = None
+        if message_history and sett.HISTORY_DATABASE:
+            try:
+                self._history = server_history.History(sett.HISTORY_DATABASE)
+            except sqlite3.Error as e:
+                log.critical("Не удалось открыть историю сообщений %s, история не сохраняется: %s",
+                             sett.HISTORY_DATABASE, e)
+            else:
+                self._metrics.add_gauge("chat_history_queued", "Messages waiting to be written to the history",
+                                        lambda: self._history.queued if self._history is not None else 0)
+        self._auth = server_auth.Authenticator(sett.AUTH_USERS_FILE) if sett.AUTH_USERS_FILE else None
+        # The wheel spans the heartbeat interval, so that every timer expires in the first round
+        self._heartbeats = TimingWheel(sett.HEARTBEAT_TICK, math.ceil(sett.HEARTBEAT_INTERVAL / sett.HEARTBEAT_TICK) + 1,
+                                       time.perf_counter()) if sett.HEARTBEAT_INTERVAL else None
+
+    @property
+    def metrics(self) -> server_metrics.ServerMetrics:
+        return self._metrics
 
     @property
     def listening(self):
@@ -67,39 +175,360 @@ class Server(metaclass=ServerVerifier):
 
     def _accept_connection(self) -> bool:
         """
-        Accept a pending connection if any, if maximum number of connection has not been reached.
-        Add a new connection to the _connections dictionary.
-        :return: True if a new connection accepted, False if timeout or maximum number of connections reached
+        Accept a pending connection if any. Add it to the _connections dictionary if admitted,
+        otherwise send it the error response and close it.
+        :return: True if a connection accepted (admitted or rejected), False if no pending connections
         """
         if not self._listening:
             log.critical("Обработка соединений невозможна - не инициализирован порт для входящих подключений")
             return False
         try:
             connection, address = self._socket.accept()
-        except TimeoutError:
-            log.debug("Нет новых запросов на соединение")
+        except BlockingIOError:
+            if self._debug:
+                log.debug("Нет новых запросов на соединение")
+            return False
+        except OSError as e:                # e.g. out of file descriptors - the connection is left pending
+            log.error("Ошибка приема входящего соединения: %s", e)
             return False
-        if len(self._connections) >= sett.MAX_CONNECTIONS:
-            log.warning("Клиент %s:%d: Превышено количество допустимых соединений - %d, "
-                        "входящее соединение отклоняется", *address, sett.MAX_CONNECTIONS)
+        if not self._admit_connection(address):
             try:
-                response = jim.Response(**jim.Responses.SERVER_ERROR.response).json
-                log.debug("Клиент %s:%d: Отправка сообщения об ошибке сервера: %s", *address, response)
-                connection.send(response.encode(sett.DEFAULT_ENCODING))
-            except Exception as e:
-                log.critical("Клиент %s:%d: Непредвиденная ошибка при отправке сообщения об ошибке: %s", *address, e)
-            log.debug("Клиент %s:%d: Завершение соединения на стороне сервера", *address)
+                connection.send(self._admission.reject_frame())
+            except OSError as e:
+                log.info("Клиент %s:%d: Ошибка отправки сообщения об ошибке сервера: %s", *address, e)
             connection.close()
+            return True
+        self._register_connection(connection, address)
+        return True
+
+    def _admit_connection(self, address: (str, int)) -> bool:
+        """
+        Decide whether to admit a new client connection, count it
+        :param address: client address
+        :return: True if admitted, False if to be rejected with the admission controller's reject frame
+        """
+        reason = self._admission.admit(len(self._connections), time.perf_counter())
+        if reason is not None:
+            self._metrics.connections_rejected[reason] += 1
+            if self._debug:
+                log.debug("Клиент %s:%d: Входящее соединение отклоняется (%s)", *address, reason)
             return False
-        connection.settimeout(sett.CLIENT_CONNECTION_TIMEOUT)
         log.info("Клиент %s:%d: Входящее соединение установлено", *address)
+        self._metrics.connections_accepted += 1
+        return True
+
+    def _register_connection(self, connection: sock.socket, address: (str, int)) -> Connection:
+        """
+        Add a new client connection to the _connections dictionary and start waiting for its data
+        :param connection: client connection socket
+        :param address: client address
+        :return: new connection
+        """
+        connection.setblocking(False)   # never wait for a client - slow clients get their output buffered
         self._connections[connection] = Connection(
             connection=connection,
             address=address,
-            nickname=""
+            nickname="",
+            decoder=jim.FrameDecoder(),
+            policy=sett.OUTPUT_POLICIES[CLIENT_CONNECTION_CLASS]
         )
+        self._selector.register(connection, selectors.EVENT_READ, self._connections[connection])
+        self._start_heartbeat(self._connections[connection])
+        return self._connections[connection]
+
+    def _start_heartbeat(self, connection: Connection):
+        """ Start checking the new client connection is alive """
+        connection.last_received = time.perf_counter()
+        if self._heartbeats is not None:
+            self._heartbeats.schedule(connection, sett.HEARTBEAT_INTERVAL, connection.last_received)
+
+    def _check_heartbeats(self):
+        """
+        Check the client connections whose heartbeat timers have expired: probe the ones silent for
+        the heartbeat interval, close the ones that have not answered HEARTBEAT_MISSES probes,
+        restart the timers of the others to expire the heartbeat interval after they were last heard from
+        """
+        now = time.perf_counter()
+        expired = self._heartbeats.advance(now)
+        if not expired:
+            return
+        probes = {}
+        for connection in expired:
+            if connection.closing:
+                continue
+            silence = now - connection.last_received
+            if connection.paused:           # not read from, rather than silent
+                self._heartbeats.schedule(connection, sett.HEARTBEAT_INTERVAL, now)
+            elif silence < sett.HEARTBEAT_INTERVAL:
+                self._heartbeats.schedule(connection, sett.HEARTBEAT_INTERVAL - silence, now)
+            elif silence >= sett.HEARTBEAT_INTERVAL * (sett.HEARTBEAT_MISSES + 1):
+                log.warning("Клиент %s:%d: Нет ответа на проверку связи в течение %.0f с, соединение закрывается",
+                            *connection.address, silence)
+                self._metrics.connections_evicted += 1
+                self._close_connection(connection)
+            else:
+                probe = probes.get(connection.codec)
+                if probe is None:
+                    probe = probes[connection.codec] = jim.frame(
+                        jim.Message(**{jim.MessageFields.ACTION: jim.Actions.PROBE}).to_bytes(connection.codec))
+                if self._debug:
+                    log.debug("Клиент %s:%d: Проверка связи", *connection.address)
+                self._send(connection, probe)
+                self._metrics.probes_sent += 1
+                self._heartbeats.schedule(connection, sett.HEARTBEAT_INTERVAL, now)
+
+    def _close_connection(self, connection: Connection):
+        """
+        Close client connection and forget it
+        :param connection: connection to close
+        """
+        connection.closing = True
+        if connection.events:
+            self._selector.unregister(connection.connection)
+        self._output_pending.discard(connection)
+        del self._connections[connection.connection]
+        self._forget_connection(connection)
+        connection.connection.close()
+
+    def _forget_connection(self, connection: Connection):
+        """
+        Remove closed connection from the connections indexes
+        :param connection: closed connection
+        """
+        if connection.nickname:
+            connections = self._nicknames.get(connection.nickname)
+            if connections is not None:
+                connections.discard(connection)
+                if not connections:
+                    del self._nicknames[connection.nickname]
+        for room in connection.rooms:
+            self._leave_room(connection, room)
+        connection.rooms.clear()
+        self._resume_senders(connection)
+        if self._heartbeats is not None:
+            self._heartbeats.cancel(connection)
+        # Continue delivering stored messages to another connection of the user if any
+        if self._deliveries.get(connection.nickname) is connection:
+            del self._deliveries[connection.nickname]
+            connections = self._nicknames.get(connection.nickname)
+            if connections:
+                self._start_delivery(next(iter(connections)))
+
+    def _join_room(self, connection: Connection, room: str):
+        """
+        Add connection to chat room members, creating the room if it does not exist
+        :param connection: connection joining the room
+        :param room: room name
+        """
+        self._rooms.setdefault(room, set()).add(connection)
+        connection.rooms.add(room)
+
+    def _leave_room(self, connection: Connection, room: str):
+        """
+        Remove connection from chat room members, removing the room if no members left.
+        Room is not removed from the connection's rooms.
+        :param connection: connection leaving the room
+        :param room: room name
+        """
+        members = self._rooms.get(room)
+        if members is not None:
+            members.discard(connection)
+            if not members:
+                del self._rooms[room]
+
+    def _send(self, connection: Connection, data: bytes | memoryview, sender: Connection = None):
+        """
+        Queue framed data to the connection's output buffer.
+        The buffer is flushed at the end of the event loop iteration, so the data of several messages
+        is sent at once, and what the socket can't accept is sent later when the client is ready.
+        The data is queued as is, so it should not be changed afterwards.
+        If the buffer grows above the high watermark, the connection's output policy is applied.
+        :param connection: connection to send data to
+        :param data: framed data
+        :param sender: connection the data is sent on behalf of - paused by OUTPUT_PAUSE policy
+        """
+        if connection.closing:
+            return
+        if not connection.output:
+            self._output_pending.add(connection)
+        connection.output.append(data)
+        connection.output_size += len(data)
+        self._metrics.bytes_sent += len(data)
+        if connection.output_size > sett.OUTPUT_HIGH_WATERMARK:
+            self._apply_output_policy(connection, sender)
+
+    def _apply_output_policy(self, connection: Connection, sender: Connection | None):
+        """
+        Apply output policy to the connection whose output buffer is above the high watermark
+        :param connection: slow connection
+        :param sender: connection the data has been sent on behalf of
+        """
+        if connection.policy == sett.OUTPUT_DROP_OLDEST:
+            dropped = self._drop_output(connection)
+            if self._debug:
+                log.debug("Клиент %s:%d: Клиент не успевает принимать данные, удалено из очереди: %d байт",
+                          *connection.address, dropped)
+        elif connection.policy == sett.OUTPUT_DISCONNECT:
+            log.warning("Клиент %s:%d: Клиент не успевает принимать данные, соединение закрывается",
+                        *connection.address)
+            self._disconnect(connection)
+        elif sender is not None and sender not in connection.paused_senders:
+            if self._debug:
+                log.debug("Клиент %s:%d: Прием данных приостановлен - клиент %s:%d не успевает принимать данные",
+                          *sender.address, *connection.address)
+            connection.paused_senders.add(sender)
+            self._pause_reading(sender)
+        else:
+            return
+        self._metrics.output_actions[connection.policy] += 1
+
+    def _drop_output(self, connection: Connection) -> int:
+        """
+        Drop the oldest buffered frames down to the low watermark, except for the partially sent one
+        :param connection: slow connection
+        :return: number of bytes dropped
+        """
+        output = connection.output
+        # The first buffer may have been sent in part if the connection is waiting for write readiness
+        first = output.popleft() if connection.events & selectors.EVENT_WRITE else None
+        dropped = 0
+        while output and connection.output_size - dropped > sett.OUTPUT_LOW_WATERMARK:
+            dropped += len(output.popleft())
+        if first is not None:
+            output.appendleft(first)
+        connection.output_size -= dropped
+        self._metrics.bytes_dropped += dropped
+        return dropped
+
+    def _disconnect(self, connection: Connection):
+        """
+        Drop the connection's output and mark it to be closed at the end of the event loop iteration -
+        it can't be closed right away as it may be among the recipients being iterated
+        :param connection: slow connection
+        """
+        connection.closing = True
+        connection.output.clear()
+        connection.output_size = 0
+        self._output_pending.add(connection)
+
+    def _pause_reading(self, connection: Connection):
+        """
+        Stop reading from the connection until all the slow connections it has been paused for drain
+        (and its password is checked, if authenticating)
+        """
+        connection.paused += 1
+        if connection.paused == 1:
+            self._update_events(connection)
+
+    def _resume_reading(self, connection: Connection):
+        """ Resume reading from the connection if no slow connections left it has been paused for """
+        connection.paused -= 1
+        if not connection.paused and not connection.closing:
+            self._update_events(connection)
+
+    def _resume_senders(self, connection: Connection):
+        """ Resume reading from the connections paused until the connection's output drains """
+        if connection.paused_senders:
+            for sender in connection.paused_senders:
+                self._resume_reading(sender)
+            connection.paused_senders.clear()
+
+    def _update_events(self, connection: Connection):
+        """ Update selector events waited for the connection: read unless paused, write if output is buffered """
+        events = (0 if connection.paused else selectors.EVENT_READ) | (selectors.EVENT_WRITE if connection.output else 0)
+        if events == connection.events:
+            return
+        if not connection.events:
+            self._selector.register(connection.connection, events, connection)
+        elif not events:
+            self._selector.unregister(connection.connection)
+        else:
+            self._selector.modify(connection.connection, events, connection)
+        connection.events = events
+
+    def _broadcast(self, sender: Connection, *recipient_groups, data: bytes, codec: str = jim.CODEC_JSON) -> int:
+        """
+        Queue the same framed message to the output buffers of all the recipients, except for the sender.
+        The data is not copied - every recipient's buffer references the same read-only memory.
+        Recipients using another codec get the message re-encoded once for all of them.
+        :param sender: connection the data came from
+        :param recipient_groups: collections of recipient connections (sets, dict values) - a recipient appearing
+            in several groups gets the data once
+        :param data: framed message
+        :param codec: codec the message is encoded with
+        :return: number of recipients
+        """
+        recipients = recipient_groups[0] if len(recipient_groups) == 1 else set().union(*recipient_groups)
+        payloads = {codec: memoryview(data).toreadonly()}
+        count = 0
+        for recipient in recipients:
+            if recipient is not sender:
+                payload = payloads.get(recipient.codec, _MISSING)
+                if payload is _MISSING:
+                    payload = payloads[recipient.codec] = self._transcode(data, recipient.codec)
+                if payload is not None:
+                    self._send(recipient, payload, sender)
+                    count += 1
+        return count
+
+    @staticmethod
+    def _transcode(data: bytes, codec: str) -> memoryview | None:
+        """
+        Re-encode framed message with another codec
+        :param data: framed message
+        :param codec: codec to encode the message with
+        :return: framed message, None if it can't be encoded with the codec (e.g. too long for JSON)
+        """
+        try:
+            message = jim.Message.from_bytes(bytes(data[jim.FRAME_HEADER.size:]))
+            return memoryview(jim.frame(message.to_bytes(codec))).toreadonly()
+        except ValueError as e:
+            log.warning("Сообщение не может быть перекодировано (%s) для пересылки: %s", codec, e)
+            return None
+
+    def _flush_output(self, connection: Connection) -> bool:
+        """
+        Send as much of the connection's buffered output as the socket accepts without blocking.
+        Buffered frames are sent together with one vectored send.
+        Wait for the socket write readiness if there is data left, stop waiting otherwise.
+        Resume reading from the connections paused for this one once the output drains below the low watermark.
+        :param connection: connection to flush output of
+        :return: True if succeeded, False if connection failed
+        """
+        output = connection.output
+        try:
+            if len(output) == 1:
+                sent = connection.connection.send(output[0])
+            elif SENDMSG_SUPPORTED:
+                sent = connection.connection.sendmsg(itertools.islice(output, IOV_MAX))
+            else:
+                sent = connection.connection.send(b"".join(itertools.islice(output, IOV_MAX)))
+        except BlockingIOError:
+            sent = 0
+        except OSError as e:
+            log.info("Клиент %s:%d: Ошибка отправки данных, соединение закрывается: %s", *connection.address, e)
+            return False
+        # Drop sent buffers, keep unsent part of the partially sent one
+        connection.output_size -= sent
+        while sent:
+            size = len(output[0])
+            if size <= sent:
+                output.popleft()
+                sent -= size
+            else:
+                output[0] = memoryview(output[0])[sent:]
+                sent = 0
+        self._update_events(connection)
+        if connection.output_size <= sett.OUTPUT_LOW_WATERMARK:
+            self._resume_senders(connection)
         return True
 
+    def _flush_pending_output(self):
+        """ Send output produced during the event loop iteration, closing connections that failed or too slow """
+        while self._output_pending:
+            connection = self._output_pending.pop()
+            if connection.closing or not self._flush_output(connection):
+                self._close_connection(connection)
 
     def _check_nickname(self, connection: Connection, nickname: str) -> bool:
         """
@@ -113,7 +542,12 @@ class Server(metaclass=ServerVerifier):
         """
         if connection.nickname is None or connection.nickname == "":
             connection.nickname = nickname
+            self._nicknames.setdefault(nickname, set()).add(connection)
             log.debug("Клиент %s:%d: Установлено имя (%s) для соединения", *connection.address, connection.nickname)
+            if self._mailbox is not None:
+                self._mailbox.add_user(nickname)
+                if self._mailbox.pending(nickname) and nickname not in self._deliveries:
+                    self._start_delivery(connection)
             return True
         # Report nickname change is invalid if nickname mismatch
         elif connection.nickname != nickname:
@@ -125,155 +559,579 @@ class Server(metaclass=ServerVerifier):
 
     def _process_message(self, connection: Connection) -> bool:
         """
-        For the specified connection, receive a peer's message, process it and reply to it if needed
+        For the specified connection, receive peer's data, process all the complete messages it contains
+        and reply to each of them
         :return: True if message exchange succeeded, False if failed for some reason
         """
         try:
-            data_bytes = connection.connection.recv(jim.MAX_JIM_LEN)
-            data = data_bytes.decode(sett.DEFAULT_ENCODING)
-            forward_message = False         # for chat messages
-            if not data:
+            data_bytes = connection.connection.recv(sett.RECEIVE_BUFFER_SIZE)
+            if not data_bytes:
                 log.info("Клиент %s:%d: Соединение закрыто клиентом", *connection.address)
                 return False
-            try:
-                message = jim.Message.from_str(data)
-            except ValueError as e:
-                log.error("Клиент %s:%d: Получены некорректные данные: %s", *connection.address, data)
-                response = jim.Response(**jim.Responses.BAD_REQUEST.response).json
-            else:
-                log.debug("Клиент %s:%d: Получено сообщение: %s", *connection.address, message.json)
-
-                # ************ PRESENCE ***************
-                if message.action == jim.Actions.PRESENCE:
-                    sender_nickname = message.kwargs[jim.MessageFields.USER][jim.MessageFields.ACCOUNT_NAME]
-                    log.debug("Клиент %s:%d: Формирование ответа на сообщение присутствия", *connection.address)
-                    if not self._check_nickname(connection, sender_nickname):
-                        response = jim.Response(**jim.Responses.BAD_LOGIN.response).json
-                    else:
-                        response = jim.Response(**jim.Responses.OK.response).json
-
-                # ************ MESSAGE ***************
-                elif message.action == jim.Actions.MESSAGE:
-                    sender_nickname = message.kwargs[jim.MessageFields.FROM]
-                    if not self._check_nickname(connection, sender_nickname):
-                        log.debug("Клиент %s:%d: Формирование сообщения об ошибке аутентификации", *connection.address)
-                        response = jim.Response(**jim.Responses.BAD_LOGIN.response).json
-                    else:
-                        target_nickname = message.kwargs[jim.MessageFields.TO]
-
-                        # Forward message to all users
-                        if target_nickname == jim.BROADCAST_MESSAGE_ADDRESS:
-
-                            # Send the message
-                            log.debug("Клиент %s:%d: Пересылка сообщения всем клиентам", *connection.address)
-                            for other_connection in self._connections:
-                                if other_connection.fileno() != connection.connection.fileno():
-                                    log.debug("Клиент %s:%d: Пересылка сообщения клиенту %s:%d",
-                                              *connection.address, *other_connection.getpeername())
-                                    other_connection.send(data_bytes)
-
-                            # Confirm regardless of whether there were any other users
-                            log.debug("Клиент %s:%d: Формирование подтверждения отправки", *connection.address)
-                            response = jim.Response(**jim.Responses.OK.response).json
-
-                        # Send message to particular user(-s if multiple connections for the same nickname)
-                        # (chats not processed)
-                        else:
-
-                            # filter connections by nickname, excluding sender
-                            forward_destinations = [destination for destination in self._connections.values()
-                                                    if destination.nickname == target_nickname and
-                                                    destination.connection.fileno() != connection.fileno()]
-
-                            # if no users found, error
-                            if not forward_destinations:
-                                log.debug("Клиент %s:%d: Формирование сообщения 'адресат %s не найден' для отправителя",
-                                          *connection.address, target_nickname)
-                                response = jim.Response(**jim.Responses.NOT_FOUND.response).json
-
-                            # is destination(s) found, send message
-                            else:
-                                log.debug("Клиент %s:%d: Пересылка сообщения клиенту(-ам) с именем %s",
-                                          *connection.address, target_nickname)
-                                for other_connection in forward_destinations:
-                                    log.debug("Клиент %s:%d: Пересылка сообщения клиенту %s:%d",
-                                              *connection.address, *other_connection.connection.getpeername())
-                                    other_connection.connection.send(data_bytes)
-                                log.debug("Клиент %s:%d: Формирование подтверждения отправки", *connection.address)
-                                response = jim.Response(**jim.Responses.OK.response).json
-
-                # ************ UNKNOWN ***************
-                else:
-                    log.error("Клиент %s:%d: Неподдерживаемый тип сообщения, формирование ответа", *connection.address)
-                    response = jim.Response(**jim.Responses.BAD_REQUEST.response).json
-        except ValueError as e:  # Can happen when creating response
-            log.critical("Клиент %s:%d: Непредвиденная ошибка данных: %s", e)
-            return False
+            return self._process_data(connection, data_bytes)
+        except BlockingIOError:         # spurious readiness - nothing to read yet
+            return True
         except TimeoutError:
             log.warning("Клиент %s:%d: Соединение закрывается по таймауту.", *connection.address)
             return False
-        except ConnectionResetError:
+        except (ConnectionResetError, BrokenPipeError):
             log.info("Клиент %s:%d: Соединение закрыто клиентом.", *connection.address)
             return False
 
-        # Send response to client
+    def _process_data(self, connection: Connection, data_bytes: bytes) -> bool:
+        """
+        Process all the complete messages in the data received from the specified connection
+        and reply to each of them
+        :param connection: connection the data was received from
+        :param data_bytes: received data
+        :return: True if message exchange succeeded, False if failed for some reason
+        """
+        received = connection.last_received = time.perf_counter()
+        self._metrics.bytes_received += len(data_bytes)
         try:
-            if not response:
-                log.critical("Клиент %s:%d: Формирование сообщения об ошибке сервера по умолчанию", *connection.address)
-                response = jim.Response(**jim.Responses.SERVER_ERROR.response).json
-            log.debug("Клиент %s:%d: Отправка ответа: %s", *connection.address, response)
-            connection.connection.send(response.encode(sett.DEFAULT_ENCODING))
+            try:
+                frames = connection.decoder.feed_frames(data_bytes)
+            except ValueError as e:
+                # The stream can't be split into messages anymore - report and close the connection
+                log.error("Клиент %s:%d: Нарушен формат потока данных: %s", *connection.address, e)
+                self._send(connection, jim.RESPONSE_ENCODER.encode_frame(jim.Responses.BAD_REQUEST,
+                                                                         codec=connection.codec))
+                return False
+            # Reply to all the received messages at once (except for the ones replied to later - authentication)
+            responses = [self._process_frame_guarded(connection, frame) for frame in frames]
+            if responses:
+                data = b"".join(responses)
+                if data:
+                    self._send(connection, data, connection)
+                self._metrics.ack_latency.record(time.perf_counter() - received, len(responses))
         except ValueError as e:  # Can happen when creating response
-            log.critical("Клиент %s:%d: Непредвиденная ошибка данных: %s", e)
+            log.critical("Клиент %s:%d: Непредвиденная ошибка данных: %s", *connection.address, e)
             return False
         except TimeoutError:
             log.warning("Клиент %s:%d: Соединение закрывается по таймауту.", *connection.address)
             return False
-        except ConnectionResetError:
+        except (ConnectionResetError, BrokenPipeError):
             log.info("Клиент %s:%d: Соединение закрыто клиентом.", *connection.address)
             return False
 
         return True
 
+    def _forward_message(self, connection: Connection, target_nickname: str, forward_bytes: memoryview) -> int:
+        """
+        Forward a chat message to its recipients: all users, chat room members or users with the given nickname
+        :param connection: connection the message was received from
+        :param target_nickname: message TO address
+        :param forward_bytes: message frame as received - a view of the received data, forwarded without copying
+        :return: response code for the sender
+        """
+        codec = jim.detect_codec(forward_bytes[jim.FRAME_HEADER.size:])
+
+        # Forward message to all users
+        if target_nickname == jim.BROADCAST_MESSAGE_ADDRESS:
+
+            # Send the message
+            count = self._broadcast(connection, self._connections.values(), data=forward_bytes, codec=codec)
+            if self._debug:
+                log.debug("Клиент %s:%d: Пересылка сообщения всем клиентам (%d)", *connection.address, count)
+
+            # Confirm regardless of whether there were any other users
+            return jim.Responses.OK
+
+        # Forward message to chat room members
+        if target_nickname.startswith(jim.ROOM_PREFIX):
+            members = self._rooms.get(target_nickname)
+
+            # if no such room, error
+            if members is None:
+                log.debug("Клиент %s:%d: Формирование сообщения 'чат %s не найден' для отправителя",
+                          *connection.address, target_nickname)
+                return jim.Responses.NOT_FOUND
+
+            # only members can send messages to the room
+            if connection not in members:
+                log.debug("Клиент %s:%d: Формирование сообщения 'отправитель не участник чата %s'",
+                          *connection.address, target_nickname)
+                return jim.Responses.FORBIDDEN
+
+            # send the same message bytes to every member
+            count = self._broadcast(connection, members, data=forward_bytes, codec=codec)
+            if self._debug:
+                log.debug("Клиент %s:%d: Пересылка сообщения участникам чата %s (%d)",
+                          *connection.address, target_nickname, count)
+            return jim.Responses.OK
+
+        # Keep the order of messages to the user still receiving the stored ones
+        if target_nickname in self._deliveries:
+            return self._store_message(connection, target_nickname, forward_bytes, jim.Responses.OK)
+
+        # Send message to particular user(-s if multiple connections for the same nickname)
+        # look up connections by nickname, excluding sender
+        forward_destinations = self._nicknames.get(target_nickname, set()) - {connection}
+
+        # store message to the known user who is offline
+        if (not forward_destinations and self._mailbox is not None and target_nickname not in self._nicknames
+                and self._mailbox.is_known(target_nickname)):
+            return self._store_message(connection, target_nickname, forward_bytes, jim.Responses.GONE)
+
+        # if no users found, error
+        if not forward_destinations:
+            log.debug("Клиент %s:%d: Формирование сообщения 'адресат %s не найден' для отправителя",
+                      *connection.address, target_nickname)
+            return jim.Responses.NOT_FOUND
+
+        # is destination(s) found, send message
+        if self._debug:
+            log.debug("Клиент %s:%d: Пересылка сообщения клиенту(-ам) с именем %s",
+                      *connection.address, target_nickname)
+        self._broadcast(connection, forward_destinations, data=forward_bytes, codec=codec)
+        return jim.Responses.OK
+
+    def _store_message(self, connection: Connection, target_nickname: str, forward_bytes: memoryview,
+                       response: int) -> int:
+        """
+        Store chat message in the recipient's offline mailbox
+        :param connection: connection the message was received from
+        :param target_nickname: recipient nickname
+        :param forward_bytes: message frame as received
+        :param response: response code for the sender if stored
+        :return: response code for the sender
+        """
+        if not self._mailbox.store(target_nickname, forward_bytes):
+            return jim.Responses.SERVER_ERROR
+        self._metrics.mailbox_stored += 1
+        if self._debug:
+            log.debug("Клиент %s:%d: Сообщение для %s сохранено для доставки", *connection.address, target_nickname)
+        return response
+
+    def _start_delivery(self, connection: Connection):
+        """
+        Start delivering stored messages to the connection - a batch every event loop iteration
+        :param connection: connection of the user having stored messages
+        """
+        log.info("Клиент %s:%d: Доставка сохраненных сообщений для %s (%d)",
+                 *connection.address, connection.nickname, self._mailbox.pending(connection.nickname))
+        self._deliveries[connection.nickname] = connection
+
+    def _deliver_batch(self, connection: Connection):
+        """
+        Send the next batch of stored messages to the connection, finish delivery if no messages left
+        :param connection: connection stored messages are being delivered to
+        """
+        frames = self._mailbox.take(connection.nickname, sett.MAILBOX_DELIVERY_BATCH)
+        for frame in frames:
+            self._broadcast(None, (connection,), data=frame, codec=jim.detect_codec(frame[jim.FRAME_HEADER.size:]))
+        self._metrics.mailbox_delivered += len(frames)
+        if not frames or not self._mailbox.pending(connection.nickname):
+            if frames:
+                log.info("Клиент %s:%d: Сохраненные сообщения доставлены", *connection.address)
+            del self._deliveries[connection.nickname]
+
+    def _deliver_stored_messages(self):
+        """ Deliver a batch of stored messages to every connection whose output has drained """
+        for connection in list(self._deliveries.values()):
+            if connection.output_size <= sett.OUTPUT_LOW_WATERMARK:
+                self._deliver_batch(connection)
+
+    def _login_required(self, connection: Connection, nickname: str) -> bool:
+        """
+        Check if the connection has to authenticate to use the nickname: registered users' nicknames
+        (all nicknames if sett.AUTH_REQUIRED) can't be used without authentication
+        :param connection: connection using the nickname
+        :param nickname: nickname
+        :return: True if authentication is required
+        """
+        if self._auth is None or connection.authenticated:
+            return False
+        return sett.AUTH_REQUIRED or self._auth.is_registered(nickname)
+
+    def _authenticate(self, connection: Connection, nickname: str, password: str, request_id: int | None):
+        """
+        Start checking the user's password in the authentication thread pool;
+        the connection is not read from until the check completes, then the response is sent
+        :param connection: connection authenticating
+        :param nickname: user nickname
+        :param password: password
+        :param request_id: id of the authenticate message to respond to
+        """
+        self._pause_reading(connection)
+        self._when_done(self._auth.verify(nickname, password),
+                        lambda future: self._complete_authentication(connection, nickname, request_id, future))
+
+    def _complete_authentication(self, connection: Connection, nickname: str, request_id: int | None,
+                                 future: concurrent.futures.Future):
+        """
+        Respond to the authenticate message when the password check completes
+        :param connection: connection authenticating
+        :param nickname: user nickname
+        :param request_id: id of the authenticate message to respond to
+        :param future: password check result
+        """
+        self._resume_reading(connection)
+        if connection.closing:
+            return
+        fields = None
+        try:
+            verified = future.result()
+        except Exception as e:
+            log.critical("Клиент %s:%d: Ошибка проверки пароля: %s", *connection.address, e)
+            response = jim.Responses.SERVER_ERROR
+        else:
+            if verified and self._check_nickname(connection, nickname):
+                log.info("Клиент %s:%d: Пользователь %s аутентифицирован", *connection.address, nickname)
+                connection.authenticated = True
+                response = jim.Responses.OK
+                fields = {jim.ResponseFields.TOKEN: self._auth.issue_token(nickname)}
+            else:
+                log.warning("Клиент %s:%d: Ошибка аутентификации пользователя %s", *connection.address, nickname)
+                response = jim.Responses.BAD_LOGIN
+        self._metrics.responses[response] += 1
+        self._send(connection, jim.RESPONSE_ENCODER.encode_frame(response, request_id=request_id,
+                                                                 codec=connection.codec, fields=fields), connection)
+
+    def _complete_history(self, connection: Connection, request_id: int | None, future: concurrent.futures.Future):
+        """
+        Send the history messages read in the query thread, followed by the response to the history request
+        with the cursor of the previous page
+        :param connection: connection requesting the history
+        :param request_id: id of the history request to respond to
+        :param future: history query result
+        """
+        if connection.closing:
+            return
+        fields = None
+        try:
+            frames, previous_page = future.result()
+        except Exception as e:
+            log.error("Клиент %s:%d: Ошибка чтения истории сообщений: %r", *connection.address, e)
+            frames = []
+            response = jim.Responses.SERVER_ERROR
+        else:
+            response = jim.Responses.OK
+            if previous_page is not None:
+                fields = {jim.ResponseFields.BEFORE: previous_page}
+        self._metrics.responses[response] += 1
+        frames.append(jim.RESPONSE_ENCODER.encode_frame(response, request_id=request_id, codec=connection.codec,
+                                                        fields=fields))
+        self._send(connection, b"".join(frames))
+
+    def _when_done(self, future: concurrent.futures.Future, callback):
+        """
+        Call the callback with the future in the event loop thread when the future completes in another thread
+        :param future: future
+        :param callback: function to call with the future
+        """
+        def done(completed_future: concurrent.futures.Future):
+            self._completions.append((callback, completed_future))
+            try:
+                self._wakeup_writer.send(b"\0")
+            except OSError:                 # buffer full - the loop is going to wake up anyway; or shut down
+                pass
+        future.add_done_callback(done)
+
+    def _process_completions(self):
+        """ Call the callbacks of the futures completed in other threads """
+        try:
+            while self._wakeup_reader.recv(sett.RECEIVE_BUFFER_SIZE):
+                pass
+        except BlockingIOError:
+            pass
+        while self._completions:
+            callback, future = self._completions.popleft()
+            callback(future)
+
+    def _process_frame_guarded(self, connection: Connection, frame: memoryview) -> bytes:
+        """
+        Process a single message (see _process_frame()), answering it with SERVER_ERROR if processing fails
+        unexpectedly, so that the other messages and connections are serviced as usual
+        """
+        try:
+            return self._process_frame(connection, frame)
+        except Exception as e:
+            log.critical("Клиент %s:%d: Непредвиденная ошибка при обработке сообщения: %r",
+                         *connection.address, e, exc_info=self._debug)
+            self._metrics.responses[jim.Responses.SERVER_ERROR] += 1
+            return jim.RESPONSE_ENCODER.encode_frame(jim.Responses.SERVER_ERROR, request_id=connection.request_id,
+                                                     codec=connection.codec)
+
+    def _process_frame(self, connection: Connection, frame: memoryview) -> bytes:
+        """
+        Process a single message received from the specified connection, forwarding it to other clients if needed.
+        Chat messages are checked for the routing fields only (unless sett.RELAY_FULL_VALIDATION is set)
+        and forwarded as received.
+        :param connection: connection the message was received from
+        :param frame: message frame extracted from the connection's data stream
+        :return: framed response to send back to the client, empty if it is to be sent later
+        """
+        response = None
+        request_id = None
+        response_fields = None
+        # Response is encoded with the codec used before this message, as presence can change it
+        codec = connection.codec
+        connection.request_id = None
+        data_bytes = bytes(frame[jim.FRAME_HEADER.size:])
+        try:
+            message = jim.Message.from_bytes(data_bytes, relay=not sett.RELAY_FULL_VALIDATION)
+        except ValueError as e:
+            log.error("Клиент %s:%d: Получены некорректные данные: %s", *connection.address, data_bytes)
+            self._metrics.messages[server_metrics.INVALID_ACTION] += 1
+            response = jim.Responses.BAD_REQUEST
+        else:
+            self._metrics.messages[message.action] += 1
+            if self._debug:
+                log.debug("Клиент %s:%d: Получено сообщение: %s", *connection.address, data_bytes)
+            # Responses are sent with the message id, so that the client can match them to its requests
+            request_id = connection.request_id = message.kwargs.get(jim.MessageFields.ID)
+
+            # ************ PRESENCE ***************
+            if message.action == jim.Actions.PRESENCE:
+                sender_nickname = message.kwargs[jim.MessageFields.USER][jim.MessageFields.ACCOUNT_NAME]
+                log.debug("Клиент %s:%d: Формирование ответа на сообщение присутствия", *connection.address)
+                # Session token issued before resumes the authenticated session without checking password
+                token = message.kwargs.get(jim.MessageFields.TOKEN)
+                if (token is not None and self._auth is not None and connection.nickname in ("", sender_nickname)
+                        and self._auth.resume(sender_nickname, token)):
+                    log.info("Клиент %s:%d: Пользователь %s аутентифицирован по токену сессии",
+                             *connection.address, sender_nickname)
+                    connection.authenticated = True
+                if self._login_required(connection, sender_nickname):
+                    log.debug("Клиент %s:%d: Требуется аутентификация пользователя %s",
+                              *connection.address, sender_nickname)
+                    response = jim.Responses.LOGIN_REQUIRED
+                elif not self._check_nickname(connection, sender_nickname):
+                    response = jim.Responses.BAD_LOGIN
+                else:
+                    response = jim.Responses.OK
+                    # Switch to the codec requested by the client, confirming it in the response
+                    requested_codec = message.kwargs.get(jim.MessageFields.CODEC)
+                    if requested_codec in sett.CODECS:
+                        log.debug("Клиент %s:%d: Кодирование сообщений: %s", *connection.address, requested_codec)
+                        connection.codec = requested_codec
+                        response_fields = {jim.ResponseFields.CODEC: requested_codec}
+
+            # ************ MESSAGE ***************
+            elif message.action == jim.Actions.MESSAGE:
+                sender_nickname = message.sender
+                if self._login_required(connection, sender_nickname):
+                    log.debug("Клиент %s:%d: Требуется аутентификация пользователя %s",
+                              *connection.address, sender_nickname)
+                    response = jim.Responses.LOGIN_REQUIRED
+                elif not self._check_nickname(connection, sender_nickname):
+                    log.debug("Клиент %s:%d: Формирование сообщения об ошибке аутентификации", *connection.address)
+                    response = jim.Responses.BAD_LOGIN
+                else:
+                    started = time.perf_counter()
+                    response = self._forward_message(connection, message.target, frame)
+                    self._metrics.fanout_latency.record(time.perf_counter() - started)
+                    # Routed messages are kept in the history, written by another thread
+                    if (response in (jim.Responses.OK, jim.Responses.GONE) and self._history is not None
+                            and not self._history.append(sender_nickname, message.target, data_bytes)):
+                        self._metrics.history_dropped += 1
+
+            # ************ AUTHENTICATE ***************
+            elif message.action == jim.Actions.AUTHENTICATE:
+                user = message.kwargs[jim.MessageFields.USER]
+                nickname = user[jim.MessageFields.ACCOUNT_NAME]
+                if self._auth is None:
+                    log.error("Клиент %s:%d: Аутентификация отключена", *connection.address)
+                    response = jim.Responses.BAD_REQUEST
+                elif connection.nickname and connection.nickname != nickname:
+                    log.debug("Клиент %s:%d: Аутентификация под другим именем (%s) после установки имени (%s)",
+                              *connection.address, nickname, connection.nickname)
+                    response = jim.Responses.BAD_LOGIN
+                elif connection.authenticated:
+                    response = jim.Responses.OK
+                else:
+                    log.debug("Клиент %s:%d: Проверка пароля пользователя %s", *connection.address, nickname)
+                    self._authenticate(connection, nickname, user[jim.MessageFields.PASSWORD], request_id)
+                    return b""
+
+            # ************ JOIN / LEAVE ***************
+            elif message.action in (jim.Actions.JOIN, jim.Actions.LEAVE):
+                room = message.kwargs[jim.MessageFields.ROOM]
+                if not connection.nickname:
+                    log.debug("Клиент %s:%d: Вход в чат или выход из чата до сообщения присутствия",
+                              *connection.address)
+                    response = jim.Responses.LOGIN_REQUIRED
+                elif room == jim.BROADCAST_MESSAGE_ADDRESS:
+                    log.debug("Клиент %s:%d: Вход в общий чат или выход из него невозможен", *connection.address)
+                    response = jim.Responses.BAD_REQUEST
+                elif message.action == jim.Actions.JOIN:
+                    log.debug("Клиент %s:%d: Вход в чат %s", *connection.address, room)
+                    self._join_room(connection, room)
+                    response = jim.Responses.OK
+                elif room not in connection.rooms:
+                    log.debug("Клиент %s:%d: Выход из чата %s, участником которого клиент не является",
+                              *connection.address, room)
+                    response = jim.Responses.NOT_FOUND
+                else:
+                    log.debug("Клиент %s:%d: Выход из чата %s", *connection.address, room)
+                    self._leave_room(connection, room)
+                    connection.rooms.discard(room)
+                    response = jim.Responses.OK
+
+            # ************ HISTORY ***************
+            elif message.action == jim.Actions.HISTORY:
+                peer = message.kwargs[jim.MessageFields.PEER]
+                limit = message.kwargs.get(jim.MessageFields.LIMIT, sett.HISTORY_QUERY_LIMIT)
+                before = message.kwargs.get(jim.MessageFields.BEFORE)
+                if not connection.nickname:
+                    log.debug("Клиент %s:%d: Запрос истории до сообщения присутствия", *connection.address)
+                    response = jim.Responses.LOGIN_REQUIRED
+                elif self._history is None:
+                    log.error("Клиент %s:%d: История сообщений отключена", *connection.address)
+                    response = jim.Responses.BAD_REQUEST
+                elif not 0 < limit <= sett.HISTORY_QUERY_MAX_LIMIT:
+                    log.error("Клиент %s:%d: Некорректное количество сообщений истории: %d", *connection.address, limit)
+                    response = jim.Responses.BAD_REQUEST
+                elif before is not None and not 0 < before <= server_history.NO_CURSOR:
+                    log.error("Клиент %s:%d: Некорректный курсор истории: %d", *connection.address, before)
+                    response = jim.Responses.BAD_REQUEST
+                elif request_id is not None and request_id not in server_history.REQUEST_ID_RANGE:
+                    log.error("Клиент %s:%d: Некорректный id запроса истории: %d", *connection.address, request_id)
+                    response = jim.Responses.BAD_REQUEST
+                elif (peer.startswith(jim.ROOM_PREFIX) and peer != jim.BROADCAST_MESSAGE_ADDRESS
+                      and peer not in connection.rooms):
+                    log.debug("Клиент %s:%d: Запрос истории чата %s, участником которого клиент не является",
+                              *connection.address, peer)
+                    response = jim.Responses.FORBIDDEN
+                else:
+                    log.debug("Клиент %s:%d: Запрос истории %s", *connection.address, peer)
+                    self._when_done(self._history.query(connection.nickname, peer, before, limit,
+                                                        connection.codec, request_id),
+                                    lambda future: self._complete_history(connection, request_id, future))
+                    return b""
+
+            # ************ UNKNOWN ***************
+            else:
+                log.error("Клиент %s:%d: Неподдерживаемый тип сообщения, формирование ответа", *connection.address)
+                response = jim.Responses.BAD_REQUEST
+
+        if response is None:
+            log.critical("Клиент %s:%d: Формирование сообщения об ошибке сервера по умолчанию", *connection.address)
+            response = jim.Responses.SERVER_ERROR
+        if self._debug:
+            log.debug("Клиент %s:%d: Отправка ответа: %d", *connection.address, response)
+        self._metrics.responses[response] += 1
+        return jim.RESPONSE_ENCODER.encode_frame(response, request_id=request_id, codec=codec, fields=response_fields)
+
+    def _process_event(self, key: selectors.SelectorKey, mask: int):
+        """
+        Process I/O readiness of the listening socket, wakeup socket or a connection:
+        accept new connections, call completion callbacks, receive and process messages, send buffered output.
+        If message exchange with the connection fails, close it and remove from the connections list.
+        """
+        # Accept pending connections - ACCEPT_BUDGET at most, the rest on the next iteration, so that
+        # a connection storm does not keep the connections being serviced waiting
+        if key.data is None:
+            for _ in range(sett.ACCEPT_BUDGET):
+                if not self._accept_connection():
+                    break
+            return
+        if key.data is _WAKEUP:
+            self._process_completions()
+            return
+        connection = key.data
+        # Skip connection if it has been closed (or is to be closed) while processing previous events
+        if connection.closing:
+            return
+        if mask & selectors.EVENT_WRITE and not self._flush_output(connection):
+            self._close_connection(connection)
+            return
+        if mask & selectors.EVENT_READ and not self._process_message(connection):
+            self._close_connection(connection)
+
     def _process_messages(self) -> bool:
         """
-        Process all the connections ready to communicate.
-        If message exchange with a given connection fails, close it and remove from the connections list.
+        Wait for I/O readiness of the listening socket and connections and process it (see _process_event()),
+        check heartbeats, deliver stored messages and send the output produced.
+        An unexpected error processing an event closes its connection only, the other events are processed
+        and the output is sent as usual.
         :return: False if exception occurs, True otherwise
         """
+        success = True
+        # Do not wait for events if stored messages are to be delivered
+        ready = any(connection.output_size <= sett.OUTPUT_LOW_WATERMARK for connection in self._deliveries.values())
         try:
-            read_ready, _, _ = select.select(self._connections, [], [], sett.SELECT_TIMEOUT)
-            if not read_ready:
-                log.debug("Нет новых запросов от существующих соединений.")
-            else:
-                for connection in read_ready:
-                    if not self._process_message(self._connections[connection]):
-                        connection.close()
-                        del self._connections[connection]
-        except select.error as e:
-            log.critical("Непредвиденная ошибка select(): %s", e)
-            return False
+            events = self._selector.select(0 if ready else sett.SELECT_TIMEOUT)
         except Exception as e:
-            log.critical("Непредвиденная ошибка при обработке сообщений клиентов: %s", e)
+            log.critical("Непредвиденная ошибка ожидания событий соединений: %s", e)
             return False
-        return True
+        started = time.perf_counter()
+        if not events and self._debug:
+            log.debug("Нет новых запросов от существующих соединений.")
+        try:
+            for key, mask in events:
+                try:
+                    self._process_event(key, mask)
+                except Exception as e:
+                    success = False
+                    log.critical("Непредвиденная ошибка при обработке событий соединения: %r", e, exc_info=self._debug)
+                    if isinstance(key.data, Connection) and not key.data.closing:
+                        self._close_connection(key.data)
+            if self._heartbeats is not None:
+                self._check_heartbeats()
+            if self._deliveries:
+                self._deliver_stored_messages()
+        except Exception as e:
+            success = False
+            log.critical("Непредвиденная ошибка при обработке сообщений клиентов: %r", e, exc_info=self._debug)
+        finally:
+            try:
+                # Send output produced during this iteration
+                self._flush_pending_output()
+            except Exception as e:
+                success = False
+                log.critical("Непредвиденная ошибка при отправке данных клиентам: %r", e, exc_info=self._debug)
+            # The events of the next iteration have been waiting for this one to complete
+            self._admission.lag = time.perf_counter() - started
+            if events:
+                self._metrics.loop_time.record(self._admission.lag)
+        return success
 
     def service_connections(self):
         """ Accept connections and process client messages """
         while True:
-            log.debug("Старт цикла обслуживания соединений.")
-            print("Существующие соединения: ", end="")
-            print([(connection.address, connection.nickname) for connection in self._connections.values()])
-            # Accept all pending connections
-            while self._accept_connection():
-                pass
+            if self._debug:
+                log.debug("Старт цикла обслуживания соединений, соединений: %d", len(self._connections))
             self._process_messages()
 
     def shutdown(self):
-        if self._listening:
-            log.critical("Завершение работы чат-сервера")
-            self._socket.close()
-            self._listening = False
+        try:
+            if self._listening:
+                log.critical("Завершение работы чат-сервера")
+                for connection in list(self._connections.values()):
+                    self._close_connection(connection)
+                self._selector.close()
+                self._socket.close()
+                self._listening = False
+        finally:
+            self._stop_services()
+
+    def _stop_services(self):
+        """ Write the queued messages to the mailbox and history and stop their threads, whatever fails """
+        closers = [service.close for service in (self._mailbox, self._history) if service is not None]
+        if self._auth is not None:
+            closers.append(self._auth.shutdown)
+        closers += [self._wakeup_reader.close, self._wakeup_writer.close]
+        self._mailbox = self._history = self._auth = None
+        for close in closers:
+            try:
+                close()
+            except Exception as e:
+                log.critical("Ошибка при завершении работы сервера: %r", e)
+
+
+def data_path(path: str | None, name: str, default: str) -> str:
+    """
+    Return path of a server file
+    :param path: path given by the command-line option, None if not given
+    :param name: file name in the data directory (sett.DATA_DIRECTORY)
+    :param default: path if neither given nor the data directory is
+    :return: path, empty if the file is not kept
+    """
+    if path is not None:
+        return path
+    return os.path.join(sett.DATA_DIRECTORY, name) if sett.DATA_DIRECTORY else default
 
 
 def main() -> bool:
@@ -281,13 +1139,55 @@ def main() -> bool:
     parser = argparse.ArgumentParser()
     parser.add_argument('-address', required=False)
     parser.add_argument('-port', required=False)
+    parser.add_argument('-asyncio', action='store_true', help="use asyncio event loop to service connections")
+    parser.add_argument('-workers', type=int, default=1,
+                        help="number of worker processes sharing the port (select() event loop in every worker)")
+    parser.add_argument('-max_connections', type=int, default=sett.MAX_CONNECTIONS,
+                        help="maximum number of client connections (of every worker)")
+    parser.add_argument('-metrics_port', type=int, default=sett.METRICS_PORT,
+                        help="port of HTTP metrics endpoint, 0 - disabled (worker N listens on port + N)")
+    parser.add_argument('-data', default=sett.DATA_DIRECTORY,
+                        help="directory to keep the offline messages store, message history and users in, "
+                             "empty - none of them is kept unless given by the options below")
+    parser.add_argument('-mailbox', help=f"offline messages store directory (default DATA/{sett.DATA_MAILBOX}), "
+                                         "empty - messages to offline users are not stored (not supported with -workers)")
+    parser.add_argument('-history', help=f"message history database (default DATA/{sett.DATA_HISTORY}), "
+                                         "empty - history is not kept")
+    parser.add_argument('-users', help=f"users' credentials file (default DATA/{sett.DATA_USERS}), "
+                                       "empty - users are not authenticated")
+    parser.add_argument('-heartbeat', type=float, default=sett.HEARTBEAT_INTERVAL,
+                        help="client silence to send probe after, seconds; 0 - clients are not probed")
     args = parser.parse_args()
+    sett.MAX_CONNECTIONS = args.max_connections
+    sett.METRICS_PORT = args.metrics_port
+    sett.DATA_DIRECTORY = args.data
+    sett.MAILBOX_DIRECTORY = data_path(args.mailbox, sett.DATA_MAILBOX, sett.MAILBOX_DIRECTORY)
+    sett.HISTORY_DATABASE = data_path(args.history, sett.DATA_HISTORY, sett.HISTORY_DATABASE)
+    sett.AUTH_USERS_FILE = data_path(args.users, sett.DATA_USERS, sett.AUTH_USERS_FILE)
+    if sett.DATA_DIRECTORY:
+        try:
+            os.makedirs(sett.DATA_DIRECTORY, exist_ok=True)
+        except OSError as e:
+            log.critical("Не удалось создать каталог данных сервера %s: %s", sett.DATA_DIRECTORY, e)
+            return False
+    sett.HEARTBEAT_INTERVAL = args.heartbeat
+    if args.workers > 1:
+        import server_workers           # imported on demand as it depends on this module
+        log.debug("Запуск %d рабочих процессов для приема соединений по адресу (%s:%s)",
+                  args.workers, args.address, args.port)
+        return server_workers.run_workers(args.address, args.port, args.workers)
     # Initialize server
     log.debug("Инициализация сервера для приема соединений по адресу (%s:%s)", args.address, args.port)
-    server = Server(args.address, args.port)
+    if args.asyncio:
+        import server_asyncio           # imported on demand as it depends on this module
+        server = server_asyncio.AsyncServer(args.address, args.port)
+    else:
+        server = Server(args.address, args.port)
     if not server.listening:
         log.critical("Не удалось инициализировать сервер, приложение завершается")
         return False
+    if sett.METRICS_PORT:
+        server_metrics.serve_metrics(server.metrics, sett.METRICS_ADDRESS, sett.METRICS_PORT)
     # Process chat connections
     try:
         server.service_connections()
@@ -300,9 +1200,8 @@ def main() -> bool:
         # Shut down server
         server.shutdown()
     log.debug("Приложение завершило работу")
+    return True
 
 
 if __name__ == "__main__":
-    # Initialize logger
-    log = logging.getLogger(sett.LOG_NAME)
     exit(0 if main() else -1)
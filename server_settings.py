@@ -9,10 +9,62 @@ DEFAULT_ENCODING = 'UTF-8'              # Default encoding for JIM messages
 
 # The following are settings unique to server
 DEFAULT_LISTEN_ADDRESS = ''             # IP address for server to listen on
-SOCKET_TIMEOUT = 0.2                    # Server socket timeout while waiting for client connections
 MAX_CONNECTIONS = 2                     # Maximum number of client connections
+LISTEN_BACKLOG = 128                    # Connections pending accept at most (capped by the OS, e.g. net.core.somaxconn)
+ACCEPT_BUDGET = 64                      # Connections accepted at most per listening socket readiness event
+ACCEPT_RATE = 0                         # Connections admitted per second at most (see server_admission); 0 - no limit
+ACCEPT_BURST = 100                      # Connections admitted at once at most with ACCEPT_RATE
+ADMISSION_LAG_THRESHOLD = 0.5           # Event loop lag to reject new connections above (overload), seconds; 0 - never
+ADMISSION_LAG_INTERVAL = 0.1            # Event loop lag measurement interval (asyncio), seconds
 CLIENT_CONNECTION_TIMEOUT = 0           # Client connection timeout in seconds - there will be no timeout
-SELECT_TIMEOUT = 1.0                    # Server timeout for select.select() function waiting for clients
+HEARTBEAT_INTERVAL = 30.0               # Client silence to send probe after (and between probes), seconds; 0 - never
+HEARTBEAT_MISSES = 3                    # Probes left unanswered to close the client connection after
+HEARTBEAT_TICK = 1.0                    # Heartbeat timers precision, seconds
+SELECT_TIMEOUT = 1.0                    # Server timeout for selector waiting for connections and clients
+RECEIVE_BUFFER_SIZE = 65536             # Max bytes to receive from client at once - may contain several messages
+CODECS = ('json', 'binary')             # Message encodings clients can request in presence (see jim.CODECS)
+RELAY_FULL_VALIDATION = False           # Validate whole chat messages, not only the fields to route them by
+METRICS_ADDRESS = '127.0.0.1'           # IP address for the metrics HTTP endpoint to listen on
+METRICS_PORT = 0                        # Metrics HTTP endpoint port, 0 - disabled; worker N listens on the port + N
+METRICS_HISTOGRAM_LOWEST = 1e-6         # Latency histograms: first bucket upper bound, seconds
+METRICS_HISTOGRAM_HIGHEST = 10.0        # Latency histograms: last bucket upper bound, seconds
+METRICS_HISTOGRAM_SUB_BUCKETS = 4       # Latency histograms: buckets per power of two
+# Output queued for a connection above the high watermark makes it a slow consumer: the output policy
+# of its connection class is applied; below the low watermark it is not slow anymore
+OUTPUT_HIGH_WATERMARK = 256 * 1024      # bytes
+OUTPUT_LOW_WATERMARK = 64 * 1024        # bytes
+OUTPUT_DROP_OLDEST = 'drop_oldest'      # Output policy: drop the oldest queued messages down to the low watermark
+OUTPUT_DISCONNECT = 'disconnect'        # Output policy: close the slow connection
+OUTPUT_PAUSE = 'pause'                  # Output policy: stop reading from the connections sending to it until it drains
+OUTPUT_POLICIES = {                     # Output policy by connection class
+    'client': OUTPUT_DISCONNECT,        # client connections
+    'worker': OUTPUT_PAUSE              # worker bus connections (see server_workers) - bus messages are never lost
+}
+DATA_DIRECTORY = ''                     # Server files directory (-data), '' - none: no mailbox, history or users kept
+DATA_MAILBOX = 'mailbox'                # Offline messages store directory in DATA_DIRECTORY (unless -mailbox)
+DATA_HISTORY = 'history.db'             # Message history database in DATA_DIRECTORY (unless -history)
+DATA_USERS = 'users.json'               # Users' credentials store in DATA_DIRECTORY (unless -users)
+MAILBOX_DIRECTORY = ''                  # Offline messages store directory (see server_mailbox), '' - disabled
+MAILBOX_SEGMENT_SIZE = 64 * 2 ** 20     # Offline messages store segment file size, bytes
+MAILBOX_DELIVERY_BATCH = 100            # Stored messages delivered to a connection per event loop iteration
+MAILBOX_QUEUE_SIZE = 50000              # Messages waiting to be written to the offline store, the ones above are refused
+MAILBOX_INDEX_FILES = 1024              # Recipients' index files the offline store writer keeps open
+HISTORY_DATABASE = ''                   # Message history database (see server_history), '' - history not kept
+HISTORY_BATCH_SIZE = 1000               # Maximum number of messages written to the history with one transaction
+HISTORY_BATCH_INTERVAL = 0.01           # Maximum time to collect messages to write with one transaction, seconds
+HISTORY_QUEUE_SIZE = 50000              # Messages waiting to be written to the history, the ones above are dropped
+HISTORY_RETENTION = 30 * 24 * 60 * 60   # Time to keep messages in the history for, seconds; 0 - forever
+HISTORY_CLEANUP_INTERVAL = 10 * 60      # Interval of deleting expired messages from the history, seconds
+HISTORY_QUERY_WORKERS = 2               # Threads running history queries
+HISTORY_QUERY_LIMIT = 50                # Messages sent in response to a history request without limit
+HISTORY_QUERY_MAX_LIMIT = 100           # Maximum messages sent in response to a history request
+AUTH_USERS_FILE = ''                    # Users' credentials store (see server_auth), '' - authentication disabled
+AUTH_REQUIRED = False                   # Require authentication for all nicknames, not only for the registered ones
+AUTH_HASH = 'scrypt'                    # Password hash for new passwords: 'scrypt' or 'pbkdf2_sha256'
+AUTH_WORKERS = 4                        # Threads checking passwords
+AUTH_RELOAD_INTERVAL = 1.0              # Seconds to check the credentials file for changes after (in the threads)
+AUTH_TOKEN_CACHE_SIZE = 100000          # Session tokens kept, the least recently used ones are forgotten first
+AUTH_TOKEN_TTL = 24 * 60 * 60           # Session token lifetime, seconds
 
 DIRECTORY_SEPARATOR = '/'
 
@@ -27,3 +79,5 @@ LOG_FILE_NAME = DIRECTORY_SEPARATOR.join((LOG_DIRECTORY, 'server.log'))
 LOG_FILE_BACKUP_DAYS_COUNT = 10       # Log backup days for daily logs
 LOG_FILE_LEVEL = logging.NOTSET
 LOG_FILE_FORMAT = "%(asctime)s %(levelname)-10s %(module)s %(message)s"
+# Write log in a separate thread, so that file and console output do not delay servicing connections
+LOG_QUEUE = True
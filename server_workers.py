@@ -0,0 +1,315 @@
+"""
+Multi-process chat server: several worker processes listen on the same port (SO_REUSEPORT),
+the kernel distributes incoming connections among them.
+Every worker services its own connections and routes messages to the other workers' users over the worker bus -
+a full mesh of Unix socket pairs created before the workers are forked.
+Workers tell each other which nicknames and chat rooms they have, so direct and room messages are forwarded
+only to the workers having the recipients; messages to all users are forwarded to every worker.
+"""
+import os
+import sys
+import signal
+import struct
+import socket as sock
+import selectors
+
+import jim
+
+import server_settings as sett
+import server_log_config
+import server_metrics
+from server_select import Server, Connection, log
+
+# Worker bus frame: kind, name length, name (nickname or room), for forwarded messages followed by message payload
+BUS_HEADER = struct.Struct("!cH")
+BUS_MAX_FRAME_LEN = 2 ** (8 * jim.FRAME_HEADER.size) - 1
+BUS_MESSAGE = b"M"              # chat message to forward to the named recipients
+BUS_NICKNAME_UP = b"U"          # first connection with the nickname appeared on the worker
+BUS_NICKNAME_DOWN = b"D"        # last connection with the nickname closed on the worker
+BUS_ROOM_UP = b"J"              # chat room appeared on the worker
+BUS_ROOM_DOWN = b"L"            # chat room disappeared from the worker
+WORKER_ADDRESS = "worker"       # worker bus connection address is (WORKER_ADDRESS, worker number)
+WORKER_CONNECTION_CLASS = "worker"  # worker bus connection class (see server_settings.OUTPUT_POLICIES)
+
+
+def bus_frame(kind: bytes, name: str, payload: bytes = b"") -> bytes:
+    """
+    Encode worker bus frame
+    :param kind: frame kind (BUS_...)
+    :param name: nickname or room name
+    :param payload: (optional) message payload to forward
+    :return: framed data ready to be sent to workers
+    """
+    name_bytes = name.encode(sett.DEFAULT_ENCODING)
+    return jim.frame(BUS_HEADER.pack(kind, len(name_bytes)) + name_bytes + payload, max_length=BUS_MAX_FRAME_LEN)
+
+
+class WorkerServer(Server):
+    """
+    Chat server worker process - services connections accepted on the shared port
+    and exchanges messages with the other workers
+    """
+    def __init__(self, address: str = None, port: str = None, number: int = 0, bus: dict = None):
+        """
+        Initialize worker - open shared port for listening and start waiting for the other workers' data
+        :param address: server IP address
+        :param port: server port
+        :param number: worker number
+        :param bus: worker bus sockets by the other workers' numbers
+        Attributes:
+        _number - worker number
+        _peers - other workers' bus connections dictionary
+        _remote_nicknames - other workers' bus connections index by nicknames of users connected to them
+        _remote_rooms - other workers' bus connections index by chat rooms having members connected to them
+        """
+        # Workers can't share the offline messages store
+        super().__init__(address, port, reuse_port=True, offline_mailbox=False)
+        self._number = number
+        self._peers = {}
+        self._remote_nicknames = {}
+        self._remote_rooms = {}
+        for peer_number, bus_socket in (bus or {}).items():
+            bus_socket.setblocking(False)
+            peer = Connection(
+                connection=bus_socket,
+                address=(WORKER_ADDRESS, peer_number),
+                nickname="",
+                decoder=jim.FrameDecoder(max_length=BUS_MAX_FRAME_LEN),
+                policy=sett.OUTPUT_POLICIES[WORKER_CONNECTION_CLASS]
+            )
+            self._peers[bus_socket] = peer
+            self._selector.register(bus_socket, selectors.EVENT_READ, peer)
+
+    def _publish(self, peers, data: bytes, sender: Connection = None):
+        """
+        Queue bus frame to the given workers
+        :param peers: worker bus connections
+        :param data: bus frame
+        :param sender: client connection the frame is sent on behalf of - paused if a worker does not keep up
+        """
+        self._broadcast(sender, peers, data=data)
+
+    def _close_connection(self, connection: Connection):
+        """
+        Close client or worker bus connection and forget it
+        :param connection: connection to close
+        """
+        if connection.connection not in self._peers:
+            super()._close_connection(connection)
+            return
+        log.critical("Рабочий процесс %d: Соединение с рабочим процессом %d закрыто",
+                     self._number, connection.address[1])
+        connection.closing = True
+        if connection.events:
+            self._selector.unregister(connection.connection)
+        self._output_pending.discard(connection)
+        del self._peers[connection.connection]
+        self._resume_senders(connection)
+        for index in (self._remote_nicknames, self._remote_rooms):
+            for name in [name for name, peers in index.items() if connection in peers]:
+                self._remote_index_discard(index, name, connection)
+        connection.connection.close()
+
+    def _forget_connection(self, connection: Connection):
+        """ Remove closed connection from the connections indexes, tell workers if its nickname is gone """
+        super()._forget_connection(connection)
+        if connection.nickname and connection.nickname not in self._nicknames:
+            self._publish(self._peers.values(), bus_frame(BUS_NICKNAME_DOWN, connection.nickname))
+
+    def _check_nickname(self, connection: Connection, nickname: str) -> bool:
+        """ Check and assign connection's nickname (see Server), tell workers if the nickname is new here """
+        known = nickname in self._nicknames
+        result = super()._check_nickname(connection, nickname)
+        if not known and nickname in self._nicknames:
+            self._publish(self._peers.values(), bus_frame(BUS_NICKNAME_UP, nickname))
+        return result
+
+    def _join_room(self, connection: Connection, room: str):
+        """ Add connection to chat room members, tell workers if the room is new here """
+        if room not in self._rooms:
+            self._publish(self._peers.values(), bus_frame(BUS_ROOM_UP, room))
+        super()._join_room(connection, room)
+
+    def _leave_room(self, connection: Connection, room: str):
+        """ Remove connection from chat room members, tell workers if the room is gone """
+        super()._leave_room(connection, room)
+        if room not in self._rooms:
+            self._publish(self._peers.values(), bus_frame(BUS_ROOM_DOWN, room))
+
+    def _forward_message(self, connection: Connection, target_nickname: str, forward_bytes: memoryview) -> int:
+        """
+        Forward a chat message to its recipients connected both to this and to the other workers
+        :param connection: connection the message was received from
+        :param target_nickname: message TO address
+        :param forward_bytes: message frame as received
+        :return: response code for the sender
+        """
+        if target_nickname == jim.BROADCAST_MESSAGE_ADDRESS:
+            peers = self._peers.values()
+        elif target_nickname.startswith(jim.ROOM_PREFIX):
+            # Room membership is checked here - the sender is a member only if the room exists on this worker
+            if target_nickname not in self._rooms:
+                if target_nickname in self._remote_rooms:
+                    log.debug("Клиент %s:%d: Формирование сообщения 'отправитель не участник чата %s'",
+                              *connection.address, target_nickname)
+                    return jim.Responses.FORBIDDEN
+                return super()._forward_message(connection, target_nickname, forward_bytes)
+            if connection not in self._rooms[target_nickname]:
+                return super()._forward_message(connection, target_nickname, forward_bytes)
+            peers = self._remote_rooms.get(target_nickname, ())
+        else:
+            peers = self._remote_nicknames.get(target_nickname, ())
+        if peers:
+            log.debug("Клиент %s:%d: Пересылка сообщения для %s рабочим процессам (%d)",
+                      *connection.address, target_nickname, len(peers))
+            self._publish(peers, bus_frame(BUS_MESSAGE, target_nickname, forward_bytes[jim.FRAME_HEADER.size:]),
+                          connection)
+        response = super()._forward_message(connection, target_nickname, forward_bytes)
+        # Recipients on the other workers only are not an error
+        return jim.Responses.OK if peers and response == jim.Responses.NOT_FOUND else response
+
+    def _process_data(self, connection: Connection, data_bytes: bytes) -> bool:
+        """
+        Process all the complete messages in the data received from a client or worker bus connection
+        :param connection: connection the data was received from
+        :param data_bytes: received data
+        :return: True if succeeded, False if failed for some reason
+        """
+        if connection.connection not in self._peers:
+            return super()._process_data(connection, data_bytes)
+        try:
+            for data in connection.decoder.feed(data_bytes):
+                self._process_bus_frame(connection, data)
+        except (ValueError, struct.error) as e:
+            log.critical("Рабочий процесс %d: Нарушен формат данных рабочего процесса %d: %s",
+                         self._number, connection.address[1], e)
+            return False
+        return True
+
+    def _process_bus_frame(self, peer: Connection, data: bytes):
+        """
+        Process a single worker bus frame - deliver forwarded message to the local recipients or update remote indexes
+        :param peer: worker bus connection the frame was received from
+        :param data: frame payload
+        """
+        kind, name_length = BUS_HEADER.unpack_from(data)
+        payload_start = BUS_HEADER.size + name_length
+        name = data[BUS_HEADER.size:payload_start].decode(sett.DEFAULT_ENCODING)
+        if kind == BUS_MESSAGE:
+            if name == jim.BROADCAST_MESSAGE_ADDRESS:
+                recipients = self._connections.values()
+            elif name.startswith(jim.ROOM_PREFIX):
+                recipients = self._rooms.get(name, ())
+            else:
+                recipients = self._nicknames.get(name, ())
+            payload = data[payload_start:]
+            count = self._broadcast(None, recipients, data=jim.frame(payload), codec=jim.detect_codec(payload))
+            log.debug("Рабочий процесс %d: Пересылка сообщения от рабочего процесса %d для %s (%d)",
+                      self._number, peer.address[1], name, count)
+        elif kind == BUS_NICKNAME_UP:
+            self._remote_nicknames.setdefault(name, set()).add(peer)
+        elif kind == BUS_NICKNAME_DOWN:
+            self._remote_index_discard(self._remote_nicknames, name, peer)
+        elif kind == BUS_ROOM_UP:
+            self._remote_rooms.setdefault(name, set()).add(peer)
+        elif kind == BUS_ROOM_DOWN:
+            self._remote_index_discard(self._remote_rooms, name, peer)
+        else:
+            raise ValueError(f"Unknown worker bus frame kind: {kind}")
+
+    @staticmethod
+    def _remote_index_discard(index: dict, name: str, peer: Connection):
+        """ Remove worker from the remote index entry, removing the entry if no workers left """
+        peers = index.get(name)
+        if peers is not None:
+            peers.discard(peer)
+            if not peers:
+                del index[name]
+
+    def shutdown(self):
+        super().shutdown()
+        for peer in self._peers.values():
+            peer.connection.close()
+        self._peers.clear()
+
+
+def _run_worker(address: str, port: str, number: int, bus: dict) -> bool:
+    """
+    Run worker process until interrupted or terminated
+    :return: True if worker has been shut down normally, False on error
+    """
+    # Terminate gracefully when the parent process stops the workers
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    server = WorkerServer(address, port, number, bus)
+    if not server.listening:
+        log.critical("Рабочий процесс %d: Не удалось инициализировать сервер", number)
+        return False
+    if sett.METRICS_PORT:
+        server_metrics.serve_metrics(server.metrics, sett.METRICS_ADDRESS, sett.METRICS_PORT + number)
+    try:
+        server.service_connections()
+    except (KeyboardInterrupt, SystemExit):
+        log.critical("Рабочий процесс %d: Обработка входящих соединений прервана", number)
+    except Exception as e:
+        log.critical("Рабочий процесс %d: Непредвиденная ошибка при обработке входящего соединения: %s", number, e)
+        return False
+    finally:
+        server.shutdown()
+    return True
+
+
+def run_workers(address: str, port: str, workers: int) -> bool:
+    """
+    Fork worker processes servicing connections on the same port and wait until any of them stops,
+    then stop the others
+    :param address: server IP address
+    :param port: server port
+    :param workers: number of worker processes
+    :return: True if all the workers have been shut down normally, False on error
+    """
+    if not hasattr(os, 'fork') or not hasattr(sock, 'SO_REUSEPORT'):
+        log.critical("Запуск нескольких рабочих процессов не поддерживается на этой платформе")
+        return False
+    # Worker bus - a socket pair for every pair of workers
+    buses = [{} for _ in range(workers)]
+    for first in range(workers):
+        for second in range(first + 1, workers):
+            buses[first][second], buses[second][first] = sock.socketpair(sock.AF_UNIX, sock.SOCK_STREAM)
+    pids = []
+    for number in range(workers):
+        pid = os.fork()
+        if pid == 0:
+            server_log_config.restart_log_listener()
+            # Keep own bus sockets only
+            for other, bus in enumerate(buses):
+                if other != number:
+                    for bus_socket in bus.values():
+                        bus_socket.close()
+            success = _run_worker(address, port, number, buses[number])
+            server_log_config.stop_log_listener()
+            os._exit(0 if success else 1)
+        pids.append(pid)
+        log.info("Запущен рабочий процесс %d (pid %d)", number, pid)
+    for bus in buses:
+        for bus_socket in bus.values():
+            bus_socket.close()
+    # A worker stopping breaks the chat for its users - stop all the workers, also when terminated itself
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    success = True
+    try:
+        pid, status = os.wait()
+        pids.remove(pid)
+        success = os.waitstatus_to_exitcode(status) == 0
+    except KeyboardInterrupt:       # workers are interrupted too, as they are in the same process group
+        log.critical("Работа рабочих процессов прервана по команде с клавиатуры")
+    except SystemExit:
+        log.critical("Завершение работы рабочих процессов")
+    for pid in pids:
+        try:
+            os.kill(pid, signal.SIGTERM)
+        except ProcessLookupError:
+            pass
+    for pid in pids:
+        _, status = os.waitpid(pid, 0)
+        success = success and os.waitstatus_to_exitcode(status) == 0
+    return success
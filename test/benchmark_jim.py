@@ -0,0 +1,91 @@
+"""
+Benchmarks of the JIM protocol module jim.py hot paths.
+Run from the test/ directory: python benchmark_jim.py
+"""
+import json
+import timeit
+
+# Necessary to import from parent directory
+import sys
+sys.path.insert(0, '..')
+
+import jim
+
+REPEAT = 5
+NUMBER = 20000
+
+MESSAGES = {
+    "presence": {"action": "presence", "time": 1653130045655173000, "type": "status",
+                 "user": {"account_name": "test", "status": "Online"}},
+    "msg": {"action": "msg", "time": 1653130045655173000, "to": "#all", "from": "test",
+            "message": "Hello, world!"},
+    "invalid msg": {"action": "msg", "time": 1653130045655173000, "to": "#all", "from": "test"},
+}
+
+RESPONSES = {
+    "response OK": {"response": 200, "time": 1653128454136720000, "alert": "OK"},
+    "response NOT_FOUND": {"response": 404, "time": 1653128454136720000, "error": "Not found"},
+}
+
+
+def best_time_us(function) -> float:
+    """ Return best time of a single call in microseconds """
+    return min(timeit.repeat(function, repeat=REPEAT, number=NUMBER)) / NUMBER * 1e6
+
+
+def validate(check, message: dict):
+    """ Return validation function ignoring validation errors """
+    def function():
+        try:
+            check(message)
+        except ValueError:
+            pass
+    return function
+
+
+def print_result(name: str, baseline_us: float, current_us: float):
+    print(f"{name:<25}{baseline_us:>12.2f}{current_us:>12.2f}{baseline_us / current_us:>10.1f}x")
+
+
+def benchmark_validation():
+    print(f"{'Validation':<25}{'check_message':>12}{'schema':>12}{'speedup':>11}")
+    print(f"{'':<25}{'(us)':>12}{'(us)':>12}")
+    for name, message in MESSAGES.items():
+        print_result(name,
+                     best_time_us(validate(lambda m: jim.check_message(m, jim.MESSAGE_FIELDS,
+                                                                       jim.MessageFields.ACTION), message)),
+                     best_time_us(validate(jim.MESSAGE_SCHEMA.check, message)))
+    for name, response in RESPONSES.items():
+        print_result(name,
+                     best_time_us(validate(lambda m: jim.check_message(m, jim.RESPONSE_FIELDS,
+                                                                       jim.ResponseFields.RESPONSE), response)),
+                     best_time_us(validate(jim.RESPONSE_SCHEMA.check, response)))
+
+
+def benchmark_response_encoding():
+    print(f"{'Response encoding':<25}{'Response':>12}{'encoder':>12}{'speedup':>11}")
+    print(f"{'':<25}{'(us)':>12}{'(us)':>12}")
+    for code in (jim.Responses.OK, jim.Responses.NOT_FOUND):
+        print_result(code.name,
+                     best_time_us(lambda: jim.frame(jim.Response(**code.response).json.encode())),
+                     best_time_us(lambda: jim.RESPONSE_ENCODER.encode_frame(code)))
+
+
+def benchmark_codecs():
+    print(f"{'Decoding':<25}{'json':>12}{'binary':>12}{'speedup':>11}{'json (B)':>10}{'binary (B)':>11}")
+    print(f"{'':<25}{'(us)':>12}{'(us)':>12}")
+    for name, message in {**MESSAGES, **RESPONSES}.items():
+        json_payload = json.dumps(message).encode()
+        binary_payload = jim.encode_binary(message)
+        json_us = best_time_us(lambda: jim.decode(json_payload))
+        binary_us = best_time_us(lambda: jim.decode(binary_payload))
+        print(f"{name:<25}{json_us:>12.2f}{binary_us:>12.2f}{json_us / binary_us:>10.1f}x"
+              f"{len(json_payload):>10}{len(binary_payload):>11}")
+
+
+if __name__ == "__main__":
+    benchmark_validation()
+    print()
+    benchmark_response_encoding()
+    print()
+    benchmark_codecs()
@@ -0,0 +1,150 @@
+"""
+Benchmarks of the chat server server_select.py hot paths.
+Run from the test/ directory: python benchmark_server.py [number of clients ...]
+Clients are simulated with socket pairs, so twice as many file descriptors as clients are needed.
+"""
+import os
+import time
+import socket
+import shutil
+import tempfile
+import logging
+import resource
+import argparse
+import statistics
+
+# Necessary to import from parent directory
+import sys
+sys.path.insert(0, '..')
+
+import jim
+import server_settings as sett
+import server_select
+
+ROUNDS = 20
+DEFAULT_CLIENTS = (1000, 10000)
+RELAY_MESSAGES = 200
+
+
+def raise_file_limit(required: int) -> bool:
+    """ Raise open files limit up to the hard limit, return True if it is enough """
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if hard != resource.RLIM_INFINITY and hard < required:
+        return False
+    if soft != resource.RLIM_INFINITY and soft < required:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (required, hard))
+    return True
+
+
+def drain(sockets: list):
+    """ Read everything the server has sent to simulated clients """
+    for client in sockets:
+        try:
+            while client.recv(65536):
+                pass
+        except BlockingIOError:
+            pass
+
+
+def benchmark_broadcast(clients: int):
+    server = server_select.Server("127.0.0.1", "0", offline_mailbox=False, message_history=False)
+    sockets = []
+    connections = []
+    for number in range(clients):
+        server_end, client_end = socket.socketpair()
+        client_end.setblocking(False)
+        sockets.append(client_end)
+        connections.append(server._register_connection(server_end, ("127.0.0.1", number)))
+    sender = connections[0]
+    data = jim.frame(jim.Message(**{jim.MessageFields.ACTION: jim.Actions.MESSAGE,
+                                    jim.MessageFields.TO: jim.BROADCAST_MESSAGE_ADDRESS,
+                                    jim.MessageFields.FROM: "sender",
+                                    jim.MessageFields.MESSAGE: "Hello, world!"}).json.encode())
+    route_times, flush_times, send_times = [], [], []
+    try:
+        for _ in range(ROUNDS):
+            # Route and queue to all the recipients, then flush all the output buffers
+            start = time.perf_counter()
+            server._process_data(sender, data)
+            routed = time.perf_counter()
+            server._flush_pending_output()
+            flushed = time.perf_counter()
+            route_times.append(routed - start)
+            flush_times.append(flushed - routed)
+            drain(sockets)
+            # Baseline - one send() per recipient as the message arrives
+            start = time.perf_counter()
+            for connection in connections[1:]:
+                connection.connection.send(data)
+            send_times.append(time.perf_counter() - start)
+            drain(sockets)
+    finally:
+        for client in sockets:
+            client.close()
+        server.shutdown()
+    route_ms, flush_ms, send_ms = (statistics.median(times) * 1000 for times in (route_times, flush_times, send_times))
+    print(f"{clients:>10}{route_ms:>12.2f}{flush_ms:>12.2f}{route_ms + flush_ms:>12.2f}"
+          f"{(route_ms + flush_ms) * 1000 / clients:>12.2f}{send_ms:>12.2f}")
+
+
+def benchmark_relay(messages: int, history: bool):
+    """
+    Direct messages pipelined in one chunk of received data: time to route one message and queue the reply
+    (with the message appended to the history, written by another thread, if history is True)
+    """
+    directory = tempfile.mkdtemp()
+    sett.HISTORY_DATABASE = os.path.join(directory, "history.db")
+    server = server_select.Server("127.0.0.1", "0", offline_mailbox=False, message_history=history)
+    sockets = []
+    connections = []
+    for nickname in ("sender", "recipient"):
+        server_end, client_end = socket.socketpair()
+        client_end.setblocking(False)
+        sockets.append(client_end)
+        connection = server._register_connection(server_end, ("127.0.0.1", len(connections)))
+        server._check_nickname(connection, nickname)
+        connections.append(connection)
+    # Message texts of various lengths up to the maximum
+    data = b"".join(jim.frame(jim.Message(**{jim.MessageFields.ACTION: jim.Actions.MESSAGE,
+                                             jim.MessageFields.TO: "recipient",
+                                             jim.MessageFields.FROM: "sender",
+                                             jim.MessageFields.MESSAGE: "x" * (number * 5 % jim.MESSAGE_FIELD_MAX_LENGTH),
+                                             jim.MessageFields.ID: number}).json.encode())
+                    for number in range(messages))
+    times = []
+    try:
+        for _ in range(ROUNDS):
+            start = time.perf_counter()
+            server._process_data(connections[0], data)
+            times.append(time.perf_counter() - start)
+            server._flush_pending_output()
+            drain(sockets)
+    finally:
+        for client in sockets:
+            client.close()
+        server.shutdown()
+        shutil.rmtree(directory)
+    print(f"{messages:>10}{'yes' if history else 'no':>12}{statistics.median(times) * 1e6 / messages:>12.2f}"
+          f"{len(data) / statistics.median(times) / 2 ** 20:>12.1f}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('clients', nargs='*', type=int, default=DEFAULT_CLIENTS)
+    args = parser.parse_args()
+    logging.getLogger(sett.LOG_NAME).setLevel(logging.WARNING)
+    logging.getLogger().setLevel(logging.WARNING)
+    print(f"Broadcast to #all, median of {ROUNDS} rounds")
+    print(f"{'clients':>10}{'route (ms)':>12}{'flush (ms)':>12}{'total (ms)':>12}{'per client':>12}{'send() loop':>12}")
+    print(f"{'':>10}{'':>12}{'':>12}{'':>12}{'(us)':>12}{'(ms)':>12}")
+    for clients in args.clients:
+        if not raise_file_limit(clients * 2 + 64):
+            print(f"{clients:>10}  skipped - not enough file descriptors allowed")
+            continue
+        benchmark_broadcast(clients)
+    print()
+    print(f"Direct messages in one received chunk, median of {ROUNDS} rounds")
+    print(f"{'messages':>10}{'history':>12}{'per message':>12}{'throughput':>12}")
+    print(f"{'':>10}{'':>12}{'(us)':>12}{'(MB/s)':>12}")
+    benchmark_relay(RELAY_MESSAGES, history=False)
+    benchmark_relay(RELAY_MESSAGES, history=True)
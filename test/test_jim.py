@@ -3,6 +3,7 @@ import unittest
 import json
 import random
 import string
+import copy
 
 # Necessary to import from parent directory
 import sys
@@ -11,6 +12,9 @@ sys.path.insert(0, '..')
 import jim
 
 
+_MISSING = object()                 # marks field to remove from message
+
+
 def random_string(length: int):
     return ''.join(random.choice(string.ascii_letters+string.digits) for i in range(length))
 
@@ -62,6 +66,25 @@ class BaseTestCases:
                 jim.Message.from_str(json.dumps(self.message))
             self.printTestResult(cm.exception)
 
+        def testId_OK(self):
+            self.message[jim.MessageFields.ID] = 12345
+            jim.Message.from_str(json.dumps(self.message))
+            self.printTestResult("OK")
+
+        def testId_InvalidType_ValueError(self):
+            with self.assertRaises(ValueError) as cm:
+                self.message[jim.MessageFields.ID] = random_string(jim.OTHER_FIELDS_MAX_LENGTH)
+                jim.Message.from_str(json.dumps(self.message))
+            self.printTestResult(cm.exception)
+
+        def testId_NotInt_ValueError(self):
+            # Values convertible to int are not accepted - the id is sent back in the response as is
+            for value in ("5", 5.0, True):
+                with self.assertRaises(ValueError) as cm:
+                    self.message[jim.MessageFields.ID] = value
+                    jim.Message.from_bytes(json.dumps(self.message).encode())
+            self.printTestResult(cm.exception)
+
         def test_OK(self):
             jim.Message.from_str(json.dumps(self.message))
             self.printTestResult("OK")
@@ -117,6 +140,15 @@ class TestMessage_Presence(BaseTestCases.MessageTestCase):
             jim.Message.from_str(json.dumps(self.message))
         self.printTestResult(cm.exception)
 
+    def testUser_AccountName_InvalidType_ValueError(self):
+        # The server indexes connections by nickname - it has to be a (hashable) str
+        for value in (["z"], {"name": "z"}, 5):
+            with self.assertRaises(ValueError) as cm:
+                self.message[jim.MessageFields.USER][jim.get_child_field_name(jim.MessageFields.USER_ACCOUNT_NAME)] \
+                    = value
+                jim.Message.from_bytes(json.dumps(self.message).encode())
+        self.printTestResult(cm.exception)
+
     def testUser_Status_Missing_ValueError(self):
         with self.assertRaises(ValueError) as cm:
             self.message[jim.MessageFields.USER].pop(jim.get_child_field_name(jim.MessageFields.USER_STATUS))
@@ -180,6 +212,13 @@ class TestMessage_Msg(BaseTestCases.MessageTestCase):
             jim.Message.from_str(json.dumps(self.message))
         self.printTestResult(cm.exception)
 
+    def testTo_InvalidType_ValueError(self):
+        for value in (5, ["destination"], True):
+            with self.assertRaises(ValueError) as cm:
+                self.message[jim.MessageFields.TO] = value
+                jim.Message.from_str(json.dumps(self.message))
+        self.printTestResult(cm.exception)
+
     def testFrom_Missing_ValueError(self):
         with self.assertRaises(ValueError) as cm:
             self.message.pop(jim.MessageFields.FROM)
@@ -192,6 +231,13 @@ class TestMessage_Msg(BaseTestCases.MessageTestCase):
             jim.Message.from_str(json.dumps(self.message))
         self.printTestResult(cm.exception)
 
+    def testFrom_InvalidType_ValueError(self):
+        for value in (5, {"name": "source"}):
+            with self.assertRaises(ValueError) as cm:
+                self.message[jim.MessageFields.FROM] = value
+                jim.Message.from_str(json.dumps(self.message))
+        self.printTestResult(cm.exception)
+
     def testEncoding_Missing_OK(self):
         self.message.pop(jim.MessageFields.ENCODING)
         jim.Message.from_str(json.dumps(self.message))
@@ -278,6 +324,15 @@ class TestMessage_Authenticate(BaseTestCases.MessageTestCase):
             jim.Message.from_str(json.dumps(self.message))
         self.printTestResult(cm.exception)
 
+    def testUser_AccountName_InvalidType_ValueError(self):
+        # The server indexes connections by nickname - it has to be a (hashable) str
+        for value in (["z"], {"name": "z"}, 5):
+            with self.assertRaises(ValueError) as cm:
+                self.message[jim.MessageFields.USER][jim.get_child_field_name(jim.MessageFields.USER_ACCOUNT_NAME)] \
+                    = value
+                jim.Message.from_bytes(json.dumps(self.message).encode())
+        self.printTestResult(cm.exception)
+
     def testUser_Password_Missing_ValueError(self):
         with self.assertRaises(ValueError) as cm:
             self.message[jim.MessageFields.USER].pop(jim.get_child_field_name(jim.MessageFields.USER_PASSWORD))
@@ -348,6 +403,50 @@ class TestMessage_Leave(TestMessage_Join):
                         }
 
 
+class TestMessage_History(BaseTestCases.MessageTestCase):
+    """
+    History message test class.
+    Tests only message-specific fields, common fields testing is done in the base class
+    """
+
+    def setUp(self) -> None:
+        self.message = {"action": "history",
+                        "time": 1653130045655173000,
+                        "peer": "#lightroom",
+                        "before": 1653130045655173000,
+                        "limit": 10
+                        }
+
+    def testPeer_Missing_ValueError(self):
+        with self.assertRaises(ValueError) as cm:
+            self.message.pop(jim.MessageFields.PEER)
+            jim.Message.from_str(json.dumps(self.message))
+        self.printTestResult(cm.exception)
+
+    def testPeer_InvalidType_ValueError(self):
+        for value in (5, ["#lightroom"]):
+            with self.assertRaises(ValueError) as cm:
+                self.message[jim.MessageFields.PEER] = value
+                jim.Message.from_str(json.dumps(self.message))
+        self.printTestResult(cm.exception)
+
+    def testBeforeLimit_Missing_OK(self):
+        self.message.pop(jim.MessageFields.BEFORE)
+        self.message.pop(jim.MessageFields.LIMIT)
+        jim.Message.from_str(json.dumps(self.message))
+        self.printTestResult("OK")
+
+    def testBeforeLimit_InvalidType_ValueError(self):
+        # A str cursor would be compared by SQLite as text and select the latest page instead of failing
+        for field in (jim.MessageFields.BEFORE, jim.MessageFields.LIMIT):
+            for value in ("5", 5.0, True, None):
+                with self.assertRaises(ValueError) as cm:
+                    self.setUp()
+                    self.message[field] = value
+                    jim.Message.from_bytes(json.dumps(self.message).encode())
+        self.printTestResult(cm.exception)
+
+
 class TestResponse(unittest.TestCase):
 
     def setUp(self) -> None:
@@ -385,6 +484,19 @@ class TestResponse(unittest.TestCase):
             jim.Response.from_str(json.dumps(self.response))
         self.printTestResult(cm.exception)
 
+    def testId_InvalidType_ValueError(self):
+        with self.assertRaises(ValueError) as cm:
+            self.response[jim.ResponseFields.ID] = random_string(jim.OTHER_FIELDS_MAX_LENGTH)
+            jim.Response.from_str(json.dumps(self.response))
+        self.printTestResult(cm.exception)
+
+    def testId_NotInt_ValueError(self):
+        for value in ("5", True):
+            with self.assertRaises(ValueError) as cm:
+                self.response[jim.ResponseFields.ID] = value
+                jim.Response.from_str(json.dumps(self.response))
+        self.printTestResult(cm.exception)
+
     def testAlert_Missing_ValueError(self):
         with self.assertRaises(ValueError) as cm:
             self.response.pop(jim.ResponseFields.ALERT)
@@ -430,6 +542,342 @@ class TestResponse(unittest.TestCase):
         self.printTestResult("OK")
 
 
+class TestMessageSchema(unittest.TestCase):
+    """
+    Compiled schema validation should give the same results and errors as check_message()
+    """
+    def setUp(self) -> None:
+        self.messages = [
+            {"action": "presence", "time": 1653130045655173000, "type": "status",
+             "user": {"account_name": "test", "status": "Online"}},
+            {"action": "probe", "time": 1653130045655173000},
+            {"action": "msg", "time": 1653130045655173000, "to": "#all", "from": "test", "encoding": "ascii",
+             "message": "message"},
+            {"action": "quit", "time": 1653130045655173000},
+            {"action": "authenticate", "time": 1653130045655173000,
+             "user": {"account_name": "test", "password": "password"}},
+            {"action": "join", "time": 1653130045655173000, "room": "#lightroom"},
+            {"action": "leave", "time": 1653130045655173000, "room": "#lightroom"},
+            {"action": "msg", "time": 1653130045655173000, "to": "test", "from": "test", "message": "message",
+             "id": 12345},
+        ]
+        self.responses = [
+            {"response": 200, "time": 1653128454136720000, "alert": "OK"},
+            {"response": 404, "time": 1653128454136720000, "error": "Not found"},
+            {"response": 200, "time": 1653128454136720000, "id": 12345, "alert": "OK"},
+        ]
+        self.values = [_MISSING, None, 12345, {"a": 1}, [1], "", "status", "#room", "presence", "msg", 200, 404,
+                       random_string(jim.OTHER_FIELDS_MAX_LENGTH + 1), random_string(jim.MESSAGE_FIELD_MAX_LENGTH + 1)]
+
+    def printTestResult(self, message: str):
+        print(f"{self.__class__.__name__} - {self.__dict__['_testMethodName']}: {message}")
+
+    @staticmethod
+    def outcome(check, message: dict):
+        try:
+            return check(message)
+        except Exception as e:
+            return type(e), str(e)
+
+    def mutations(self, message: dict, fields: dict):
+        """ Yield message variants with every known or present field missing or set to various values """
+        keys = set(message) | {key for key in fields if key.find(jim.MESSAGE_LEVEL_DELIMITER) == -1}
+        nested = {key for key in fields if key.find(jim.MESSAGE_LEVEL_DELIMITER) != -1}
+        def mutate(fields: dict, key: str, value):
+            if value is _MISSING:
+                fields.pop(key, None)
+            else:
+                fields[key] = value
+
+        for value in self.values:
+            for key in keys:
+                mutated = copy.deepcopy(message)
+                mutate(mutated, key, value)
+                yield mutated
+            for key in nested:
+                parent, child = key.split(jim.MESSAGE_LEVEL_DELIMITER)
+                mutated = copy.deepcopy(message)
+                if type(mutated.get(parent)) == dict:
+                    mutate(mutated[parent], child, value)
+                    yield mutated
+
+    def compare(self, messages: list, fields: dict, type_field: str, schema: jim.MessageSchema):
+        count = 0
+        for message in messages:
+            for mutated in self.mutations(message, fields):
+                expected = self.outcome(lambda m: jim.check_message(m, fields, type_field), mutated)
+                self.assertEqual(self.outcome(schema.check, mutated), expected, mutated)
+                count += 1
+        self.printTestResult(f"{count} variants OK")
+
+    def testMessages_SameAsCheckMessage(self):
+        self.compare(self.messages, jim.MESSAGE_FIELDS, jim.MessageFields.ACTION, jim.MESSAGE_SCHEMA)
+
+    def testResponses_SameAsCheckMessage(self):
+        self.compare(self.responses, jim.RESPONSE_FIELDS, jim.ResponseFields.RESPONSE, jim.RESPONSE_SCHEMA)
+
+
+class TestResponseEncoder(unittest.TestCase):
+
+    def printTestResult(self, message: str):
+        print(f"{self.__class__.__name__} - {self.__dict__['_testMethodName']}: {message}")
+
+    def testEncode_Standard_SameAsJson(self):
+        for code in jim.Responses:
+            response = jim.Response(**code.response)
+            self.assertEqual(jim.RESPONSE_ENCODER.encode(code, response.time), response.json.encode())
+            self.assertEqual(response.to_bytes(), response.json.encode())
+        self.printTestResult("OK")
+
+    def testEncode_Custom_SameAsJson(self):
+        response = jim.Response(**{"response": 200, "alert": random_string(jim.OTHER_FIELDS_MAX_LENGTH)})
+        self.assertEqual(response.to_bytes(), response.json.encode())
+        self.printTestResult("OK")
+
+    def testEncodeFrame_Decoded_OK(self):
+        decoder = jim.FrameDecoder()
+        frames = decoder.feed(jim.RESPONSE_ENCODER.encode_frame(jim.Responses.NOT_FOUND))
+        response = jim.Response.from_str(frames[0].decode())
+        self.assertEqual(response.response, jim.Responses.NOT_FOUND)
+        self.assertEqual(response.kwargs, jim.Responses.NOT_FOUND.texts)
+        self.printTestResult("OK")
+
+    def testEncodeFrame_RequestId_SameAsJson(self):
+        for code in jim.Responses:
+            response = jim.Response(**{jim.ResponseFields.RESPONSE: code, jim.ResponseFields.ID: 12345, **code.texts})
+            self.assertEqual(jim.RESPONSE_ENCODER.encode_frame(code, response.time, 12345),
+                             jim.frame(response.json.encode()))
+        self.printTestResult("OK")
+
+
+class TestMessageObject(unittest.TestCase):
+
+    def setUp(self) -> None:
+        self.message = {"action": "msg", "time": 1653130045655173000, "to": "#all", "from": "test",
+                        "message": "Hello", "id": 1}
+
+    def printTestResult(self, message: str):
+        print(f"{self.__class__.__name__} - {self.__dict__['_testMethodName']}: {message}")
+
+    def testAccessors_OK(self):
+        message = jim.Message.from_bytes(json.dumps(self.message).encode())
+        self.assertEqual((message.sender, message.target, message.text), ("test", "#all", "Hello"))
+        presence = jim.Message(action="presence", user={"account_name": "test", "status": "Online"})
+        self.assertEqual((presence.sender, presence.target, presence.text), (None, None, None))
+        self.printTestResult("OK")
+
+    def testSlots_NoInstanceDict(self):
+        for instance in (jim.Message(**self.message), jim.Response(response=200, alert="OK")):
+            self.assertFalse(hasattr(instance, "__dict__"))
+        self.printTestResult("OK")
+
+    def testJson_Cached_SameAsDumps(self):
+        message = jim.Message(**self.message)
+        self.assertIs(message.json, message.json)
+        self.assertEqual(message.json, json.dumps(self.message))
+        self.assertIs(message.to_bytes(jim.CODEC_BINARY), message.to_bytes(jim.CODEC_BINARY))
+        response = jim.Response(response=200, time=1653130045655173000, alert="OK")
+        self.assertIs(response.json, response.json)
+        self.printTestResult("OK")
+
+    def testTime_Missing_Now(self):
+        del self.message["time"]
+        message = jim.Message.from_bytes(json.dumps(self.message).encode())
+        self.assertIsInstance(message.time, int)
+        self.assertNotIn(jim.MessageFields.TIME, message.kwargs)
+        self.printTestResult("OK")
+
+class TestMessageRelay(unittest.TestCase):
+
+    def setUp(self) -> None:
+        self.message = {"action": "msg", "time": 1653130045655173000, "to": "#all", "from": "test",
+                        "message": "Hello", "id": 1}
+
+    def printTestResult(self, message: str):
+        print(f"{self.__class__.__name__} - {self.__dict__['_testMethodName']}: {message}")
+
+    def testRelay_SameAsMessage(self):
+        payload = json.dumps(self.message).encode()
+        message = jim.Message.from_bytes(payload, relay=True)
+        expected = jim.Message.from_bytes(payload)
+        self.assertEqual((message.action, message.time, message.kwargs),
+                         (expected.action, expected.time, expected.kwargs))
+        self.printTestResult("OK")
+
+    def testRelay_InvalidBody_OK(self):
+        for body in ({"message": random_string(jim.MESSAGE_FIELD_MAX_LENGTH + 1)}, {"message": None},
+                     {"time": "now"}):
+            message = jim.Message.from_bytes(json.dumps({**self.message, **body}).encode(), relay=True)
+            self.assertEqual(message.kwargs[jim.MessageFields.TO], self.message["to"])
+        self.printTestResult("OK")
+
+    def testRelay_InvalidRouting_ValueError(self):
+        for routing in ({"to": random_string(jim.ACCOUNT_NAME_MAX_LENGTH + 1)}, {"from": _MISSING}, {"id": "first"},
+                        {"to": 5}, {"from": ["test"]}, {"id": "5"}, {"id": False}):
+            message = {key: value for key, value in {**self.message, **routing}.items() if value is not _MISSING}
+            with self.assertRaises(ValueError) as cm:
+                jim.Message.from_bytes(json.dumps(message).encode(), relay=True)
+        self.printTestResult(cm.exception)
+
+    def testRelay_NotChatMessage_Validated(self):
+        presence = {"action": "presence", "time": 1653130045655173000, "user": {"account_name": "test"}}
+        with self.assertRaises(ValueError) as cm:
+            jim.Message.from_bytes(json.dumps(presence).encode(), relay=True)
+        self.printTestResult(cm.exception)
+
+class TestBinaryCodec(unittest.TestCase):
+
+    def setUp(self) -> None:
+        self.messages = [{"action": "presence", "time": 1653130045655173000, "type": "status",
+                          "user": {"account_name": "test", "status": "Online"}, "codec": "binary"},
+                         {"action": "msg", "time": 1653130045655173000, "to": "#all", "from": "test",
+                          "message": "Привет, " + random_string(jim.MESSAGE_FIELD_MAX_LENGTH - 8), "id": 65535},
+                         {"action": "join", "room": "#room", "id": 1},
+                         {"response": 200, "time": 1653130045655173000, "id": 2 ** 40, "alert": "OK"},
+                         {"response": 400, "error": "Bad request", "extra": [1, -1.5, True, False, None]}]
+
+    def printTestResult(self, message: str):
+        print(f"{self.__class__.__name__} - {self.__dict__['_testMethodName']}: {message}")
+
+    def testEncodeDecode_SameAsJson(self):
+        for message in self.messages:
+            payload = jim.encode_binary(message)
+            self.assertEqual(jim.detect_codec(payload), jim.CODEC_BINARY)
+            self.assertEqual(jim.decode(payload), json.loads(json.dumps(message)))
+            self.assertLess(len(payload), len(json.dumps(message).encode()))
+        self.printTestResult("OK")
+
+    def testDecode_Json_OK(self):
+        payload = json.dumps(self.messages[0]).encode()
+        self.assertEqual(jim.detect_codec(payload), jim.CODEC_JSON)
+        self.assertEqual(jim.decode(payload), self.messages[0])
+        self.printTestResult("OK")
+
+    def testToBytes_Binary_SameFields(self):
+        message = jim.Message(**self.messages[1])
+        self.assertEqual(jim.Message.from_bytes(message.to_bytes(jim.CODEC_BINARY)).kwargs, message.kwargs)
+        response = jim.Response(**self.messages[3])
+        self.assertEqual(jim.Response.from_bytes(response.to_bytes(jim.CODEC_BINARY)).kwargs, response.kwargs)
+        self.printTestResult("OK")
+
+    def testEncodeFrame_Binary_SameAsToBytes(self):
+        for code in jim.Responses:
+            response = jim.Response(**{jim.ResponseFields.RESPONSE: code, jim.ResponseFields.ID: 12345, **code.texts})
+            self.assertEqual(jim.RESPONSE_ENCODER.encode_frame(code, response.time, 12345, jim.CODEC_BINARY),
+                             jim.frame(response.to_bytes(jim.CODEC_BINARY)))
+        self.printTestResult("OK")
+
+    def testEncodeFrame_Fields_Decoded_OK(self):
+        payload = jim.FrameDecoder().feed(jim.RESPONSE_ENCODER.encode_frame(
+            jim.Responses.OK, request_id=1, codec=jim.CODEC_BINARY,
+            fields={jim.ResponseFields.CODEC: jim.CODEC_BINARY}))[0]
+        response = jim.Response.from_bytes(payload)
+        self.assertEqual(response.kwargs, {jim.ResponseFields.ID: 1, **jim.Responses.OK.texts,
+                                           jim.ResponseFields.CODEC: jim.CODEC_BINARY})
+        self.printTestResult("OK")
+
+    def testDecode_Truncated_ValueError(self):
+        # Cut inside the last field (message id) and inside the message text
+        payload = jim.encode_binary(self.messages[1])
+        for length in (len(payload) - 1, len(payload) // 2):
+            with self.assertRaises(ValueError) as cm:
+                jim.decode(payload[:length])
+        self.printTestResult(cm.exception)
+
+    def testDecode_TrailingData_ValueError(self):
+        with self.assertRaises(ValueError) as cm:
+            jim.decode(jim.encode_binary(self.messages[2]) + b"\x00")
+        self.printTestResult(cm.exception)
+
+    def testDecode_NotDict_ValueError(self):
+        with self.assertRaises(ValueError) as cm:
+            jim.decode(b"[1, 2]")
+        self.printTestResult(cm.exception)
+
+    def testMessage_InvalidCodec_ValueError(self):
+        with self.assertRaises(ValueError) as cm:
+            jim.Message(**{**self.messages[0], "codec": "xml"})
+        self.printTestResult(cm.exception)
+
+    def testToken_Binary_SameFields(self):
+        message = jim.Message(**self.messages[0], token="t" * jim.TOKEN_MAX_LENGTH)
+        self.assertEqual(jim.Message.from_bytes(message.to_bytes(jim.CODEC_BINARY)).kwargs, message.kwargs)
+        payload = jim.FrameDecoder().feed(jim.RESPONSE_ENCODER.encode_frame(
+            jim.Responses.OK, request_id=1, codec=jim.CODEC_BINARY, fields={jim.ResponseFields.TOKEN: "token"}))[0]
+        self.assertEqual(jim.Response.from_bytes(payload).kwargs[jim.ResponseFields.TOKEN], "token")
+        self.printTestResult("OK")
+
+    def testToken_TooLong_ValueError(self):
+        with self.assertRaises(ValueError) as cm:
+            jim.Message(**self.messages[0], token="t" * (jim.TOKEN_MAX_LENGTH + 1))
+        self.printTestResult(cm.exception)
+
+
+class TestFraming(unittest.TestCase):
+
+    def setUp(self) -> None:
+        self.payloads = [json.dumps({"action": "msg",
+                                     "time": 1653130045655173000,
+                                     "to": "#all",
+                                     "from": "test",
+                                     "message": random_string(length)}).encode()
+                         for length in (1, 100, jim.MESSAGE_FIELD_MAX_LENGTH)]
+        self.stream = b"".join(jim.frame(payload) for payload in self.payloads)
+        self.decoder = jim.FrameDecoder()
+
+    def printTestResult(self, message: str):
+        print(f"{self.__class__.__name__} - {self.__dict__['_testMethodName']}: {message}")
+
+    def testFrame_TooLong_ValueError(self):
+        with self.assertRaises(ValueError) as cm:
+            jim.frame(b" " * (jim.MAX_FRAME_LEN + 1))
+        self.printTestResult(cm.exception)
+
+    def testFeed_Coalesced_OK(self):
+        self.assertEqual(self.decoder.feed(self.stream), self.payloads)
+        self.assertEqual(len(self.decoder), 0)
+        self.printTestResult("OK")
+
+    def testFeed_Split_OK(self):
+        frames = []
+        for i in range(len(self.stream)):
+            frames.extend(self.decoder.feed(self.stream[i:i + 1]))
+        self.assertEqual(frames, self.payloads)
+        self.assertEqual(len(self.decoder), 0)
+        self.printTestResult("OK")
+
+    def testFeed_Incomplete_Empty(self):
+        self.assertEqual(self.decoder.feed(self.stream[:-1]), self.payloads[:-1])
+        self.assertEqual(self.decoder.feed(b""), [])
+        self.assertEqual(self.decoder.feed(self.stream[-1:]), self.payloads[-1:])
+        self.printTestResult("OK")
+
+    def testFeed_InvalidLength_ValueError(self):
+        with self.assertRaises(ValueError) as cm:
+            self.decoder.feed(jim.FRAME_HEADER.pack(jim.MAX_FRAME_LEN + 1))
+        self.assertEqual(len(self.decoder), 0)
+        self.printTestResult(cm.exception)
+
+    def testFeedFrames_Coalesced_NotCopied(self):
+        frames = self.decoder.feed_frames(self.stream)
+        self.assertEqual([bytes(frame) for frame in frames], [jim.frame(payload) for payload in self.payloads])
+        self.assertTrue(all(frame.obj is self.stream and frame.readonly for frame in frames))
+        self.printTestResult("OK")
+
+    def testFeedFrames_Split_OK(self):
+        frames = []
+        for i in range(0, len(self.stream), 7):
+            frames.extend(bytes(frame) for frame in self.decoder.feed_frames(self.stream[i:i + 7]))
+        self.assertEqual(frames, [jim.frame(payload) for payload in self.payloads])
+        self.assertEqual(len(self.decoder), 0)
+        self.printTestResult("OK")
+
+    def testFeed_CustomMaxLength_OK(self):
+        payload = b" " * (jim.MAX_FRAME_LEN + 1)
+        decoder = jim.FrameDecoder(max_length=len(payload))
+        self.assertEqual(decoder.feed(jim.frame(payload, max_length=len(payload))), [payload])
+        self.printTestResult("OK")
+
 
 if __name__ == "__main__":
     unittest.main()
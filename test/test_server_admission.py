@@ -0,0 +1,56 @@
+import time
+import unittest
+
+# Necessary to import from parent directory
+import sys
+sys.path.insert(0, '..')
+
+import jim
+import server_admission
+
+
+class TestTokenBucket(unittest.TestCase):
+    def test_burst_then_rate(self):
+        bucket = server_admission.TokenBucket(rate=10, burst=3, now=0.0)
+        self.assertEqual([bucket.take(0.0) for _ in range(4)], [True, True, True, False])
+        self.assertFalse(bucket.take(0.05))
+        self.assertTrue(bucket.take(0.1))
+        self.assertFalse(bucket.take(0.1))
+        # Tokens are not accumulated above the burst
+        self.assertEqual([bucket.take(100.0) for _ in range(4)], [True, True, True, False])
+
+
+class TestAdmissionController(unittest.TestCase):
+    def test_max_connections(self):
+        admission = server_admission.AdmissionController(max_connections=2, rate=0, burst=0, lag_threshold=0)
+        self.assertIsNone(admission.admit(1, 0.0))
+        self.assertEqual(admission.admit(2, 0.0), server_admission.REJECT_MAX_CONNECTIONS)
+        self.assertEqual(admission.admit(2, 0.0), server_admission.REJECT_MAX_CONNECTIONS)
+        self.assertEqual(admission.rejected, 2)
+        self.assertIsNone(admission.admit(0, 0.0))
+        self.assertEqual(admission.rejected, 0)
+
+    def test_overload(self):
+        admission = server_admission.AdmissionController(max_connections=10, rate=0, burst=0, lag_threshold=0.5)
+        admission.lag = 0.6
+        self.assertEqual(admission.admit(0, 0.0), server_admission.REJECT_OVERLOAD)
+        admission.lag = 0.1
+        self.assertIsNone(admission.admit(0, 0.0))
+
+    def test_rate(self):
+        admission = server_admission.AdmissionController(max_connections=10, rate=1, burst=2, lag_threshold=0)
+        now = time.perf_counter()
+        self.assertEqual([admission.admit(0, now) for _ in range(3)], [None, None, server_admission.REJECT_RATE])
+        self.assertIsNone(admission.admit(0, now + 1))
+
+    def test_reject_frame(self):
+        admission = server_admission.AdmissionController(max_connections=1, rate=0, burst=0, lag_threshold=0)
+        frame = admission.reject_frame()
+        self.assertIs(admission.reject_frame(), frame)
+        decoder = jim.FrameDecoder()
+        payload, = decoder.feed(frame)
+        self.assertEqual(jim.Response.from_bytes(payload).response, jim.Responses.SERVER_ERROR)
+
+
+if __name__ == '__main__':
+    unittest.main()
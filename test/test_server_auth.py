@@ -0,0 +1,120 @@
+import os
+import time
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+# Necessary to import from parent directory
+import sys
+sys.path.insert(0, '..')
+
+import server_auth
+
+
+class TestPasswordHash(unittest.TestCase):
+    def test_scrypt(self):
+        record = server_auth.hash_password("пароль", server_auth.HASH_SCRYPT)
+        self.assertTrue(record.startswith(server_auth.HASH_SCRYPT + server_auth.RECORD_SEPARATOR))
+        self.assertTrue(server_auth.verify_password(record, "пароль"))
+        self.assertFalse(server_auth.verify_password(record, "пароль2"))
+        # Every record has its own salt
+        self.assertNotEqual(record, server_auth.hash_password("пароль", server_auth.HASH_SCRYPT))
+
+    def test_pbkdf2(self):
+        record = server_auth.hash_password("password", server_auth.HASH_PBKDF2)
+        self.assertTrue(record.startswith(server_auth.HASH_PBKDF2 + server_auth.RECORD_SEPARATOR))
+        self.assertTrue(server_auth.verify_password(record, "password"))
+        self.assertFalse(server_auth.verify_password(record, ""))
+
+    def test_invalid_record(self):
+        self.assertFalse(server_auth.verify_password("", "password"))
+        self.assertFalse(server_auth.verify_password("md5$salt$hash", "password"))
+        self.assertFalse(server_auth.verify_password("pbkdf2_sha256$x$00$00", "password"))
+        with self.assertRaises(ValueError):
+            server_auth.hash_password("password", "md5")
+
+
+class TestTokenCache(unittest.TestCase):
+    def test_check(self):
+        tokens = server_auth.TokenCache(size=10, ttl=60)
+        token = tokens.issue("user")
+        self.assertTrue(tokens.check("user", token))
+        self.assertFalse(tokens.check("other", token))
+        self.assertFalse(tokens.check("user", token + "x"))
+        self.assertNotEqual(token, tokens.issue("user"))
+
+    def test_least_recently_used_evicted(self):
+        tokens = server_auth.TokenCache(size=2, ttl=60)
+        first = tokens.issue("first")
+        second = tokens.issue("second")
+        self.assertTrue(tokens.check("first", first))
+        third = tokens.issue("third")
+        self.assertEqual(len(tokens), 2)
+        self.assertFalse(tokens.check("second", second))
+        self.assertTrue(tokens.check("first", first))
+        self.assertTrue(tokens.check("third", third))
+
+    def test_expired(self):
+        tokens = server_auth.TokenCache(size=10, ttl=-1)
+        token = tokens.issue("user")
+        self.assertFalse(tokens.check("user", token))
+        self.assertEqual(len(tokens), 0)
+
+
+class TestAuthenticator(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, "users.json")
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_credential_store(self):
+        store = server_auth.CredentialStore(self.path)
+        self.assertFalse(store.loaded)
+        store.set_password("user", "password")
+        store.set_password("пользователь", "пароль")
+        self.assertEqual(os.stat(self.path).st_mode & 0o777, 0o600)
+        other = server_auth.CredentialStore(self.path)
+        self.assertTrue(other.loaded)
+        self.assertTrue(other.is_registered("пользователь"))
+        self.assertTrue(server_auth.verify_password(other.record("user"), "password"))
+        self.assertTrue(store.remove("user"))
+        self.assertFalse(store.remove("user"))
+        # The change is picked up on reload
+        self.assertTrue(other.reload())
+        self.assertIsNone(other.record("user"))
+
+    def test_verify(self):
+        authenticator = server_auth.Authenticator(self.path, workers=2)
+        try:
+            self.assertFalse(authenticator.is_registered("user"))
+            # Users added while the server is running are picked up
+            server_auth.CredentialStore(self.path).set_password("user", "password")
+            futures = [authenticator.verify("user", "password"), authenticator.verify("user", "wrong"),
+                       authenticator.verify("unknown", "password")]
+            self.assertEqual([future.result(timeout=10) for future in futures], [True, False, False])
+            self.assertTrue(authenticator.is_registered("user"))
+            token = authenticator.issue_token("user")
+            self.assertTrue(authenticator.resume("user", token))
+            self.assertFalse(authenticator.resume("unknown", token))
+        finally:
+            authenticator.shutdown()
+
+    def test_reload_in_background(self):
+        with mock.patch.object(server_auth.sett, "AUTH_RELOAD_INTERVAL", 0):
+            authenticator = server_auth.Authenticator(self.path, workers=1)
+            try:
+                server_auth.CredentialStore(self.path).set_password("user", "password")
+                # The file is re-read in the thread pool, so the user shows up without a password check
+                deadline = time.monotonic() + 10
+                while not authenticator.is_registered("user") and time.monotonic() < deadline:
+                    time.sleep(0.01)
+                self.assertTrue(authenticator.is_registered("user"))
+            finally:
+                authenticator.shutdown()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,163 @@
+import os
+import json
+import time
+import shutil
+import sqlite3
+import tempfile
+import unittest
+
+# Necessary to import from parent directory
+import sys
+sys.path.insert(0, '..')
+
+import jim
+import server_history
+
+
+def chat_message(sender: str, target: str, text: str, codec: str = jim.CODEC_JSON) -> bytes:
+    """ Return encoded chat message as received from the sender """
+    return jim.Message(**{jim.MessageFields.ACTION: jim.Actions.MESSAGE, jim.MessageFields.TO: target,
+                          jim.MessageFields.FROM: sender, jim.MessageFields.MESSAGE: text}).to_bytes(codec)
+
+
+class TestHistory(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, "history.db")
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def rows(self) -> list:
+        with sqlite3.connect(self.path) as database:
+            return database.execute("SELECT time, sender, target, payload FROM messages ORDER BY id").fetchall()
+
+    def test_append(self):
+        history = server_history.History(self.path, batch_size=10, batch_interval=0.01, queue_size=1000, retention=0)
+        for number in range(25):
+            target = "#room" if number % 2 else "user"
+            self.assertTrue(history.append("sender", target, chat_message("sender", target, f"message {number}")))
+        history.close()
+        self.assertEqual(history.written, 25)
+        rows = self.rows()
+        self.assertEqual([jim.decode(row[3])[jim.MessageFields.MESSAGE] for row in rows],
+                         [f"message {number}" for number in range(25)])
+        self.assertEqual(rows[1][1:3], ("sender", "#room"))
+        self.assertEqual([row[0] for row in rows], sorted(row[0] for row in rows))
+        with sqlite3.connect(self.path) as database:
+            self.assertEqual(database.execute("PRAGMA journal_mode").fetchone()[0], "wal")
+
+    def test_queue_full_dropped(self):
+        history = server_history.History(self.path, batch_size=10, batch_interval=0.5, queue_size=2, retention=0)
+        history.append("sender", "user", chat_message("sender", "user", "first"))
+        time.sleep(0.1)                 # the writer has taken the first message and is collecting the batch
+        results = [history.append("sender", "user", chat_message("sender", "user", f"message {number}"))
+                   for number in range(3)]
+        self.assertEqual(results, [True, True, False])
+        self.assertEqual(history.dropped, 1)
+        history.close()
+        self.assertEqual(len(self.rows()), 3)
+
+    def test_retention(self):
+        history = server_history.History(self.path, retention=0)
+        history.append("sender", "user", chat_message("sender", "user", "message"))
+        history.close()
+        self.assertEqual(len(self.rows()), 1)
+        # Expired messages are deleted when the writer starts
+        history = server_history.History(self.path, retention=1e-6)
+        history.close()
+        self.assertEqual(self.rows(), [])
+
+    def test_unreplayable_skipped(self):
+        history = server_history.History(self.path, batch_interval=0.01, retention=0)
+        # Relayed messages are only checked for their routing fields - this one has no text
+        history.append("sender", "user", json.dumps({jim.MessageFields.ACTION: jim.Actions.MESSAGE,
+                                                     jim.MessageFields.TIME: time.time_ns(),
+                                                     jim.MessageFields.TO: "user",
+                                                     jim.MessageFields.FROM: "sender"}).encode())
+        # The longest message fits in a frame, but not with the HISTORY field added
+        sender, target = "s" * jim.ACCOUNT_NAME_MAX_LENGTH, "#" + "r" * (jim.ACCOUNT_NAME_MAX_LENGTH - 1)
+        payload = chat_message(sender, target, "m" * jim.MESSAGE_FIELD_MAX_LENGTH)
+        self.assertLessEqual(len(payload), jim.MAX_FRAME_LEN)
+        history.append(sender, target, payload)
+        history.append("sender", "user", chat_message("sender", "user", "valid"))
+        history.close()
+        self.assertEqual((history.written, history.skipped), (1, 2))
+        self.assertEqual([jim.decode(row[3])[jim.MessageFields.MESSAGE] for row in self.rows()], ["valid"])
+
+
+class TestHistoryQuery(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, "history.db")
+        self.history = server_history.History(self.path, batch_interval=0.001, retention=0)
+
+    def tearDown(self):
+        self.history.close()
+        shutil.rmtree(self.directory)
+
+    def append(self, sender: str, target: str, text: str, codec: str = jim.CODEC_JSON):
+        self.history.append(sender, target, chat_message(sender, target, text, codec))
+
+    def written(self, count: int):
+        deadline = time.monotonic() + 5
+        while self.history.written < count and time.monotonic() < deadline:
+            time.sleep(0.001)
+
+    def pages(self, nickname: str, peer: str, limit: int, codec: str = jim.CODEC_JSON) -> list:
+        """ Read all the pages, return the messages' texts by page, latest page first """
+        pages = []
+        before = None
+        while True:
+            frames, before = self.history.query(nickname, peer, before, limit, codec, 7).result(timeout=5)
+            messages = [jim.Message.from_bytes(jim.FrameDecoder().feed(frame)[0]) for frame in frames]
+            self.assertTrue(all(message.kwargs[jim.MessageFields.HISTORY] == 7 for message in messages))
+            pages.append([message.text for message in messages])
+            if before is None:
+                return pages
+
+    def test_room_pages(self):
+        for number in range(25):
+            self.append("user", "#room", f"room {number}")
+            self.append("user", "#other", f"other {number}")
+        self.written(50)
+        pages = self.pages("reader", "#room", 10, jim.CODEC_BINARY)
+        self.assertEqual(pages, [[f"room {number}" for number in numbers]
+                                 for numbers in (range(15, 25), range(5, 15), range(5))])
+
+    def test_conversation_pages(self):
+        for number in range(9):
+            self.append(*(("first", "second") if number % 2 else ("second", "first")), f"direct {number}")
+            self.append("first", "third", f"third {number}")
+            self.append("first", "first", f"own {number}")
+        self.written(27)
+        self.assertEqual(self.pages("first", "second", 4),
+                         [[f"direct {number}" for number in numbers] for numbers in ((5, 6, 7, 8), (1, 2, 3, 4), (0,))])
+        self.assertEqual(self.pages("second", "first", 10), [[f"direct {number}" for number in range(9)]])
+        self.assertEqual(self.pages("first", "first", 10), [[f"own {number}" for number in range(9)]])
+        self.assertEqual(self.pages("second", "third", 10), [[]])
+
+    def test_equal_times_pages(self):
+        # Server workers writing to the same database may give their messages the same time
+        with sqlite3.connect(self.path) as database:
+            database.executemany(server_history.INSERT,
+                                 [(1000, "user", "#room", chat_message("user", "#room", f"room {number}"))
+                                  for number in range(7)])
+        self.assertEqual(self.pages("reader", "#room", 3),
+                         [[f"room {number}" for number in numbers] for numbers in ((4, 5, 6), (1, 2, 3), (0,))])
+        # The messages before an expired cursor have expired too
+        self.assertEqual(self.history.query("reader", "#room", 1000, 3, jim.CODEC_JSON, 7).result(timeout=5),
+                         ([], None))
+
+    def test_too_long_for_codec_requested(self):
+        # Non-ASCII characters are escaped with JSON, so the message is sent with the codec it was received with
+        self.append("user", "#room", "я" * 250, jim.CODEC_BINARY)
+        self.written(1)
+        frames, _ = self.history.query("reader", "#room", None, 10, jim.CODEC_JSON, 7).result(timeout=5)
+        payload = jim.FrameDecoder().feed(frames[0])[0]
+        self.assertEqual(jim.detect_codec(payload), jim.CODEC_BINARY)
+        self.assertEqual(jim.decode(payload)[jim.MessageFields.MESSAGE], "я" * 250)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,114 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+# Necessary to import from parent directory
+import sys
+sys.path.insert(0, '..')
+
+import server_mailbox
+
+
+class TestMailbox(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.mailbox = server_mailbox.Mailbox(self.directory, segment_size=100)
+
+    def tearDown(self):
+        self.mailbox.close()
+        shutil.rmtree(self.directory)
+
+    def reopen(self):
+        self.mailbox.close()
+        self.mailbox = server_mailbox.Mailbox(self.directory, segment_size=100)
+
+    def segments(self) -> list:
+        return sorted(name for name in os.listdir(self.directory) if name.endswith(server_mailbox.SEGMENT_SUFFIX))
+
+    def test_known_users(self):
+        self.assertFalse(self.mailbox.is_known("user"))
+        self.mailbox.add_user("user")
+        self.mailbox.add_user("user")
+        self.mailbox.add_user("имя\nс переводом строки")
+        self.reopen()
+        self.assertTrue(self.mailbox.is_known("user"))
+        self.assertTrue(self.mailbox.is_known("имя\nс переводом строки"))
+        self.assertFalse(self.mailbox.is_known("other"))
+
+    def test_store_and_take_in_order(self):
+        frames = [f"message {i}".encode() for i in range(25)]
+        for frame in frames:
+            self.assertTrue(self.mailbox.store("user", frame))
+        self.mailbox.store("other", b"other message")
+        self.assertEqual(self.mailbox.pending("user"), 25)
+        self.assertEqual(self.mailbox.take("user", 10), frames[:10])
+        self.assertEqual(self.mailbox.pending("user"), 15)
+        self.assertEqual(self.mailbox.take("user", 100), frames[10:])
+        self.assertEqual(self.mailbox.pending("user"), 0)
+        self.assertEqual(self.mailbox.take("user", 100), [])
+        self.assertEqual(self.mailbox.take("other", 100), [b"other message"])
+
+    def test_reopen_keeps_undelivered(self):
+        frames = [f"message {i}".encode() for i in range(10)]
+        for frame in frames:
+            self.mailbox.store("user", frame)
+        self.mailbox.take("user", 4)
+        self.reopen()
+        self.assertEqual(self.mailbox.pending("user"), 6)
+        self.assertEqual(self.mailbox.take("user", 100), frames[4:])
+
+    def test_delivered_segments_deleted(self):
+        for i in range(30):
+            self.mailbox.store("user", b"x" * 20)
+        self.mailbox.store("other", b"kept")
+        # Messages are written by the writer thread
+        self.mailbox.flush()
+        self.assertGreater(len(self.segments()), 2)
+        self.mailbox.take("user", 100)
+        # The segment with an undelivered message is kept, as well as the segment being appended to
+        self.assertEqual(len(self.segments()), 1)
+        self.mailbox.take("other", 100)
+        self.assertEqual(len(self.segments()), 1)
+        self.mailbox.store("user", b"new")
+        self.reopen()
+        self.assertEqual(self.mailbox.take("user", 100), [b"new"])
+        self.mailbox.flush()
+        self.assertEqual(os.listdir(os.path.join(self.directory, server_mailbox.INDEX_DIRECTORY)), [])
+
+    def test_many_recipients(self):
+        # More recipients than index files kept open
+        self.mailbox.close()
+        self.mailbox = server_mailbox.Mailbox(self.directory, segment_size=100, index_files=2)
+        nicknames = [f"user {i}" for i in range(5)]
+        for i in range(4):
+            for nickname in nicknames:
+                self.mailbox.store(nickname, f"{nickname}: {i}".encode())
+        self.assertEqual(self.mailbox.take("user 0", 2), [b"user 0: 0", b"user 0: 1"])
+        self.reopen()
+        for nickname in nicknames:
+            self.assertEqual(self.mailbox.take(nickname, 100),
+                             [f"{nickname}: {i}".encode() for i in range(2 if nickname == "user 0" else 0, 4)])
+        self.mailbox.flush()
+        self.assertEqual(self.segments(), ["00000002.seg"])
+
+    def test_partial_index_entry_dropped(self):
+        self.mailbox.store("user", b"first")
+        self.reopen()
+        index_path = os.path.join(self.directory, server_mailbox.INDEX_DIRECTORY, "user".encode().hex() + ".idx")
+        with open(index_path, "ab") as index_file:
+            index_file.write(b"\x00\x00")
+        self.reopen()
+        self.assertEqual(self.mailbox.pending("user"), 1)
+        self.mailbox.store("user", b"second")
+        self.assertEqual(self.mailbox.take("user", 100), [b"first", b"second"])
+
+    def test_queue_full(self):
+        self.mailbox.close()
+        self.mailbox = server_mailbox.Mailbox(self.directory, queue_size=0)
+        self.assertFalse(self.mailbox.store("user", b"message"))
+        self.assertEqual(self.mailbox.pending("user"), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
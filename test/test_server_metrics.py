@@ -0,0 +1,95 @@
+import unittest
+
+# Necessary to import from parent directory
+import sys
+sys.path.insert(0, '..')
+
+import jim
+import server_metrics
+import server_settings as sett
+
+
+class TestLatencyHistogram(unittest.TestCase):
+    def setUp(self):
+        self.histogram = server_metrics.LatencyHistogram(lowest=0.001, highest=1.0, sub_buckets=4)
+
+    def test_bounds(self):
+        bounds = self.histogram.bounds
+        self.assertEqual(bounds[0], 0.001)
+        self.assertGreaterEqual(bounds[-1], 1.0)
+        self.assertEqual(bounds, sorted(bounds))
+        # Every power of two range is split into 4 equal buckets
+        self.assertAlmostEqual(bounds[1], 0.00125)
+        self.assertAlmostEqual(bounds[4], 0.002)
+        self.assertAlmostEqual(bounds[5], 0.0025)
+        self.assertEqual(len(self.histogram.counts), len(bounds) + 1)
+
+    def test_record(self):
+        self.histogram.record(0.0005)
+        self.histogram.record(0.001)
+        self.histogram.record(0.0011, count=3)
+        self.histogram.record(100.0)
+        self.assertEqual(self.histogram.counts[0], 2)         # bounds are inclusive
+        self.assertEqual(self.histogram.counts[1], 3)
+        self.assertEqual(self.histogram.counts[-1], 1)
+        self.assertEqual(self.histogram.count, 6)
+        self.assertAlmostEqual(self.histogram.total, 0.0005 + 0.001 + 0.0033 + 100.0)
+
+    def test_quantile(self):
+        self.assertEqual(self.histogram.quantile(0.5), 0.0)
+        for _ in range(99):
+            self.histogram.record(0.0011)
+        self.histogram.record(0.5)
+        self.assertAlmostEqual(self.histogram.quantile(0.5), 0.00125)
+        self.assertAlmostEqual(self.histogram.quantile(0.99), 0.00125)
+        self.assertGreaterEqual(self.histogram.quantile(1.0), 0.5)
+        self.histogram.record(100.0, count=100)
+        self.assertEqual(self.histogram.quantile(0.99), float("inf"))
+
+    def test_render(self):
+        self.histogram.record(0.0011, count=2)
+        self.histogram.record(100.0)
+        lines = self.histogram.render("test_seconds", "Test")
+        self.assertEqual(lines[:2], ["# HELP test_seconds Test", "# TYPE test_seconds histogram"])
+        self.assertEqual(lines[2], 'test_seconds_bucket{le="0.001"} 0')
+        self.assertEqual(lines[3], 'test_seconds_bucket{le="0.00125"} 2')
+        self.assertEqual(lines[-4], 'test_seconds_bucket{le="1.024"} 2')
+        self.assertEqual(lines[-3], 'test_seconds_bucket{le="+Inf"} 3')
+        self.assertEqual(lines[-2], "test_seconds_sum 100.0022")
+        self.assertEqual(lines[-1], "test_seconds_count 3")
+
+
+class TestServerMetrics(unittest.TestCase):
+    def setUp(self):
+        self.metrics = server_metrics.ServerMetrics()
+
+    def test_labels_known(self):
+        for action in jim.Actions:
+            self.assertEqual(self.metrics.messages[action], 0)
+        self.assertEqual(self.metrics.messages[server_metrics.INVALID_ACTION], 0)
+        for code in jim.Responses:
+            self.assertEqual(self.metrics.responses[code], 0)
+        for policy in sett.OUTPUT_POLICIES.values():
+            self.assertEqual(self.metrics.output_actions[policy], 0)
+
+    def test_render(self):
+        self.metrics.messages[jim.Actions.MESSAGE] += 2
+        self.metrics.responses[jim.Responses.OK] += 2
+        self.metrics.bytes_received = 100
+        self.metrics.output_actions[sett.OUTPUT_DISCONNECT] += 1
+        self.metrics.add_gauge("test_gauge", "Test gauge", lambda: 7)
+        lines = self.metrics.render().splitlines()
+        self.assertIn(f'chat_messages_total{{action="{jim.Actions.MESSAGE.value}"}} 2', lines)
+        self.assertIn(f'chat_responses_total{{code="{jim.Responses.OK.value}"}} 2', lines)
+        self.assertIn("chat_received_bytes_total 100", lines)
+        self.assertIn(f'chat_output_policy_actions_total{{policy="{sett.OUTPUT_DISCONNECT}"}} 1', lines)
+        self.assertIn("# TYPE test_gauge gauge", lines)
+        self.assertIn("test_gauge 7", lines)
+        self.assertIn("chat_fanout_seconds_count 0", lines)
+        # Every metric has its type declared once
+        types = [line.split()[2] for line in lines if line.startswith("# TYPE")]
+        self.assertEqual(len(types), len(set(types)))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,365 @@
+import time
+import socket
+import selectors
+import unittest
+from unittest import mock
+
+# Necessary to import from parent directory
+import sys
+sys.path.insert(0, '..')
+
+import jim
+import server_select
+import server_settings as sett
+
+
+class ServerTestCase(unittest.TestCase):
+    """
+    Server with client connections over socket pairs, serviced one event loop iteration at a time
+    """
+    def setUp(self):
+        self.server = server_select.Server("127.0.0.1", "0", offline_mailbox=False, message_history=False)
+        self.clients = []
+
+    def tearDown(self):
+        for client in self.clients:
+            client.close()
+        self.server.shutdown()
+
+    def connect(self, nickname: str = None) -> tuple:
+        """ Connect a client, introducing it with presence if the nickname is given; return connection, socket """
+        server_end, client_end = socket.socketpair()
+        client_end.setblocking(False)
+        self.clients.append(client_end)
+        connection = self.server._register_connection(server_end, ("127.0.0.1", len(self.clients)))
+        if nickname is not None:
+            self.send(client_end, action=jim.Actions.PRESENCE,
+                      user={jim.MessageFields.ACCOUNT_NAME: nickname, jim.MessageFields.STATUS: "online"})
+            self.assertEqual(self.responses(client_end), [jim.Responses.OK])
+        return connection, client_end
+
+    def send(self, client: socket.socket, **fields):
+        """ Send message from the client and let the server process it """
+        client.sendall(jim.frame(jim.Message(**fields).to_bytes()))
+        self.server._process_messages()
+
+    @staticmethod
+    def receive(client: socket.socket) -> list:
+        """ Return the messages and responses received by the client """
+        decoder = jim.FrameDecoder()
+        received = []
+        while True:
+            try:
+                data = client.recv(65536)
+            except BlockingIOError:
+                return received
+            if not data:
+                return received
+            received += [jim.decode(payload) for payload in decoder.feed(data)]
+
+    def responses(self, client: socket.socket) -> list:
+        """ Return codes of the responses received by the client """
+        return [received[jim.ResponseFields.RESPONSE] for received in self.receive(client)
+                if jim.ResponseFields.RESPONSE in received]
+
+    @staticmethod
+    def texts(received: list) -> list:
+        """ Return texts of the chat messages among the received ones """
+        return [message[jim.MessageFields.MESSAGE] for message in received
+                if message.get(jim.MessageFields.ACTION) == jim.Actions.MESSAGE]
+
+    def chat(self, client: socket.socket, sender: str, target: str, text: str, request_id: int = None):
+        fields = {} if request_id is None else {jim.MessageFields.ID: request_id}
+        self.send(client, action=jim.Actions.MESSAGE, to=target, message=text, **{"from": sender}, **fields)
+
+
+class TestErrors(ServerTestCase):
+    def test_unexpected_error_answered_with_request_id(self):
+        _, client = self.connect("alice")
+        with mock.patch.object(self.server, "_forward_message", side_effect=RuntimeError("boom")):
+            self.chat(client, "alice", "bob", "first", request_id=5)
+        self.chat(client, "alice", "bob", "second", request_id=6)
+        received = self.receive(client)
+        self.assertEqual([(response[jim.ResponseFields.RESPONSE], response.get(jim.ResponseFields.ID))
+                          for response in received],
+                         [(jim.Responses.SERVER_ERROR, 5), (jim.Responses.NOT_FOUND, 6)])
+
+    def test_history_request_id_out_of_range(self):
+        _, client = self.connect("alice")
+        self.server._history = history = mock.Mock()
+        # The messages sent from the history carry the request id, which the binary codec limits to int64
+        self.send(client, action=jim.Actions.HISTORY, peer="bob", id=2 ** 63)
+        self.assertEqual(self.responses(client), [jim.Responses.BAD_REQUEST])
+        history.query.assert_not_called()
+        self.send(client, action=jim.Actions.HISTORY, peer="bob", id=-2 ** 63)
+        self.assertEqual(history.query.call_args.args[-1], -2 ** 63)
+
+
+class TestRouting(ServerTestCase):
+    def test_direct_message(self):
+        _, alice = self.connect("alice")
+        _, bob = self.connect("bob")
+        _, carol = self.connect("carol")
+        self.chat(alice, "alice", "bob", "hi")
+        self.assertEqual(self.responses(alice), [jim.Responses.OK])
+        self.assertEqual(self.texts(self.receive(bob)), ["hi"])
+        self.assertEqual(self.receive(carol), [])
+
+    def test_direct_message_to_every_connection_of_user(self):
+        _, alice = self.connect("alice")
+        _, bob_phone = self.connect("bob")
+        _, bob_laptop = self.connect("bob")
+        self.chat(alice, "alice", "bob", "hi")
+        self.assertEqual(self.texts(self.receive(bob_phone)), ["hi"])
+        self.assertEqual(self.texts(self.receive(bob_laptop)), ["hi"])
+        # The sender's other connections get the messages to themselves, the sender's one does not
+        self.chat(bob_phone, "bob", "bob", "note")
+        self.assertEqual(self.receive(bob_phone)[0][jim.ResponseFields.RESPONSE], jim.Responses.OK)
+        self.assertEqual(self.texts(self.receive(bob_laptop)), ["note"])
+
+    def test_unknown_nickname(self):
+        _, alice = self.connect("alice")
+        self.chat(alice, "alice", "bob", "hi", request_id=1)
+        received = self.receive(alice)
+        self.assertEqual([(response[jim.ResponseFields.RESPONSE], response[jim.ResponseFields.ID])
+                          for response in received], [(jim.Responses.NOT_FOUND, 1)])
+
+    def test_other_nickname_refused(self):
+        connection, alice = self.connect("alice")
+        bob_connection, bob = self.connect("bob")
+        self.send(alice, action=jim.Actions.PRESENCE,
+                  user={jim.MessageFields.ACCOUNT_NAME: "mallory", jim.MessageFields.STATUS: "online"})
+        self.chat(alice, "bob", "bob", "spoofed")
+        self.assertEqual(self.responses(alice), [jim.Responses.BAD_LOGIN, jim.Responses.BAD_LOGIN])
+        self.assertEqual(self.receive(bob), [])
+        self.assertEqual(connection.nickname, "alice")
+        self.assertNotIn("mallory", self.server._nicknames)
+        self.assertEqual(self.server._nicknames, {"alice": {connection}, "bob": {bob_connection}})
+
+    def test_broadcast_once_to_every_connection(self):
+        _, alice = self.connect("alice")
+        _, bob_phone = self.connect("bob")
+        _, bob_laptop = self.connect("bob")
+        _, anonymous = self.connect()
+        self.chat(alice, "alice", jim.BROADCAST_MESSAGE_ADDRESS, "hello all")
+        self.assertEqual(self.responses(alice), [jim.Responses.OK])
+        for client in (bob_phone, bob_laptop, anonymous):
+            self.assertEqual(self.texts(self.receive(client)), ["hello all"])
+
+    def test_index_cleaned_up_on_close(self):
+        _, alice = self.connect("alice")
+        bob_connection, bob = self.connect("bob")
+        bob.close()
+        self.clients.remove(bob)
+        self.server._process_messages()
+        self.assertTrue(bob_connection.closing)
+        self.assertNotIn("bob", self.server._nicknames)
+        self.assertNotIn(bob_connection, self.server._connections.values())
+        self.chat(alice, "alice", "bob", "hi")
+        self.assertEqual(self.responses(alice), [jim.Responses.NOT_FOUND])
+
+
+class TestRooms(ServerTestCase):
+    def join(self, client: socket.socket, room: str, action: str = jim.Actions.JOIN) -> list:
+        self.send(client, action=action, room=room)
+        return self.responses(client)
+
+    def test_join_and_leave(self):
+        connection, alice = self.connect("alice")
+        self.assertEqual(self.join(alice, "#python"), [jim.Responses.OK])
+        self.assertEqual(self.server._rooms, {"#python": {connection}})
+        self.assertEqual(self.join(alice, "#python", jim.Actions.LEAVE), [jim.Responses.OK])
+        self.assertEqual(self.server._rooms, {})
+        self.assertEqual(connection.rooms, set())
+        self.assertEqual(self.join(alice, "#python", jim.Actions.LEAVE), [jim.Responses.NOT_FOUND])
+
+    def test_join_refused(self):
+        _, anonymous = self.connect()
+        self.assertEqual(self.join(anonymous, "#python"), [jim.Responses.LOGIN_REQUIRED])
+        _, alice = self.connect("alice")
+        self.assertEqual(self.join(alice, jim.BROADCAST_MESSAGE_ADDRESS), [jim.Responses.BAD_REQUEST])
+        self.assertEqual(self.server._rooms, {})
+
+    def test_delivery_to_members_only(self):
+        _, alice = self.connect("alice")
+        _, bob = self.connect("bob")
+        _, carol = self.connect("carol")
+        for client in (alice, bob):
+            self.join(client, "#python")
+        self.chat(alice, "alice", "#python", "hi room")
+        self.assertEqual(self.responses(alice), [jim.Responses.OK])
+        self.assertEqual(self.texts(self.receive(bob)), ["hi room"])
+        self.assertEqual(self.receive(carol), [])
+
+    def test_non_member_forbidden(self):
+        _, alice = self.connect("alice")
+        _, bob = self.connect("bob")
+        self.join(alice, "#python")
+        self.chat(bob, "bob", "#python", "let me in")
+        self.assertEqual(self.responses(bob), [jim.Responses.FORBIDDEN])
+        self.assertEqual(self.receive(alice), [])
+        self.chat(bob, "bob", "#rust", "anyone?")
+        self.assertEqual(self.responses(bob), [jim.Responses.NOT_FOUND])
+
+    def test_members_left_on_close(self):
+        alice_connection, alice = self.connect("alice")
+        bob_connection, bob = self.connect("bob")
+        for client in (alice, bob):
+            self.join(client, "#python")
+        self.server._close_connection(bob_connection)
+        self.assertEqual(self.server._rooms["#python"], {alice_connection})
+        self.chat(alice, "alice", "#python", "still here")
+        self.assertEqual(self.responses(alice), [jim.Responses.OK])
+
+
+class TestOutputPolicies(ServerTestCase):
+    FRAME_SIZE = 16 * 1024
+
+    def frames(self, count: int) -> list:
+        """ Return distinct frames, FRAME_SIZE bytes each """
+        return [bytes([i % 256]) * self.FRAME_SIZE for i in range(count)]
+
+    def overflow_count(self) -> int:
+        """ Number of frames to exceed the high watermark with """
+        return sett.OUTPUT_HIGH_WATERMARK // self.FRAME_SIZE + 1
+
+    def drain(self, connection: server_select.Connection, client: socket.socket) -> bytes:
+        """ Receive all the connection's output on the client side """
+        received = bytearray()
+        while connection.output:
+            self.assertTrue(self.server._flush_output(connection))
+            while True:
+                try:
+                    received += client.recv(1024 * 1024)
+                except BlockingIOError:
+                    break
+        return bytes(received)
+
+    def test_drop_oldest(self):
+        connection, client = self.connect("bob")
+        connection.policy = sett.OUTPUT_DROP_OLDEST
+        frames = self.frames(self.overflow_count())
+        for frame in frames:
+            self.server._send(connection, frame)
+        self.assertLessEqual(connection.output_size, sett.OUTPUT_LOW_WATERMARK)
+        dropped = len(frames) * self.FRAME_SIZE - connection.output_size
+        self.assertGreater(dropped, 0)
+        self.assertEqual(self.server._metrics.bytes_dropped, dropped)
+        self.assertEqual(self.server._metrics.output_actions[sett.OUTPUT_DROP_OLDEST], 1)
+        # The newest frames are kept
+        kept = connection.output_size // self.FRAME_SIZE
+        self.assertEqual(self.drain(connection, client), b"".join(frames[-kept:]))
+
+    def test_drop_oldest_keeps_partially_sent_frame(self):
+        connection, client = self.connect("bob")
+        connection.policy = sett.OUTPUT_DROP_OLDEST
+        connection.connection.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, 4096)
+        frames = self.frames(2)
+        for frame in frames:
+            self.server._send(connection, frame)
+        self.server._flush_pending_output()
+        self.assertTrue(connection.events & selectors.EVENT_WRITE)
+        partial = connection.output[0]
+        for frame in self.frames(self.overflow_count()):
+            self.server._send(connection, frame)
+        self.assertIs(connection.output[0], partial)
+
+    def test_disconnect(self):
+        connection, client = self.connect("bob")
+        self.assertEqual(connection.policy, sett.OUTPUT_DISCONNECT)
+        for frame in self.frames(self.overflow_count()):
+            self.server._send(connection, frame)
+        self.assertTrue(connection.closing)
+        self.assertEqual(connection.output_size, 0)
+        self.assertEqual(self.server._metrics.output_actions[sett.OUTPUT_DISCONNECT], 1)
+        self.server._flush_pending_output()
+        self.assertNotIn("bob", self.server._nicknames)
+        self.assertEqual(client.recv(1024), b"")
+
+    def test_pause_until_low_watermark(self):
+        sender, _ = self.connect("alice")
+        connection, client = self.connect("bob")
+        connection.policy = sett.OUTPUT_PAUSE
+        frames = self.frames(self.overflow_count())
+        for frame in frames:
+            self.server._send(connection, frame, sender)
+        self.assertEqual(sender.paused, 1)
+        self.assertFalse(sender.events & selectors.EVENT_READ)
+        self.assertEqual(self.server._metrics.output_actions[sett.OUTPUT_PAUSE], 1)
+        # Nothing is dropped, the sender is resumed once the output drains below the low watermark
+        self.assertEqual(self.drain(connection, client), b"".join(frames))
+        self.assertEqual(sender.paused, 0)
+        self.assertTrue(sender.events & selectors.EVENT_READ)
+        self.assertEqual(connection.paused_senders, set())
+
+    def test_partial_send(self):
+        connection, client = self.connect("bob")
+        connection.connection.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, 4096)
+        frames = self.frames(5)
+        for frame in frames:
+            self.server._send(connection, frame)
+        self.assertTrue(self.server._flush_output(connection))
+        # The socket accepts a part of the output, the rest is sent on write readiness
+        self.assertGreater(connection.output_size, 0)
+        self.assertLess(connection.output_size, len(frames) * self.FRAME_SIZE)
+        self.assertEqual(connection.output_size, sum(len(buffer) for buffer in connection.output))
+        self.assertTrue(connection.events & selectors.EVENT_WRITE)
+        self.assertEqual(self.drain(connection, client), b"".join(frames))
+        self.assertEqual(connection.output_size, 0)
+        self.assertFalse(connection.events & selectors.EVENT_WRITE)
+
+
+class TestHeartbeats(ServerTestCase):
+    def setUp(self):
+        # Short intervals, so that the probes are sent and answered in real time
+        patcher = mock.patch.multiple(sett, HEARTBEAT_INTERVAL=0.1, HEARTBEAT_TICK=0.01, HEARTBEAT_MISSES=2,
+                                      SELECT_TIMEOUT=0.01)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        super().setUp()
+
+    def run_loop(self, seconds: float, client: socket.socket, answer: bool) -> int:
+        """ Run the server's event loop for the time given, answering probes if asked to; return probes received """
+        probes = 0
+        deadline = time.perf_counter() + seconds
+        while time.perf_counter() < deadline:
+            self.server._process_messages()
+            for message in self.receive(client):
+                if message.get(jim.MessageFields.ACTION) == jim.Actions.PROBE:
+                    probes += 1
+                    if answer:
+                        client.sendall(jim.frame(jim.Message(
+                            action=jim.Actions.PRESENCE,
+                            user={jim.MessageFields.ACCOUNT_NAME: "alice", jim.MessageFields.STATUS: "online"}
+                        ).to_bytes()))
+        return probes
+
+    def test_silent_connection_probed_then_closed(self):
+        connection, client = self.connect("alice")
+        probes = self.run_loop(1.0, client, answer=False)
+        self.assertTrue(connection.closing)
+        self.assertEqual(probes, sett.HEARTBEAT_MISSES)
+        self.assertEqual(self.server._metrics.probes_sent, sett.HEARTBEAT_MISSES)
+        self.assertEqual(self.server._metrics.connections_evicted, 1)
+        self.assertNotIn("alice", self.server._nicknames)
+
+    def test_answering_connection_kept(self):
+        connection, client = self.connect("alice")
+        probes = self.run_loop(1.0, client, answer=True)
+        self.assertGreater(probes, sett.HEARTBEAT_MISSES)
+        self.assertFalse(connection.closing)
+        self.assertEqual(self.server._metrics.connections_evicted, 0)
+
+    def test_active_connection_not_probed(self):
+        connection, client = self.connect("alice")
+        deadline = time.perf_counter() + 0.5
+        while time.perf_counter() < deadline:
+            self.chat(client, "alice", "alice", "still here")
+            self.assertNotIn(jim.Actions.PROBE, [message.get(jim.MessageFields.ACTION)
+                                                 for message in self.receive(client)])
+        self.assertFalse(connection.closing)
+        self.assertEqual(self.server._metrics.probes_sent, 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,146 @@
+import socket
+import unittest
+from unittest import mock
+
+# Necessary to import from parent directory
+import sys
+sys.path.insert(0, '..')
+
+import jim
+import server_settings as sett
+import server_workers
+
+
+class TestWorkerBus(unittest.TestCase):
+    """
+    Two workers in this process connected with a socket pair bus, serviced one event loop iteration at a time
+    """
+    def setUp(self):
+        patcher = mock.patch.object(sett, "SELECT_TIMEOUT", 0)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        first_bus, second_bus = socket.socketpair(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.workers = [server_workers.WorkerServer("127.0.0.1", "0", 0, {1: first_bus}),
+                        server_workers.WorkerServer("127.0.0.1", "0", 1, {0: second_bus})]
+        self.peers = [next(iter(worker._peers.values())) for worker in self.workers]
+        self.clients = []
+
+    def tearDown(self):
+        for client in self.clients:
+            client.close()
+        for worker in self.workers:
+            worker.shutdown()
+
+    def run_loops(self):
+        """ Let both workers process their clients' and each other's data """
+        for _ in range(3):
+            for worker in self.workers:
+                worker._process_messages()
+
+    def connect(self, worker: int, nickname: str) -> tuple:
+        """ Connect a client to the worker and introduce it with presence; return connection, socket """
+        server_end, client_end = socket.socketpair()
+        client_end.setblocking(False)
+        self.clients.append(client_end)
+        connection = self.workers[worker]._register_connection(server_end, ("127.0.0.1", len(self.clients)))
+        self.send(client_end, action=jim.Actions.PRESENCE,
+                  user={jim.MessageFields.ACCOUNT_NAME: nickname, jim.MessageFields.STATUS: "online"})
+        self.assertEqual(self.responses(client_end), [jim.Responses.OK])
+        return connection, client_end
+
+    def disconnect(self, client: socket.socket):
+        client.close()
+        self.clients.remove(client)
+        self.run_loops()
+
+    def send(self, client: socket.socket, **fields):
+        client.sendall(jim.frame(jim.Message(**fields).to_bytes()))
+        self.run_loops()
+
+    def chat(self, client: socket.socket, sender: str, target: str, text: str):
+        self.send(client, action=jim.Actions.MESSAGE, to=target, message=text, **{"from": sender})
+
+    @staticmethod
+    def receive(client: socket.socket) -> list:
+        decoder = jim.FrameDecoder()
+        received = []
+        while True:
+            try:
+                data = client.recv(65536)
+            except BlockingIOError:
+                return received
+            if not data:
+                return received
+            received += [jim.decode(payload) for payload in decoder.feed(data)]
+
+    def responses(self, client: socket.socket) -> list:
+        return [received[jim.ResponseFields.RESPONSE] for received in self.receive(client)
+                if jim.ResponseFields.RESPONSE in received]
+
+    def texts(self, client: socket.socket) -> list:
+        return [message[jim.MessageFields.MESSAGE] for message in self.receive(client)
+                if message.get(jim.MessageFields.ACTION) == jim.Actions.MESSAGE]
+
+    def test_message_to_user_on_other_worker(self):
+        _, alice = self.connect(0, "alice")
+        _, bob = self.connect(1, "bob")
+        self.assertEqual(self.workers[0]._remote_nicknames, {"bob": {self.peers[0]}})
+        self.assertEqual(self.workers[1]._remote_nicknames, {"alice": {self.peers[1]}})
+        self.chat(alice, "alice", "bob", "hi")
+        self.assertEqual(self.responses(alice), [jim.Responses.OK])
+        self.assertEqual(self.texts(bob), ["hi"])
+        self.chat(bob, "bob", "carol", "anyone?")
+        self.assertEqual(self.responses(bob), [jim.Responses.NOT_FOUND])
+        self.assertEqual(self.receive(alice), [])
+
+    def test_nickname_down_with_last_connection(self):
+        _, alice = self.connect(0, "alice")
+        _, bob_phone = self.connect(1, "bob")
+        _, bob_laptop = self.connect(1, "bob")
+        self.disconnect(bob_phone)
+        self.assertEqual(self.workers[0]._remote_nicknames, {"bob": {self.peers[0]}})
+        self.disconnect(bob_laptop)
+        self.assertEqual(self.workers[0]._remote_nicknames, {})
+        self.chat(alice, "alice", "bob", "hi")
+        self.assertEqual(self.responses(alice), [jim.Responses.NOT_FOUND])
+
+    def test_broadcast_to_every_worker(self):
+        _, alice = self.connect(0, "alice")
+        _, carol = self.connect(0, "carol")
+        _, bob = self.connect(1, "bob")
+        self.chat(alice, "alice", jim.BROADCAST_MESSAGE_ADDRESS, "hello all")
+        self.assertEqual(self.responses(alice), [jim.Responses.OK])
+        self.assertEqual(self.texts(carol), ["hello all"])
+        self.assertEqual(self.texts(bob), ["hello all"])
+
+    def test_rooms_across_workers(self):
+        _, alice = self.connect(0, "alice")
+        _, bob = self.connect(1, "bob")
+        _, carol = self.connect(1, "carol")
+        for client in (alice, bob):
+            self.send(client, action=jim.Actions.JOIN, room="#python")
+            self.assertEqual(self.responses(client), [jim.Responses.OK])
+        self.assertEqual(self.workers[0]._remote_rooms, {"#python": {self.peers[0]}})
+        self.assertEqual(self.workers[1]._remote_rooms, {"#python": {self.peers[1]}})
+        self.chat(alice, "alice", "#python", "hi room")
+        self.assertEqual(self.responses(alice), [jim.Responses.OK])
+        self.assertEqual(self.texts(bob), ["hi room"])
+        self.assertEqual(self.receive(carol), [])
+        # Non-members are refused on the worker having members too
+        self.chat(carol, "carol", "#python", "let me in")
+        self.assertEqual(self.responses(carol), [jim.Responses.FORBIDDEN])
+        self.send(bob, action=jim.Actions.LEAVE, room="#python")
+        self.assertEqual(self.responses(bob), [jim.Responses.OK])
+        self.assertEqual(self.workers[0]._remote_rooms, {})
+        self.chat(alice, "alice", "#python", "alone")
+        self.assertEqual(self.responses(alice), [jim.Responses.OK])
+        self.assertEqual(self.receive(bob), [])
+        # The room disappears from the other worker when its last member there disconnects
+        self.disconnect(alice)
+        self.assertEqual(self.workers[1]._remote_rooms, {})
+        self.chat(carol, "carol", "#python", "anyone?")
+        self.assertEqual(self.responses(carol), [jim.Responses.NOT_FOUND])
+
+
+if __name__ == '__main__':
+    unittest.main()
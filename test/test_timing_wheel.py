@@ -0,0 +1,66 @@
+import unittest
+
+# Necessary to import from parent directory
+import sys
+sys.path.insert(0, '..')
+
+from timing_wheel import TimingWheel
+
+
+class TestTimingWheel(unittest.TestCase):
+    def setUp(self):
+        self.wheel = TimingWheel(tick=1.0, slots=8, now=100.0)
+
+    def test_expire_in_order(self):
+        self.wheel.schedule("a", 2.5, 100.0)
+        self.wheel.schedule("b", 1.0, 100.0)
+        self.assertEqual(len(self.wheel), 2)
+        self.assertIn("a", self.wheel)
+        self.assertEqual(self.wheel.advance(100.9), [])
+        self.assertEqual(self.wheel.advance(101.0), ["b"])
+        self.assertEqual(self.wheel.advance(102.0), [])
+        self.assertEqual(self.wheel.advance(103.0), ["a"])
+        self.assertEqual(len(self.wheel), 0)
+        self.assertNotIn("a", self.wheel)
+        self.assertEqual(self.wheel.advance(110.0), [])
+
+    def test_reschedule_and_cancel(self):
+        self.wheel.schedule("a", 1.0, 100.0)
+        self.wheel.schedule("a", 3.0, 100.5)
+        self.wheel.schedule("b", 2.0, 100.0)
+        self.assertTrue(self.wheel.cancel("b"))
+        self.assertFalse(self.wheel.cancel("b"))
+        self.assertEqual(self.wheel.advance(103.0), [])
+        self.assertEqual(self.wheel.advance(104.0), ["a"])
+        self.assertEqual(len(self.wheel), 0)
+
+    def test_past_delay_expires_on_next_tick(self):
+        self.wheel.advance(105.0)
+        self.wheel.schedule("a", -10.0, 105.0)
+        self.assertEqual(self.wheel.advance(105.5), [])
+        self.assertEqual(self.wheel.advance(106.0), ["a"])
+
+    def test_delays_beyond_span(self):
+        # 8 slots: the timers 8 and 16 ticks away share the slot with the one 0 ticks away
+        self.wheel.schedule("near", 1.0, 100.0)
+        self.wheel.schedule("round 2", 9.0, 100.0)
+        self.wheel.schedule("round 3", 17.0, 100.0)
+        self.assertEqual(self.wheel.advance(101.0), ["near"])
+        self.assertEqual(self.wheel.advance(108.0), [])
+        self.assertEqual(self.wheel.advance(109.0), ["round 2"])
+        self.assertEqual(self.wheel.advance(116.0), [])
+        self.assertEqual(self.wheel.advance(117.0), ["round 3"])
+
+    def test_long_gap(self):
+        keys = [f"timer {i}" for i in range(20)]
+        for i, key in enumerate(keys):
+            self.wheel.schedule(key, i + 1, 100.0)
+        # All the timers are due, however many rounds have passed
+        self.assertCountEqual(self.wheel.advance(1000.0), keys)
+        self.assertEqual(len(self.wheel), 0)
+        self.wheel.schedule("a", 1.0, 1000.0)
+        self.assertEqual(self.wheel.advance(1001.0), ["a"])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,86 @@
+"""
+Hashed timing wheel (Varghese & Lauck): timers are kept in a circular array of slots, one slot per tick,
+every timer in the slot of the tick it expires at. Scheduling, rescheduling and cancelling a timer are O(1),
+and advancing the wheel visits only the slots of the ticks elapsed, so the cost of a tick depends on the number
+of timers expiring, not on the number of timers. Timers further away than the wheel span (tick * slots) share
+slots with the nearer ones and are skipped until their round comes, so the wheel should span the usual delays.
+"""
+import math
+
+
+class TimingWheel:
+    """
+    Timers of hashable keys (e.g. connections), a key has one timer at most
+    """
+    __slots__ = ('_tick', '_slots', '_timers', '_current')
+
+    def __init__(self, tick: float, slots: int, now: float):
+        """
+        :param tick: timer precision, seconds - timers expire on the first advance() after their tick ends
+        :param slots: number of slots (wheel span in ticks)
+        :param now: current time, seconds (any monotonic clock, the same for all the calls)
+        Attributes:
+        _slots - keys of the timers by slot
+        _timers - expiration tick by key
+        _current - last tick processed
+        """
+        self._tick = tick
+        self._slots = [set() for _ in range(slots)]
+        self._timers = {}
+        self._current = int(now / tick)
+
+    def __len__(self):
+        return len(self._timers)
+
+    def __contains__(self, key) -> bool:
+        return key in self._timers
+
+    def schedule(self, key, delay: float, now: float):
+        """
+        Start the key's timer, or restart it if it is running
+        :param key: timer key
+        :param delay: time to expire in, seconds
+        :param now: current time, seconds
+        """
+        expiration = max(math.ceil((now + delay) / self._tick), self._current + 1)
+        scheduled = self._timers.get(key)
+        if scheduled == expiration:
+            return
+        if scheduled is not None:
+            self._slots[scheduled % len(self._slots)].discard(key)
+        self._timers[key] = expiration
+        self._slots[expiration % len(self._slots)].add(key)
+
+    def cancel(self, key) -> bool:
+        """
+        Stop the key's timer
+        :param key: timer key
+        :return: True if stopped, False if it was not running
+        """
+        scheduled = self._timers.pop(key, None)
+        if scheduled is None:
+            return False
+        self._slots[scheduled % len(self._slots)].discard(key)
+        return True
+
+    def advance(self, now: float) -> list:
+        """
+        Process the ticks elapsed by now and stop the timers expired
+        :param now: current time, seconds
+        :return: keys of the expired timers
+        """
+        target = int(now / self._tick)
+        if target <= self._current:
+            return []
+        expired = []
+        # Every slot is visited once at most, however long it has been since the last call
+        for tick in range(self._current + 1, self._current + 1 + min(target - self._current, len(self._slots))):
+            slot = self._slots[tick % len(self._slots)]
+            if slot:
+                due = [key for key in slot if self._timers[key] <= target]
+                for key in due:
+                    slot.discard(key)
+                    del self._timers[key]
+                expired.extend(due)
+        self._current = target
+        return expired